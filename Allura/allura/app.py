@@ -16,6 +16,7 @@
 #       under the License.
 
 import os
+import json
 import logging
 from urllib import basejoin
 from cStringIO import StringIO
@@ -24,7 +25,7 @@
 from copy import copy
 
 import pkg_resources
-from tg import expose, redirect, flash, validate
+from tg import expose, redirect, flash, validate, jsonify
 from tg.decorators import without_trailing_slash
 from tg import config as tg_config
 from pylons import request, app_globals as g, tmpl_context as c
@@ -44,7 +45,8 @@
 from allura import model
 from allura.controllers import BaseController
 from allura.lib.decorators import require_post, memoize
-from allura.lib.utils import permanent_redirect, ConfigProxy
+from allura.lib.utils import permanent_redirect, ConfigProxy, unique_attachments
+from allura.lib.utils import chunked_find, JSONForExport
 from allura import model as M
 from allura.tasks import index_tasks
 
@@ -739,6 +741,90 @@ def bulk_export(self, f, export_path='', with_attachments=False):
         """
         raise NotImplementedError('bulk_export')
 
+    def export_artifacts(self, f, cls, query, export_path='', with_attachments=False, chunk_size=None):
+        """Write the ``cls`` artifacts matching ``query`` into ``f`` as a compact
+        JSON list, for :meth:`bulk_export`.
+
+        The artifacts are loaded a chunk at a time (``bulk_export.chunk_size``,
+        default 100), with their discussion threads, posts and attachments
+        (see :meth:`prefetch_for_export`), and each chunk is written and
+        dropped from the ORM session before the next one, so exporting a big
+        tool takes constant memory.  Progress is reported on the export task
+        after each chunk (see :meth:`~allura.model.monq_model.MonQTask.report_progress`).
+        """
+        json_class = JSONForExport if with_attachments else jsonify.GenericJSON
+        chunk_size = chunk_size or asint(tg_config.get('bulk_export.chunk_size', 100))
+        total = cls.query.find(query).count()
+        done = 0
+        f.write('[')
+        for chunk in chunked_find(cls, dict(query), chunk_size):
+            attachments = self.prefetch_for_export(chunk)
+            if with_attachments:
+                self.export_attachments(chunk, export_path)
+            for artifact in chunk:
+                if done:
+                    f.write(',')
+                json.dump(artifact, f, cls=json_class, separators=(',', ':'))
+                done += 1
+            M.MonQTask.report_progress('exported %d/%d %s of %s' % (
+                done, total, cls.__name__, self.config.url()))
+            # artifacts, threads and posts are in the artifact session (and
+            # nothing is changed, so there is nothing to flush)
+            M.artifact_orm_session.clear()
+            for attachment in attachments:
+                session(attachment).expunge(attachment)
+        f.write(']')
+
+    def prefetch_for_export(self, artifacts):
+        """Load the discussion threads and their posts, and the attachments of
+        ``artifacts`` and of the posts, with a few queries for all of them
+        rather than a few for each one.
+
+        :returns: the attachments loaded
+        """
+        if not artifacts:
+            return []
+        by_ref = dict((a.index_id(), a) for a in artifacts)
+        threads = defaultdict(list)
+        for thread in M.Thread.query.find({'ref_id': {'$in': by_ref.keys()}}):
+            threads[thread.ref_id].append(thread)
+        posts = defaultdict(list)
+        for ref_id, ref_threads in threads.iteritems():
+            # several threads are merged by get_discussion_thread
+            if len(ref_threads) == 1:
+                by_ref[ref_id].discussion_thread = ref_threads[0]
+                posts[ref_threads[0]._id] = []
+        post_list = M.Post.query.find({
+            'thread_id': {'$in': posts.keys()}, 'status': 'ok', 'deleted': False,
+        }).sort('timestamp').all()
+        for post in post_list:
+            posts[post.thread_id].append(post)
+        for ref_threads in threads.itervalues():
+            if len(ref_threads) == 1:
+                ref_threads[0].prefetched_posts = posts[ref_threads[0]._id]
+
+        attachments = defaultdict(list)
+        try:
+            attachment_class = artifacts[0].attachment_class()
+        except NotImplementedError:
+            # e.g. blog posts have no attachments of their own
+            artifact_atts = []
+        else:
+            artifact_atts = attachment_class.query.find({
+                'app_config_id': self.config._id, 'type': 'attachment',
+                'artifact_id': {'$in': [a._id for a in artifacts]}}).all()
+            for att in artifact_atts:
+                attachments[att.artifact_id].append(att)
+            for artifact in artifacts:
+                artifact.attachments = unique_attachments(attachments[artifact._id])
+        post_atts = M.Post.attachment_class().query.find({
+            'type': 'attachment', 'post_id': {'$in': [p._id for p in post_list]}}).all()
+        for att in post_atts:
+            attachments[att.post_id].append(att)
+        for post in post_list:
+            post.attachments = unique_attachments(attachments[post._id])
+        return artifact_atts + post_atts
+
     def doap(self, parent):
         """App's representation for DOAP API.
 
@@ -15,11 +15,15 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import time
 import smtpd
+import Queue
 import asyncore
+import threading
 
 import faulthandler
 import tg
+from pylons import tmpl_context as c
 from paste.script import command
 
 import allura.tasks
@@ -42,21 +46,245 @@ class SMTPServerCommand(base.Command):
     def command(self):
         faulthandler.enable()
         self.basic_setup()
+        stats = MailServerStats()
+        queue = Queue.Queue(asint(tg.config.get('forgemail.queue_size', 1000)))
+        writer = RouteEmailWriter(
+            queue, stats,
+            batch_size=asint(tg.config.get('forgemail.batch_size', 100)),
+            stats_interval=asint(tg.config.get('forgemail.stats_interval', 300)))
+        writer.start()
         MailServer((tg.config.get('forgemail.host', '0.0.0.0'),
                     asint(tg.config.get('forgemail.port', 8825))),
-                   None)
-        asyncore.loop()
+                   None,
+                   queue=queue,
+                   stats=stats,
+                   writer=writer,
+                   max_message_size=asint(tg.config.get('forgemail.max_message_size', 0)))
+        try:
+            asyncore.loop()
+        finally:
+            writer.stop()
+
+
+class MailServerStats(object):
+
+    '''Counters of the messages handled by a :class:`MailServer`'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict(accepted=0, rejected_size=0, rejected_busy=0, posted=0, failed=0)
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def __getitem__(self, name):
+        return self.counts[name]
+
+
+class MailChannel(smtpd.SMTPChannel):
+
+    '''
+    An SMTP connection which stops buffering a message once it is bigger than
+    the server's ``max_message_size``, and rejects it at the end of DATA.
+    '''
+
+    def __init__(self, server, conn, addr):
+        self.mail_server = server
+        self.data_size = 0
+        smtpd.SMTPChannel.__init__(self, server, conn, addr)
+
+    def _too_big(self):
+        max_size = self.mail_server.max_message_size
+        return max_size and self.data_size > max_size
+
+    def collect_incoming_data(self, data):
+        if self._SMTPChannel__state == self.DATA:
+            self.data_size += len(data)
+            if self._too_big():
+                return
+        smtpd.SMTPChannel.collect_incoming_data(self, data)
+
+    def found_terminator(self):
+        if self._SMTPChannel__state == self.DATA and self._too_big():
+            base.log.warning('Msg from %s rejected, more than %d bytes',
+                             self._SMTPChannel__mailfrom, self.mail_server.max_message_size)
+            self.mail_server.stats.incr('rejected_size')
+            self._SMTPChannel__line = []
+            self._SMTPChannel__rcpttos = []
+            self._SMTPChannel__mailfrom = None
+            self._SMTPChannel__state = self.COMMAND
+            self.set_terminator('\r\n')
+            self.push('552 Message exceeds fixed maximum message size')
+        else:
+            smtpd.SMTPChannel.found_terminator(self)
+        if self._SMTPChannel__state == self.COMMAND:
+            self.data_size = 0
 
 
 class MailServer(smtpd.SMTPServer):
 
+    '''
+    Accepts messages into a bounded ``queue``, for a :class:`RouteEmailWriter`
+    to post as ``route_email`` tasks, so nothing slow happens in the event
+    loop.  Messages are refused with a temporary error while the queue is
+    full, or the ``writer`` can't post them, so the sending server tries
+    again later.
+    '''
+
+    def __init__(self, localaddr, remoteaddr, queue, stats=None, max_message_size=0, writer=None):
+        self.queue = queue
+        self.stats = stats or MailServerStats()
+        self.writer = writer
+        self.max_message_size = max_message_size
+        smtpd.SMTPServer.__init__(self, localaddr, remoteaddr)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            MailChannel(self, conn, addr)
+
     def process_message(self, peer, mailfrom, rcpttos, data):
+        base.log.info('Msg Received from %s for %s', mailfrom, rcpttos)
+        base.log.info(' (%d bytes)', len(data))
+        if self.writer is not None and self.writer.failing:
+            base.log.warning('Msg from %s refused, tasks can\'t be posted', mailfrom)
+            self.stats.incr('rejected_busy')
+            return '451 Unable to queue the message, try again later'
+        try:
+            self.queue.put_nowait(dict(peer=peer, mailfrom=mailfrom, rcpttos=rcpttos, data=data))
+        except Queue.Full:
+            base.log.warning('Msg from %s refused, queue is full', mailfrom)
+            self.stats.incr('rejected_busy')
+            return '451 Too busy, try again later'
+        self.stats.incr('accepted')
+
+
+class RouteEmailWriter(threading.Thread):
+
+    '''
+    Takes messages off the queue and posts them as ``route_email`` tasks, up
+    to ``batch_size`` at a time with a single insert.  A batch which can't
+    be posted after a few retries is held, and tried again every
+    ``retry_wait`` seconds, until it is posted or the writer is stopped (the
+    messages are then logged, for them to be replayed).
+    '''
+
+    retries = 3
+    retry_wait = 30
+
+    def __init__(self, queue, stats, batch_size=100, batch_wait=0.1, stats_interval=300):
+        threading.Thread.__init__(self, name='route_email writer')
+        self.daemon = True
+        self.queue = queue
+        self.stats = stats
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.stats_interval = stats_interval
+        self._stopping = False
+        self._stop = threading.Event()
+        self._held = None
+        self._last_stats = time.time()
+        # tmpl_context is per thread, so post the tasks with the context of
+        # the thread creating the writer
+        self._context = c._current_obj()
+
+    def run(self):
+        c._push_object(self._context)
         try:
-            base.log.info('Msg Received from %s for %s', mailfrom, rcpttos)
-            base.log.info(' (%d bytes)', len(data))
-            allura.tasks.mail_tasks.route_email.post(
-                peer=peer, mailfrom=mailfrom, rcpttos=rcpttos,
-                data=h.really_unicode(data))
-            base.log.info('Msg passed along')
-        except Exception:
-            base.log.exception('Error handling msg')
+            while not self._stopping:
+                batch = self._held or self.next_batch()
+                if batch:
+                    self._held = None if self.write(batch) else batch
+                if self._held and self._stop.wait(self.retry_wait):
+                    self._stopping = True
+                self.log_stats()
+            if self._held:
+                self.give_up(self._held + self.drain())
+        finally:
+            c._pop_object(self._context)
+
+    @property
+    def failing(self):
+        '''Whether a batch couldn't be posted and is being held'''
+        return self._held is not None
+
+    def stop(self):
+        '''Post whatever is still queued, and stop'''
+        self._stop.set()
+        self.queue.put(None)
+        self.join()
+
+    def next_batch(self):
+        # wait no longer than the next stats are due, so that they're logged
+        # while no mail arrives too
+        try:
+            msg = self.queue.get(timeout=max(self._last_stats + self.stats_interval - time.time(), 0.1))
+        except Queue.Empty:
+            return []
+        if msg is None:
+            self._stopping = True
+            return []
+        batch = [msg]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                msg = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                break
+            if msg is None:
+                self._stopping = True
+                break
+            batch.append(msg)
+        return batch
+
+    def drain(self):
+        msgs = []
+        while True:
+            try:
+                msg = self.queue.get_nowait()
+            except Queue.Empty:
+                return msgs
+            if msg is not None:
+                msgs.append(msg)
+
+    def write(self, batch):
+        '''Post a batch, returning whether it was'''
+        calls = [((), dict(peer=msg['peer'], mailfrom=msg['mailfrom'], rcpttos=msg['rcpttos'],
+                           data=h.really_unicode(msg['data'])))
+                 for msg in batch]
+        for attempt in range(self.retries + 1):
+            try:
+                allura.tasks.mail_tasks.route_email.post_many(calls)
+            except Exception:
+                base.log.exception('Error posting %d msgs (attempt %d)', len(batch), attempt + 1)
+                if attempt < self.retries:
+                    time.sleep(2 ** attempt)
+            else:
+                base.log.info('%d msgs passed along', len(batch))
+                self.stats.incr('posted', len(batch))
+                return True
+        if not self._held:
+            for msg in batch:
+                base.log.error('Could not post msg from %s for %s (%d bytes), holding it',
+                               msg['mailfrom'], msg['rcpttos'], len(msg['data']))
+        return False
+
+    def give_up(self, msgs):
+        '''Log messages which can't be posted, in full'''
+        for msg in msgs:
+            base.log.error('Msg from %s for %s (peer %s) lost, its data was:\n%s',
+                           msg['mailfrom'], msg['rcpttos'], msg['peer'], msg['data'])
+        self.stats.incr('failed', len(msgs))
+
+    def log_stats(self, force=False):
+        if not force and time.time() - self._last_stats < self.stats_interval:
+            return
+        self._last_stats = time.time()
+        base.log.info('Mail server stats: %s queued=%d',
+                      ' '.join('%s=%d' % kv for kv in sorted(self.stats.counts.items())),
+                      self.queue.qsize())
@@ -15,8 +15,10 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import errno
 import logging
 import os
+import resource
 import time
 import Queue
 from contextlib import contextmanager
@@ -59,6 +61,20 @@ class TaskdCommand(base.Command):
     parser = base.Command.standard_parser(verbose=True)
     parser.add_option('--only', dest='only', type='string', default=None,
                       help='only handle tasks of the given name(s) (can be comma-separated list)')
+    parser.add_option('--lanes', dest='lanes', type='string', default=None,
+                      help='only handle tasks in the given lane(s) (can be comma-separated list); '
+                      'use "default" for tasks not in any configured lane')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=None,
+                      help='number of tasks to claim at once (default: monq.claim_batch_size or 1)')
+    parser.add_option('--workers', dest='workers', type='int', default=None,
+                      help='number of worker processes to fork after loading the app (default: monq.workers or 1).  '
+                      'With more than one, this process supervises the workers and replaces them when they exit')
+    parser.add_option('--max-tasks', dest='max_tasks', type='int', default=None,
+                      help='restart a worker after it has handled this many tasks '
+                      '(default: monq.worker.max_tasks or 0, for no limit)')
+    parser.add_option('--max-rss', dest='max_rss', type='int', default=None, metavar='MB',
+                      help='restart a worker when its resident memory is above this many MB after a task '
+                      '(default: monq.worker.max_rss or 0, for no limit)')
     parser.add_option('--nocapture', dest='nocapture', action="store_true", default=False,
                       help='Do not capture stdout and redirect it to logging.  Useful for development with pdb.set_trace()')
 
@@ -67,6 +83,10 @@ def command(self):
         self.basic_setup()
         self.keep_running = True
         self.restart_when_done = False
+        self.workers = {}  # pid => start time, in the supervisor
+        self.is_worker = False  # forked by a supervisor
+        self.max_tasks = self._option('max_tasks', 'monq.worker.max_tasks', 0)
+        self.max_rss = self._option('max_rss', 'monq.worker.max_rss', 0)
         base.log.info('Starting taskd, pid %s' % os.getpid())
         signal.signal(signal.SIGHUP, self.graceful_restart)
         signal.signal(signal.SIGTERM, self.graceful_stop)
@@ -77,7 +97,23 @@ def command(self):
         signal.siginterrupt(signal.SIGHUP, False)
         signal.siginterrupt(signal.SIGTERM, False)
         signal.siginterrupt(signal.SIGUSR1, False)
-        self.worker()
+        self.wsgi_app = loadapp('config:%s#task' %
+                                self.args[0], relative_to=os.getcwd())
+        num_workers = self._option('workers', 'monq.workers', 1)
+        if num_workers > 1:
+            self.supervise(num_workers)
+        else:
+            self.worker()
+
+        if self.restart_when_done:
+            base.log.info('taskd pid %s restarting itself' % os.getpid())
+            os.execv(sys.argv[0], sys.argv)
+
+    def _option(self, name, config_key, default):
+        value = getattr(self.options, name)
+        if value is None:
+            value = asint(tg.config.get(config_key, default))
+        return value
 
     def graceful_restart(self, signum, frame):
         base.log.info(
@@ -85,28 +121,109 @@ def graceful_restart(self, signum, frame):
             (os.getpid(), signum))
         self.keep_running = False
         self.restart_when_done = True
+        # workers are replaced by a restarted supervisor
+        self._signal_workers(signal.SIGTERM)
 
     def graceful_stop(self, signum, frame):
         base.log.info(
             'taskd pid %s recieved signal %s preparing to do a graceful stop' %
             (os.getpid(), signum))
         self.keep_running = False
+        self._signal_workers(signal.SIGTERM)
 
     def log_current_task(self, signum, frame):
-        entry = 'taskd pid %s is currently handling task %s' % (
-            os.getpid(), getattr(self, 'task', None))
+        if self.workers:
+            entry = 'taskd pid %s is supervising workers %s' % (
+                os.getpid(), ', '.join(str(pid) for pid in sorted(self.workers)))
+            self._signal_workers(signal.SIGUSR1)
+        else:
+            entry = 'taskd pid %s is currently handling task %s (%s)' % (
+                os.getpid(), getattr(self, 'task', None), getattr(self, 'stats', None))
         status_log.info(entry)
         base.log.info(entry)
 
+    def _signal_workers(self, signum):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def supervise(self, num_workers):
+        '''
+        Fork ``num_workers`` workers sharing the already loaded app, and
+        replace each one that exits (e.g. to be recycled) until stopped.
+        '''
+        setproctitle('taskd supervisor')
+        base.log.info('taskd pid %s supervising %s workers' % (os.getpid(), num_workers))
+        while self.keep_running:
+            while self.keep_running and len(self.workers) < num_workers:
+                self._fork_worker()
+            self._wait_worker()
+        while self.workers:
+            self._wait_worker()
+        base.log.info('taskd supervisor pid %s stopped' % os.getpid())
+
+    def _fork_worker(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return
+        # in the new worker
+        self.workers = {}
+        self.is_worker = True
+        setproctitle('taskd')
+        status = 1
+        try:
+            self.worker()
+            status = 0
+        except:
+            base.log.exception('taskd worker pid %s failed' % os.getpid())
+        finally:
+            os._exit(status)
+
+    def _wait_worker(self):
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return
+            if e.errno == errno.ECHILD:
+                self.workers.clear()
+                return
+            raise
+        started = self.workers.pop(pid, None)
+        if started is None:
+            return
+        base.log.info('taskd worker pid %s exited with status %s' % (pid, status))
+        if status and time.time() - started < 5:
+            # don't spin if workers die right away
+            time.sleep(5)
+
+    def recycle_reason(self):
+        '''Why this worker should be replaced now, or None'''
+        if self.max_tasks and self.stats.tasks >= self.max_tasks:
+            return 'handled %s tasks' % self.stats.tasks
+        if self.max_rss:
+            rss = current_rss()
+            if rss > self.max_rss:
+                return 'using %sMB of memory' % rss
+        return None
+
     def worker(self):
         from allura import model as M
         name = '%s pid %s' % (os.uname()[1], os.getpid())
-        wsgi_app = loadapp('config:%s#task' %
-                           self.args[0], relative_to=os.getcwd())
+        wsgi_app = self.wsgi_app
+        self.stats = WorkerStats()
         poll_interval = asint(pylons.config.get('monq.poll_interval', 10))
+        batch_size = self.options.batch_size or asint(pylons.config.get('monq.claim_batch_size', 1))
         only = self.options.only
         if only:
             only = only.split(',')
+        lanes = self.options.lanes
+        if lanes:
+            lanes = [None if lane == 'default' else lane
+                     for lane in lanes.split(',')]
 
         def start_response(status, headers, exc_info=None):
             if status != '200 OK':
@@ -114,8 +231,14 @@ def start_response(status, headers, exc_info=None):
                     'Unexpected http response from taskd request: %s.  Headers: %s',
                     status, headers)
 
-        def waitfunc_noq():
-            time.sleep(poll_interval)
+        if M.monq_model.TaskWakeup.enabled():
+            wakeup = M.monq_model.TaskWakeup.instance()
+
+            def waitfunc_noq():
+                wakeup.wait(poll_interval, only=only, lanes=lanes)
+        else:
+            def waitfunc_noq():
+                time.sleep(poll_interval)
 
         def check_running(func):
             def waitfunc_checks_running():
@@ -127,14 +250,21 @@ def waitfunc_checks_running():
 
         waitfunc = waitfunc_noq
         waitfunc = check_running(waitfunc)
+        next_tasks = []
         while self.keep_running:
             try:
                 while self.keep_running:
-                    self.task = M.MonQTask.get(
-                        process=name,
-                        waitfunc=waitfunc,
-                        only=only)
+                    if next_tasks:
+                        self.task = next_tasks.pop(0)
+                    else:
+                        self.task, next_tasks = M.MonQTask.claim(
+                            process=name,
+                            limit=batch_size,
+                            waitfunc=waitfunc,
+                            only=only,
+                            lanes=lanes)
                     if self.task:
+                        start = datetime.utcnow()
                         with(proctitle("taskd:{0}:{1}".format(
                                 self.task.task_name, self.task._id))):
                             # Build the (fake) request
@@ -147,7 +277,16 @@ def waitfunc_checks_running():
                                                        'nocapture': self.options.nocapture,
                                                        })
                             list(wsgi_app(r.environ, start_response))
-                            self.task = None
+                        self.stats.add(self.task, start)
+                        log.info('taskd pid %s finished %s (%s)',
+                                 os.getpid(), self.task.task_name, self.stats)
+                        self.task = None
+                        reason = self.recycle_reason()
+                        if reason:
+                            base.log.info('taskd pid %s recycling after %s' % (os.getpid(), reason))
+                            self.keep_running = False
+                            # a supervisor replaces its workers, otherwise restart in place
+                            self.restart_when_done = not self.is_worker
             except Exception as e:
                 if self.keep_running:
                     base.log.exception(
@@ -155,11 +294,50 @@ def waitfunc_checks_running():
                     time.sleep(10)
                 else:
                     base.log.exception('taskd error %s' % e)
+        if next_tasks:
+            M.MonQTask.release(next_tasks)
         base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
 
-        if self.restart_when_done:
-            base.log.info('taskd pid %s restarting itself' % os.getpid())
-            os.execv(sys.argv[0], sys.argv)
+
+class WorkerStats(object):
+
+    '''Throughput and queue lag of one taskd worker'''
+
+    def __init__(self):
+        self.started = time.time()
+        self.tasks = 0
+        self.busy_secs = 0.0
+        self.last_lag = None
+
+    def add(self, task, start):
+        '''Record a task, started at ``start`` (utc datetime)'''
+        self.tasks += 1
+        self.busy_secs += total_seconds(datetime.utcnow() - start)
+        self.last_lag = total_seconds(start - task.time_queue)
+
+    def __str__(self):
+        elapsed = time.time() - self.started
+        return '%d tasks, %.2f tasks/s, %.0f%% busy, last queue lag %s, rss %sMB' % (
+            self.tasks,
+            self.tasks / elapsed if elapsed else 0,
+            100 * self.busy_secs / elapsed if elapsed else 0,
+            '%.1fs' % self.last_lag if self.last_lag is not None else 'n/a',
+            current_rss())
+
+
+def total_seconds(td):
+    return td.days * 86400 + td.seconds + td.microseconds / 1e6
+
+
+def current_rss():
+    '''Resident memory of this process, in MB'''
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() / (1024 * 1024)
+    except (IOError, IndexError, ValueError):
+        # peak rather than current usage; in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
 
 class TaskCommand(base.Command):
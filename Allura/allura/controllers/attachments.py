@@ -19,11 +19,13 @@
 from webob import exc
 
 from tg import expose, request, redirect
+from pylons import app_globals as g
 from ming.utils import LazyProperty
 
 from allura.lib.security import require_access
 from allura.lib.utils import is_ajax
 from allura import model as M
+from allura.model.filesystem import async_thumbnails
 from .base import BaseController
 
 
@@ -127,4 +129,11 @@ def index(self, delete=False, **kw):
     def thumb(self, **kwargs):
         if self.artifact.deleted:
             raise exc.HTTPNotFound
-        return self.thumbnail.serve(embed=True)
+        try:
+            thumbnail = self.thumbnail
+        except exc.HTTPNotFound:
+            if async_thumbnails() and self.attachment.is_image():
+                # the thumbnail task hasn't run yet
+                redirect(g.forge_static('images/spinner.gif'))
+            raise
+        return thumbnail.serve(embed=True)
@@ -40,6 +40,7 @@
 from allura.lib import utils
 from allura.lib import helpers as h
 from allura.lib import widgets as w
+from allura.lib import snapshot_cache
 from allura.lib.decorators import require_post
 from allura.lib.diff import HtmlSideBySideDiff
 from allura.lib.security import require_access, require_authenticated, has_access
@@ -673,6 +674,8 @@ def tarball(self, **kw):
         path = request.params.get('path')
         if not asbool(tg.config.get('scm.repos.tarball.enable', False)):
             raise exc.HTTPNotFound()
+        if asbool(tg.config.get('scm.repos.tarball.streaming', False)):
+            redirect('snapshot' + ('?path=' + quote(path.encode('utf-8')) if path else ''))
         rev = self._commit.url().split('/')[-2]
         status = c.app.repo.get_tarball_status(rev, path)
         if not status and request.method == 'POST':
@@ -680,6 +683,39 @@ def tarball(self, **kw):
             redirect('tarball' + '?path={0}'.format(path) if path else '')
         return dict(commit=self._commit, revision=rev, status=status)
 
+    @expose()
+    def snapshot(self, format='zip', path=None, **kw):
+        '''
+        Stream an archive of this commit as it's being generated.  Popular
+        snapshots are kept in the snapshot cache (if configured), and served
+        from there with support for Range requests.
+        '''
+        if not asbool(tg.config.get('scm.repos.tarball.enable', False)):
+            raise exc.HTTPNotFound()
+        content_type = M.repository.SNAPSHOT_FORMATS.get(format)
+        if content_type is None:
+            raise exc.HTTPNotFound()
+        repo = c.app.repo
+        rev = self._commit.url().split('/')[-2]
+        filename = u'%s.%s' % (repo.tarball_filename(rev, path), format)
+        cache = snapshot_cache.get_cache()
+        key = cache.key(self._commit.tree_id, filename) if cache else None
+        cached_path = cache.get(key) if cache else None
+        if cached_path:
+            # opened only once it's known that the contents are needed
+            return utils.serve_file(lambda: open(cached_path, 'rb'), filename, content_type,
+                                    size=os.path.getsize(cached_path),
+                                    embed=False, etag=key, accept_ranges=True)
+        chunks = repo.snapshot_stream(rev, format, path)
+        if cache and cache.should_store(key):
+            chunks = cache.store(key, chunks)
+        response.headers['Content-Type'] = ''
+        response.content_type = content_type
+        response.headers.add(
+            'Content-Disposition',
+            'attachment;filename="%s"' % filename.encode('utf-8'))
+        return chunks
+
     @expose('json:')
     def tarball_status(self, path=None, **kw):
         if not asbool(tg.config.get('scm.repos.tarball.enable', False)):
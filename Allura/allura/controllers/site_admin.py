@@ -23,6 +23,7 @@
 from tg import expose, validate, flash, config, redirect
 from tg.decorators import with_trailing_slash, without_trailing_slash
 import bson
+import pymongo
 import tg
 from paste.deploy.converters import aslist
 from pylons import app_globals as g
@@ -36,6 +37,7 @@
 from allura.lib import helpers as h
 from allura.lib import validators as v
 from allura.lib.decorators import require_post
+from allura.lib.custom_middleware import slow_requests
 from allura.lib.plugin import SiteAdminExtension, ProjectRegistrationProvider, AuthenticationProvider
 from allura.lib import search
 from allura.lib.security import require_access, Credentials
@@ -69,6 +71,7 @@ def __init__(self):
         self.user = AdminUserDetailsController()
         self.delete_projects = DeleteProjectsController()
         self.site_notifications = SiteNotificationController()
+        self.slow_requests = SlowRequestsController()
 
     def _check_security(self):
         with h.push_context(config.get('site_admin_project', 'allura'),
@@ -96,6 +99,7 @@ def sidebar_menu(self):
             SitemapEntry('Delete Projects', base_url + 'delete_projects', ui_icon=g.icons['delete']),
             SitemapEntry('Search Users', base_url + 'search_users', ui_icon=g.icons['search']),
             SitemapEntry('Site Notifications', base_url + 'site_notifications', ui_icon=g.icons['admin']),
+            SitemapEntry('Slow Requests', base_url + 'slow_requests', ui_icon=g.icons['stats']),
         ]
         for ep_name in sorted(g.entry_points['site_admin']):
             g.entry_points['site_admin'][ep_name]().update_sidebar_menu(links)
@@ -624,6 +628,37 @@ def task_doc(self, task_name, **kw):
         return dict(doc=doc, error=error)
 
 
+class SlowRequestsController(object):
+    """Show the profiles of slow requests saved by AlluraTimerMiddleware"""
+
+    def _check_security(self):
+        with h.push_context(config.get('site_admin_project', 'allura'),
+                            neighborhood=config.get('site_admin_project_nbhd', 'Projects')):
+            require_access(c.project, 'admin')
+
+    @expose('jinja:allura:templates/site_admin_slow_requests.html')
+    @without_trailing_slash
+    def index(self, url=None, limit=100, **kw):
+        query = {}
+        if url:
+            query['url'] = re.compile(re.escape(url))
+        fields = ['url', 'method', 'ms', 'mongo_calls', 'repeated', 'trigger', 'created']
+        profiles = list(slow_requests().find(query, fields=fields)
+                        .sort('_id', pymongo.DESCENDING).limit(int(limit)))
+        return dict(profiles=profiles, url=url)
+
+    @expose('jinja:allura:templates/site_admin_slow_request_view.html')
+    @without_trailing_slash
+    def view(self, profile_id):
+        try:
+            profile = slow_requests().find_one({'_id': bson.ObjectId(profile_id)})
+        except bson.errors.InvalidId:
+            profile = None
+        if profile is None:
+            raise HTTPNotFound()
+        return dict(profile=profile)
+
+
 class StatsController(object):
     """Show neighborhood stats."""
     @expose('jinja:allura:templates/site_admin_stats.html')
@@ -58,7 +58,7 @@
 )
 from allura.eventslistener import PostEvent
 
-from allura.lib import gravatar, plugin, utils
+from allura.lib import gravatar, plugin, utils, static_assets
 from allura.lib import helpers as h
 from allura.lib.widgets import analytics
 from allura.lib.security import Credentials
@@ -524,14 +524,19 @@ def forge_static(self, resource):
         base = config['static.url_base']
         if base.startswith(':'):
             base = request.scheme + base
-        return base + resource
+        return base + self._static_path(resource)
 
     def app_static(self, resource, app=None):
         base = config['static.url_base']
         app = app or c.app
         if base.startswith(':'):
             base = request.scheme + base
-        return (base + app.config.tool_name.lower() + '/' + resource)
+        return base + self._static_path(app.config.tool_name.lower() + '/' + resource)
+
+    def _static_path(self, path):
+        if asbool(config.get('static.fingerprint', False)):
+            return static_assets.get_index().fingerprinted(path)
+        return path
 
     def set_project(self, pid_or_project):
         'h.set_context() is preferred over this method'
@@ -18,18 +18,26 @@
 import os
 import re
 import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from random import random
+from time import time
 
 import tg
 import pkg_resources
+import pymongo
 from paste import fileapp
-from paste.deploy.converters import aslist
+from paste.deploy.converters import aslist, asint
 from pylons import tmpl_context as c
 from pylons.util import call_wsgi_application
-from timermiddleware import Timer, TimerMiddleware
+from timermiddleware import Timer, TimerMiddleware, StatsRecord, TimingDecorator
 from webob import exc, Request
 import pysolr
 
 from allura.lib import helpers as h
+from allura.lib import static_assets
 import allura.model.repository
 
 log = logging.getLogger(__name__)
@@ -44,6 +52,11 @@ class StaticFilesMiddleware(object):
 
     Map everything in allura/public/nf/* to <script_name>/*
     For each plugin, map everything <module>/nf/<ep_name>/* to <script_name>/<ep_name>/*
+
+    Files are looked up in an index built at startup (see
+    :mod:`allura.lib.static_assets`).  Fingerprinted paths of current files
+    are marked immutable, and precompressed .br/.gz variants are sent to
+    clients which accept them.
     '''
     CACHE_MAX_AGE = 60 * 60 * 24 * 365
 
@@ -53,6 +66,7 @@ def __init__(self, app, script_name=''):
         self.directories = [
             (self.script_name + ep.name.lower() + '/', ep)
             for ep in tool_entry_points]
+        self.index = static_assets.get_index()
 
     def __call__(self, environ, start_response):
         environ['static.script_name'] = self.script_name
@@ -60,7 +74,6 @@ def __call__(self, environ, start_response):
             return self.app(environ, start_response)
         try:
             app = self.get_app(environ)
-            app.cache_control(public=True, max_age=self.CACHE_MAX_AGE)
             return app(environ, start_response)
         except OSError:
             return exc.HTTPNotFound()(environ, start_response)
@@ -68,6 +81,29 @@ def __call__(self, environ, start_response):
     def get_app(self, environ):
         if '..' in environ['PATH_INFO']:
             raise OSError
+        path, immutable = self.index.resolve(environ['PATH_INFO'][len(self.script_name):])
+        if path is None:
+            # e.g. a file added since startup
+            app = self.find_app(environ)
+            app.cache_control(public=True, max_age=self.CACHE_MAX_AGE)
+            return app
+        headers = [('Access-Control-Allow-Origin', '*')]
+        kwargs = {}
+        if path in self.index.variants:
+            headers.append(('Vary', 'Accept-Encoding'))
+        file_path, encoding = self.index.choose(path, environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding:
+            kwargs = dict(content_type=self.index.content_type(path), content_encoding=encoding)
+        app = fileapp.FileApp(file_path, headers, **kwargs)
+        app.cache_control(public=True, max_age=self.CACHE_MAX_AGE)
+        if immutable:
+            # paste's cache_control() doesn't know this extension
+            app.headers[:] = [
+                (name, value + ', immutable' if name == 'Cache-Control' else value)
+                for name, value in app.headers]
+        return app
+
+    def find_app(self, environ):
         for prefix, ep in self.directories:
             if environ['PATH_INFO'].startswith(prefix):
                 filename = environ['PATH_INFO'][len(prefix):]
@@ -279,8 +315,198 @@ def __call__(self, environ, start_response):
         return resp(environ, start_response)
 
 
+class ProfileRecord(StatsRecord):
+
+    '''
+    A :class:`StatsRecord` which also keeps the tree of timed calls made
+    while handling a request, and the ordered list of its Mongo, Solr and
+    SCM calls, for :class:`AlluraTimerMiddleware` to save.
+    '''
+
+    # timers whose calls are listed, by prefix
+    call_timers = ('mongo', 'ming', 'solr', 'repo.', 'base_repo_tool.', 'urlopen', 'ldap')
+
+    def __init__(self, request, max_calls=2000):
+        super(ProfileRecord, self).__init__(request)
+        self.max_calls = max_calls
+        self.begin = time()
+        self.tree = []
+        self.calls = []
+        self.num_nodes = 0
+        self.next_call = None
+        self._stack = [self.tree]
+
+    @contextmanager
+    def timing(self, name):
+        call, self.next_call = self.next_call, None
+        with super(ProfileRecord, self).timing(name) as timed_this_one:
+            if not timed_this_one or self.num_nodes >= self.max_calls:
+                yield timed_this_one
+                return
+            self.num_nodes += 1
+            node = dict(name=name, start=self._ms(self.begin), children=[])
+            if call:
+                node['call'] = call
+            self._stack[-1].append(node)
+            self._stack.append(node['children'])
+            begin = time()
+            try:
+                yield True
+            finally:
+                node['ms'] = self._ms(begin)
+                self._stack.pop()
+                if name.startswith(self.call_timers):
+                    self.calls.append(dict(
+                        (k, v) for k, v in node.iteritems() if k != 'children'))
+
+    def _ms(self, since):
+        return round((time() - since) * 1000, 1)
+
+    def repeated(self, limit=10):
+        '''The calls made more than once, most frequent first, as
+        ``(call, count, total ms)``.  These are the likely N+1 queries.'''
+        counts = Counter()
+        totals = Counter()
+        for call in self.calls:
+            key = call.get('call') or call['name']
+            counts[key] += 1
+            totals[key] += call['ms']
+        return [(name, n, round(totals[name], 1))
+                for name, n in counts.most_common(limit) if n > 1]
+
+    def as_profile(self):
+        return dict(
+            url=self.url,
+            method=self.request.method,
+            ms=round(self.timers.get('total', 0) * 1000, 1),
+            # a list rather than a dict keyed by timer, as names like
+            # "repo.commit" can't be mongo keys
+            timings=sorted(
+                (dict(name=k, ms=round(v * 1000, 1), count=self.counts.get(k, 0))
+                 for k, v in self.timers.iteritems()),
+                key=lambda t: t['ms'], reverse=True),
+            mongo_calls=self.counts.get('mongo', 0),
+            tree=self.tree,
+            calls=self.calls,
+            repeated=self.repeated(),
+            created=datetime.utcnow(),
+        )
+
+
+def describe_call(method_name, instance, args):
+    '''A short description of a timed call, alike for calls which differ
+    only in the values they query for'''
+    from ming.odm.odmsession import ODMSession
+    if isinstance(instance, pymongo.collection.Collection):
+        spec = args[0] if args else None
+        fields = sorted(spec.keys()) if isinstance(spec, dict) else []
+        return '%s.%s(%s)' % (instance.name, method_name, ', '.join(fields))
+    if isinstance(instance, pymongo.cursor.Cursor):
+        return '%s.%s' % (instance.collection.name, method_name)
+    if isinstance(instance, ODMSession) and args and isinstance(args[0], type):
+        return '%s.%s' % (args[0].__name__, method_name)
+    if instance is not None:
+        return '%s.%s' % (type(instance).__name__, method_name)
+    return method_name
+
+
+class ProfilingTimingDecorator(TimingDecorator):
+
+    def run_and_log(self, func, instance, *args, **kwargs):
+        stats = self.middleware.stat_record
+        if isinstance(stats, ProfileRecord):
+            stats.next_call = describe_call(self.method_name, instance, args)
+        return super(ProfilingTimingDecorator, self).run_and_log(func, instance, *args, **kwargs)
+
+
+_slow_requests = None
+
+
+def slow_requests():
+    '''The capped collection of saved request profiles'''
+    global _slow_requests
+    if _slow_requests is None:
+        from allura import model as M
+        db = M.main_doc_session.db
+        if 'slow_requests' not in db.collection_names():
+            try:
+                db.create_collection(
+                    'slow_requests', capped=True, size=64 * 1024 * 1024,
+                    max=asint(tg.config.get('stats.profile.keep', 100)))
+            except pymongo.errors.CollectionInvalid:
+                pass  # created by another process in the meantime
+        _slow_requests = db.slow_requests
+    return _slow_requests
+
+
 class AlluraTimerMiddleware(TimerMiddleware):
 
+    '''
+    Logs timings of a sample (``stats.sample_rate``) of requests.
+
+    Requests can also be profiled: a sample of them
+    (``stats.profile.sample_rate``), and any request with an
+    ``X-Allura-Profile`` header of ``stats.profile.header_token``.  The
+    calls made by a profiled request are recorded, and if it took longer
+    than ``stats.profile.min_duration`` ms (or was asked for by header), it
+    is saved in the ``slow_requests`` capped collection, which is shown in
+    site admin.
+    '''
+
+    def __init__(self, app, config):
+        # like TimerMiddleware.__init__, but with ProfilingTimingDecorator
+        self.app = app
+        self.config = config
+        self.log = logging.getLogger('stats')
+        self.sample_rate = float(config.get('stats.sample_rate', 0))
+        self.profile_sample_rate = float(config.get('stats.profile.sample_rate', 0))
+        self.profile_token = config.get('stats.profile.header_token')
+        self.profile_min_duration = float(config.get('stats.profile.min_duration', 1000))
+        self.profile_max_calls = asint(config.get('stats.profile.max_calls', 2000))
+        self.tl = threading.local()
+        if self.sample_rate or self.profile_sample_rate or self.profile_token:
+            for timer in self.timers():
+                for name in timer.names:
+                    setattr(timer.target_class, name, ProfilingTimingDecorator(
+                        getattr(timer.target_class, name), timer.timer_name, name,
+                        timer.debug_each_call, self))
+
+    def profile_trigger(self, environ):
+        token = environ.get('HTTP_X_ALLURA_PROFILE')
+        if token and self.profile_token and token == self.profile_token:
+            return 'header'
+        if self.profile_sample_rate and random() < self.profile_sample_rate:
+            return 'sample'
+        return None
+
+    def __call__(self, environ, start_response):
+        trigger = self.profile_trigger(environ)
+        if not trigger:
+            return super(AlluraTimerMiddleware, self).__call__(environ, start_response)
+        req = Request(environ)
+        self.stat_record = s = ProfileRecord(req, max_calls=self.profile_max_calls)
+        try:
+            with s.timing('total'):
+                resp = req.get_response(self.app)
+                result = resp(environ, start_response)
+                s = self.before_logging(s)
+        finally:
+            self.stat_record = None
+        self.log.info('%r', s)
+        self.save_profile(s, trigger)
+        return result
+
+    def save_profile(self, record, trigger):
+        profile = record.as_profile()
+        if trigger != 'header' and profile['ms'] < self.profile_min_duration:
+            return
+        profile['trigger'] = trigger
+        profile.update(record._custom_stats)
+        try:
+            slow_requests().insert(profile)
+        except Exception:
+            log.exception('Error saving profile of %s', record.url)
+
     def timers(self):
         import genshi
         import jinja2
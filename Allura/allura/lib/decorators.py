@@ -48,7 +48,8 @@ def task(*args, **kw):
 
     Calling ``<original_callable>.post(*args, **kw)`` queues the callable for
     execution by a background worker process. All parameters must be
-    BSON-serializable.
+    BSON-serializable.  ``<original_callable>.post_many([(args, kw), ...])``
+    queues several calls at once.
 
     Example usage::
 
@@ -61,19 +62,42 @@ def myotherfunc():
             # No email notifications will be sent for c.project during this task
             pass
 
+        @task(lane='bulk')
+        def mybulkfunc():
+            # Queued in the 'bulk' lane (see MonQTask.lane_for)
+            pass
+
+        @task(coalesce='union')
+        def mymergedfunc(ids):
+            # ids posted while an earlier task is still waiting are added
+            # to that task (see MonQTask.post)
+            pass
+
     """
     def task_(func):
-        def post(*args, **kwargs):
-            delay = kwargs.pop('delay', 0)
+        def notifications_cm():
             project = getattr(c, 'project', None)
             cm = (h.notifications_disabled if project and
                   kw.get('notifications_disabled') else h.null_contextmanager)
-            with cm(project):
+            return cm(project)
+
+        def post(*args, **kwargs):
+            delay = kwargs.pop('delay', 0)
+            with notifications_cm():
                 from allura import model as M
-                return M.MonQTask.post(func, args, kwargs, delay=delay)
+                return M.MonQTask.post(func, args, kwargs, delay=delay,
+                                       lane=kw.get('lane'), coalesce=kw.get('coalesce'))
+
+        def post_many(calls):
+            # ``calls`` is a list of (args, kwargs), queued with one insert
+            with notifications_cm():
+                from allura import model as M
+                return M.MonQTask.post_many(func, calls, lane=kw.get('lane'))
+
         # if decorating a class, have to make it a staticmethod
         # or it gets a spurious cls argument
         func.post = staticmethod(post) if inspect.isclass(func) else post
+        func.post_many = staticmethod(post_many) if inspect.isclass(func) else post_many
         return func
     if len(args) == 1 and callable(args[0]):
         return task_(args[0])
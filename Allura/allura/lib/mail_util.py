@@ -15,15 +15,22 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
 import re
+import json
+import time
+import uuid
+import errno
 import logging
 import smtplib
+import threading
 import email.feedparser
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
 from email import header
 
 import tg
+from ming.utils import LazyProperty
 from paste.deploy.converters import asbool, asint, aslist
 from formencode import validators as fev
 from pylons import tmpl_context as c
@@ -221,8 +228,21 @@ def isvalid(addr):
 
 class SMTPClient(object):
 
-    def __init__(self):
-        self._client = None
+    '''
+    Sends mail over a pool of at most ``smtp_pool_size`` SMTP connections,
+    which are kept open between messages.
+    '''
+
+    def __init__(self, pool_size=None):
+        self.pool_size = pool_size
+        self._pid = os.getpid()
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @LazyProperty
+    def _slots(self):
+        pool_size = self.pool_size or asint(tg.config.get('smtp_pool_size', 4))
+        return threading.BoundedSemaphore(max(pool_size, 1))
 
     def sendmail(
             self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message,
@@ -259,17 +279,68 @@ def sendmail(
             log.warning('No valid addrs in %s, so not sending mail',
                         map(unicode, addrs))
             return
+        spool = MailSpool.from_config()
+        # servers limit the number of recipients of a single message
+        max_rcpts = asint(tg.config.get('smtp_max_rcpts', 100)) or len(smtp_addrs)
+        for i in range(0, len(smtp_addrs), max_rcpts):
+            rcpts = smtp_addrs[i:i + max_rcpts]
+            if spool:
+                spool.put(config.return_path, rcpts, content)
+            else:
+                self.send_raw(config.return_path, rcpts, content)
+
+    def send_raw(self, return_path, rcpts, content):
+        '''Send an already formatted message over a pooled connection.  A
+        connection which fails is replaced and the message sent again once.'''
+        client = self._acquire()
+        try:
+            client.sendmail(return_path, rcpts, content)
+        except:
+            self._discard(client)
+            try:
+                client = self._connect()
+                client.sendmail(return_path, rcpts, content)
+            except:
+                self._discard(client)
+                self._slots.release()
+                raise
+        self._release(client)
+
+    def _acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked: the connections belong to the parent process
+                self._pid = os.getpid()
+                self._idle = []
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self._connect()
+        except:
+            self._slots.release()
+            raise
+
+    def _release(self, client):
+        with self._lock:
+            self._idle.append(client)
+        self._slots.release()
+
+    def _discard(self, client):
         try:
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
+            client.close()
         except:
-            self._connect()
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
+            pass
+
+    def close(self):
+        '''Close the idle connections'''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for client in idle:
+            try:
+                client.quit()
+            except:
+                self._discard(client)
 
     def _connect(self):
         if asbool(tg.config.get('smtp_ssl', False)):
@@ -289,4 +360,67 @@ def _connect(self):
                               tg.config['smtp_password'])
         if asbool(tg.config.get('smtp_tls', False)):
             smtp_client.starttls()
-        self._client = smtp_client
+        return smtp_client
+
+
+class MailSpool(object):
+
+    '''
+    A directory of outgoing messages.
+
+    With ``smtp_spool_dir`` set, :class:`SMTPClient` only writes messages to
+    the spool, so sending a burst of mail doesn't hold up taskd on the SMTP
+    server.  ``paster script ... allura/scripts/mail_spool.py`` then sends
+    them, over several connections at once.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        for sub in ('tmp', 'new', 'cur'):
+            try:
+                os.makedirs(os.path.join(root, sub))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    @classmethod
+    def from_config(cls):
+        root = tg.config.get('smtp_spool_dir')
+        return cls(root) if root else None
+
+    def put(self, return_path, rcpts, content):
+        name = '%d.%s' % (time.time() * 1000, uuid.uuid4().hex)
+        tmp_path = os.path.join(self.root, 'tmp', name)
+        with open(tmp_path, 'wb') as fp:
+            json.dump(dict(return_path=return_path, rcpts=rcpts), fp)
+            fp.write('\n')
+            fp.write(content)
+        # only complete messages show up in new/
+        os.rename(tmp_path, os.path.join(self.root, 'new', name))
+
+    def names(self):
+        return sorted(os.listdir(os.path.join(self.root, 'new')))
+
+    def read(self, name, sub='new'):
+        with open(os.path.join(self.root, sub, name), 'rb') as fp:
+            envelope = json.loads(fp.readline())
+            return envelope['return_path'], envelope['rcpts'], fp.read()
+
+    def send(self, client, name):
+        '''Send a spooled message with ``client``, and remove it once sent.
+        Returns False if it failed (it is then left in the spool).'''
+        new_path = os.path.join(self.root, 'new', name)
+        cur_path = os.path.join(self.root, 'cur', name)
+        try:
+            # claim it, so concurrent senders don't send it twice
+            os.rename(new_path, cur_path)
+        except OSError:
+            return True
+        try:
+            client.send_raw(*self.read(name, 'cur'))
+        except Exception:
+            log.exception('Error sending spooled mail %s', name)
+            os.rename(cur_path, new_path)
+            return False
+        os.remove(cur_path)
+        return True
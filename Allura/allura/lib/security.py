@@ -19,13 +19,16 @@
 This module provides the security predicates used in decorating various models.
 """
 import logging
-from collections import defaultdict
+import threading
+from collections import defaultdict, OrderedDict
 
 from pylons import tmpl_context as c
 from pylons import request
 from webob import exc
 from itertools import chain
 from ming.utils import LazyProperty
+from paste.deploy.converters import asint
+import tg
 
 from allura.lib.utils import TruthyCallable
 
@@ -62,8 +65,10 @@ def clear(self):
         'clear cache'
         self.users = {}
         self.projects = {}
+        self.decisions = {}
 
     def clear_user(self, user_id, project_id=None):
+        self.decisions = {}
         if project_id == '*':
             to_remove = [(uid, pid)
                          for uid, pid in self.users if uid == user_id]
@@ -315,63 +320,260 @@ def has_access(obj, permission, user=None, project=None):
     def predicate(obj=obj, user=user, project=project, roles=None):
         if obj is None:
             return False
+        if user is None:
+            user = c.user
+        assert user, 'c.user should always be at least M.User.anonymous()'
+        cred = Credentials.get()
+        if project is None:
+            if isinstance(obj, M.Neighborhood):
+                project = obj.neighborhood_project
+                if project is None:
+                    log.error('Neighborhood project missing for %s', obj)
+                    return False
+            elif isinstance(obj, M.Project):
+                project = obj.root_project
+            else:
+                project = getattr(obj, 'project', None) or c.project
+                project = project.root_project
         if roles is None:
-            if user is None:
-                user = c.user
-            assert user, 'c.user should always be at least M.User.anonymous()'
-            cred = Credentials.get()
-            if project is None:
-                if isinstance(obj, M.Neighborhood):
-                    project = obj.neighborhood_project
-                    if project is None:
-                        log.error('Neighborhood project missing for %s', obj)
-                        return False
-                elif isinstance(obj, M.Project):
-                    project = obj.root_project
-                else:
-                    project = getattr(obj, 'project', None) or c.project
-                    project = project.root_project
             roles = cred.user_roles(
                 user_id=user._id, project_id=project._id).reaching_ids
 
-        # TODO: move deny logic into loop below; see ticket [#6715]
-        if user != M.User.anonymous():
-            user_roles = Credentials.get().user_roles(user_id=user._id,
-                                                      project_id=project.root_project._id)
-            for r in user_roles:
-                deny_user = M.ACE.deny(r['_id'], permission)
-                if M.ACL.contains(deny_user, obj.acl):
-                    return False
-
-        chainable_roles = []
-        for rid in roles:
-            for ace in obj.acl:
-                if M.ACE.match(ace, rid, permission):
-                    if ace.access == M.ACE.ALLOW:
-                        # access is allowed
-                        # log.info('%s: True', txt)
-                        return True
-                    else:
-                        # access is denied for this role
-                        break
-            else:
-                # access neither allowed or denied, may chain to parent context
-                chainable_roles.append(rid)
-        parent = obj.parent_security_context()
-        if parent and chainable_roles:
-            result = has_access(parent, permission, user=user, project=project)(
-                roles=tuple(chainable_roles))
-        elif not isinstance(obj, M.Neighborhood):
-            result = has_access(project.neighborhood, 'admin', user=user)()
-            if not (result or isinstance(obj, M.Project)):
-                result = has_access(project, 'admin', user=user)()
-        else:
-            result = False
-        # log.info('%s: %s', txt, result)
+        key = _decision_key(obj, permission, user, project, roles)
+        result = cred.decisions.get(key)
+        if result is not None:
+            return result
+        shared = _shared_decisions()
+        if shared is not None:
+            shared_key = key + _admin_roles_key(cred, user, project)
+            result = shared.get(shared_key)
+        if result is None:
+            result = _has_access(obj, permission, user, project, roles)
+            if shared is not None:
+                shared.put(shared_key, result)
+        cred.decisions[key] = result
         return result
     return TruthyCallable(predicate)
 
 
+def _has_access(obj, permission, user, project, roles):
+    from allura import model as M
+
+    # TODO: move deny logic into loop below; see ticket [#6715]
+    if user != M.User.anonymous():
+        user_roles = Credentials.get().user_roles(user_id=user._id,
+                                                  project_id=project.root_project._id)
+        for r in user_roles:
+            deny_user = M.ACE.deny(r['_id'], permission)
+            if M.ACL.contains(deny_user, obj.acl):
+                return False
+
+    chainable_roles = []
+    for rid in roles:
+        for ace in obj.acl:
+            if M.ACE.match(ace, rid, permission):
+                if ace.access == M.ACE.ALLOW:
+                    # access is allowed
+                    # log.info('%s: True', txt)
+                    return True
+                else:
+                    # access is denied for this role
+                    break
+        else:
+            # access neither allowed or denied, may chain to parent context
+            chainable_roles.append(rid)
+    parent = obj.parent_security_context()
+    if parent and chainable_roles:
+        result = has_access(parent, permission, user=user, project=project)(
+            roles=tuple(chainable_roles))
+    elif not isinstance(obj, M.Neighborhood):
+        result = has_access(project.neighborhood, 'admin', user=user)()
+        if not (result or isinstance(obj, M.Project)):
+            result = has_access(project, 'admin', user=user)()
+    else:
+        result = False
+    # log.info('%s: %s', txt, result)
+    return result
+
+
+def _acl_key(acl):
+    return tuple((ace.access, ace.role_id, ace.permission) for ace in acl)
+
+
+def _decision_key(obj, permission, user, project, roles):
+    '''
+    Everything a :func:`has_access` decision depends on: the ACLs of the
+    object and its parent security contexts (and of the project and
+    neighborhood, whose admins are always allowed), rather than the object
+    itself.  So e.g. all the tickets of a tracker with the same ACL share a
+    decision, and changing an ACL makes a new key.
+    '''
+    from allura import model as M
+    contexts = []
+    while obj is not None:
+        contexts.append((isinstance(obj, M.Neighborhood), isinstance(obj, M.Project), _acl_key(obj.acl)))
+        obj = obj.parent_security_context()
+    neighborhood = project.neighborhood
+    return (permission, user._id, project._id, tuple(roles), tuple(contexts),
+            _acl_key(project.acl), neighborhood and _acl_key(neighborhood.acl))
+
+
+def _admin_roles_key(cred, user, project):
+    '''
+    The user's roles in the projects whose admins :func:`has_access` falls
+    back to.  The roles are loaded (once per request) from the ProjectRoles,
+    so decisions shared between requests are not reused after a role change.
+    '''
+    project_ids = [project.root_project._id]
+    neighborhood_project = project.neighborhood and project.neighborhood.neighborhood_project
+    if neighborhood_project:
+        project_ids.append(neighborhood_project._id)
+    return tuple(tuple(cred.user_roles(user_id=user._id, project_id=pid).reaching_ids)
+                 for pid in project_ids)
+
+
+class DecisionCache(object):
+
+    '''A thread-safe LRU cache of :func:`has_access` decisions shared between requests'''
+
+    def __init__(self, size):
+        self.size = size
+        self._decisions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            result = self._decisions.pop(key, None)
+            if result is not None:
+                self._decisions[key] = result
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            self._decisions.pop(key, None)
+            self._decisions[key] = result
+            while len(self._decisions) > self.size:
+                self._decisions.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._decisions.clear()
+
+
+_decision_cache = None
+
+
+def _shared_decisions():
+    '''The process-wide :class:`DecisionCache`, if ``security.decision_cache_size`` is set'''
+    global _decision_cache
+    size = asint(tg.config.get('security.decision_cache_size', 0))
+    if not size:
+        return None
+    if _decision_cache is None or _decision_cache.size != size:
+        _decision_cache = DecisionCache(size)
+    return _decision_cache
+
+
+def filter_by_access(objs, permission, user=None, project=None):
+    '''
+    The objects (e.g. artifacts for a list page) which the user has the
+    permission on.  The user's roles in all their projects and their
+    AppConfigs are loaded up front, and objects with the same ACLs share one
+    decision.
+    '''
+    from allura import model as M
+    objs = list(objs)
+    if user is None:
+        user = c.user
+    app_config_ids = set(getattr(obj, 'app_config_id', None) for obj in objs)
+    app_config_ids.discard(None)
+    if app_config_ids:
+        app_configs = M.AppConfig.query.find({'_id': {'$in': list(app_config_ids)}}).all()
+        project_ids = set(ac.project_id for ac in app_configs)
+        projects = M.Project.query.find({'_id': {'$in': list(project_ids)}}).all()
+        Credentials.get().load_user_roles(
+            user._id, *set(p.root_project._id for p in projects))
+    return [obj for obj in objs if has_access(obj, permission, user=user, project=project)()]
+
+
+#: :func:`acl_principals` for roles which an ACL leaves to the parent security context
+INHERITED = 'inherit'
+#: :func:`acl_principals` for roles which an ACL allows through :data:`~allura.model.types.EVERYONE`
+EVERYONE_ALLOWED = 'everyone'
+
+
+def acl_principals(acl, permission):
+    '''
+    What an object's own ACL says about a permission, as lists of strings to
+    index into solr and match with :func:`principals_filter`.
+
+    Returns ``(allowed, denied)``.  ``allowed`` has the ids of the roles the
+    ACL allows, plus :data:`EVERYONE_ALLOWED` or :data:`INHERITED` for the
+    roles it doesn't mention, unless it denies them.  ``denied`` has the ids of
+    the roles with a DENY entry for the permission, which :func:`has_access`
+    checks against the user's own roles first.
+    '''
+    from allura import model as M
+    decided = OrderedDict()
+    others = None
+    denied = []
+    for ace in acl:
+        if ace.permission not in (permission, M.ALL_PERMISSIONS):
+            continue
+        if ace.access == M.ACE.DENY and ace.permission == permission and ace.role_id != M.EVERYONE:
+            denied.append(str(ace.role_id))
+        if others is not None:
+            # roles not decided yet were decided by the EVERYONE entry
+            continue
+        if ace.role_id == M.EVERYONE:
+            others = ace.access
+        else:
+            decided.setdefault(ace.role_id, ace.access)
+    allowed = [str(rid) for rid, access in decided.iteritems() if access == M.ACE.ALLOW]
+    if others is None:
+        allowed.append(INHERITED)
+    elif others == M.ACE.ALLOW:
+        allowed.append(EVERYONE_ALLOWED)
+    return allowed, denied
+
+
+def principals_filter(allowed_field, denied_field, user=None, project=None, unindexed=False):
+    '''
+    Solr filter queries for the objects which the user has a permission on,
+    given their :func:`acl_principals` for it indexed into ``allowed_field``
+    and ``denied_field``.  So a search gets full pages and exact hit counts
+    without calling :func:`has_access` for each result.
+
+    Roles the objects leave to their parent security context are taken to
+    have the permission there, so check it on the parent (e.g. the tool)
+    first.  Project and neighborhood admins are always allowed, so get no
+    filter queries.
+
+    With ``unindexed``, objects indexed without ``allowed_field`` (e.g.
+    before it was added) match too, and must be checked with
+    :func:`has_access`.
+    '''
+    from allura import model as M
+    if user is None:
+        user = c.user
+    if project is None:
+        project = c.project.root_project
+    if has_access(project, 'admin', user=user, project=project)():
+        return []
+    cred = Credentials.get()
+    roles = cred.user_roles(user_id=user._id, project_id=project._id).reaching_ids
+    principals = [INHERITED, EVERYONE_ALLOWED] + [str(rid) for rid in roles]
+    fq = ['%s:(%s)' % (allowed_field, ' OR '.join(principals))]
+    if unindexed:
+        fq[0] += ' OR (*:* -%s:[* TO *])' % allowed_field
+    if user != M.User.anonymous():
+        user_roles = cred.user_roles(user_id=user._id, project_id=project.root_project._id)
+        own = [str(r['_id']) for r in user_roles]
+        if own:
+            fq.append('-%s:(%s)' % (denied_field, ' OR '.join(own)))
+    return fq
+
+
 def all_allowed(obj, user_or_role=None, project=None):
     '''
     List all the permission names that a given user or named role
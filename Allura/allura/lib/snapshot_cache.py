@@ -0,0 +1,178 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+'''
+On-disk cache of streamed repository snapshots.
+
+Snapshots are streamed straight from the SCM to the client.  Once the same
+snapshot has been requested ``min_hits`` times (counted per process), the
+next stream is also written to the cache, and later requests are served from
+that file.  The least recently served files are removed once the cache grows
+past ``max_size`` bytes.
+
+The same kind of cache keeps popular GridFS files (attachments, screenshots,
+etc) on local disk; see :func:`get_file_cache`.
+'''
+
+import os
+import errno
+import logging
+import threading
+from hashlib import sha1
+from collections import OrderedDict
+
+import tg
+from paste.deploy.converters import asint
+
+log = logging.getLogger(__name__)
+
+
+class SnapshotCache(object):
+
+    def __init__(self, root, max_size, min_hits=2, max_tracked=10000):
+        self.root = root
+        self.max_size = max_size
+        self.min_hits = min_hits
+        self.max_tracked = max_tracked
+        self._hits = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, tree_id, filename):
+        '''
+        Cache key for a snapshot.  Snapshots of the same tree only differ by
+        their file name (which is also their top-level directory).
+        '''
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+        return sha1('%s\0%s' % (tree_id, filename)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        '''Return the path of a cached snapshot and mark it as used, or None'''
+        path = self.path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def should_store(self, key):
+        '''Count a request for ``key``; True once it has been popular enough'''
+        with self._lock:
+            hits = self._hits.pop(key, 0) + 1
+            self._hits[key] = hits
+            while len(self._hits) > self.max_tracked:
+                self._hits.popitem(last=False)
+        return hits >= self.min_hits
+
+    def store(self, key, chunks):
+        '''
+        Pass ``chunks`` through, writing them to the cache as they go by.
+        The file only becomes visible once the whole snapshot was streamed.
+        '''
+        path = self.path(key)
+        tmp_path = '%s.%s.%s.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        complete = False
+        try:
+            with open(tmp_path, 'wb') as fp:
+                for chunk in chunks:
+                    fp.write(chunk)
+                    yield chunk
+            os.rename(tmp_path, path)
+            complete = True
+        finally:
+            if not complete and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._lock:
+            self._hits.pop(key, None)
+        self.evict()
+
+    def evict(self):
+        '''Remove the least recently used snapshots until under max_size'''
+        files = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            log.info('Evicted snapshot %s (%d bytes)', path, size)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    '''
+    The :class:`SnapshotCache` configured by ``scm.repos.snapshot_cache.*``,
+    or None if no cache directory is set.
+    '''
+    global _cache
+    root = tg.config.get('scm.repos.snapshot_cache.root')
+    if not root:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache.root != root:
+            _cache = SnapshotCache(
+                root,
+                max_size=asint(tg.config.get('scm.repos.snapshot_cache.max_size', 10 * 1024 ** 3)),
+                min_hits=asint(tg.config.get('scm.repos.snapshot_cache.min_hits', 2)))
+        return _cache
+
+
+_file_cache = None
+
+
+def get_file_cache():
+    '''
+    The :class:`SnapshotCache` for GridFS files, configured by
+    ``files.cache.*``, or None if no cache directory is set.
+    '''
+    global _file_cache
+    root = tg.config.get('files.cache.root')
+    if not root:
+        return None
+    with _cache_lock:
+        if _file_cache is None or _file_cache.root != root:
+            _file_cache = SnapshotCache(
+                root,
+                max_size=asint(tg.config.get('files.cache.max_size', 1024 ** 3)),
+                min_hits=asint(tg.config.get('files.cache.min_hits', 2)))
+        return _file_cache
@@ -15,12 +15,18 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import re
+import time
 import shlex
+import logging
+import threading
 
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 import pysolr
 
+log = logging.getLogger(__name__)
+
 escape_rules = {'+': r'\+',
                 '-': r'\-',
                 '&': r'\&',
@@ -56,9 +62,14 @@ def make_solr_from_config(push_servers, query_server=None, **kwargs):
     Make a :class:`Solr <Solr>` instance from config defaults.  Use
     `**kwargs` to override any value
     """
+    commitWithin = config.get('solr.commitWithin')
     solr_kwargs = dict(
-        commit=asbool(config.get('solr.commit', True)),
-        commitWithin=config.get('solr.commitWithin'),
+        # with commitWithin, solr commits on its own schedule
+        commit=asbool(config.get('solr.commit', not commitWithin)),
+        commitWithin=commitWithin,
+        batch_size=asint(config.get('solr.batch_size', 500)),
+        retries=asint(config.get('solr.retries', 3)),
+        retry_backoff=float(config.get('solr.retry_backoff', 1)),
         timeout=int(config.get('solr.long_timeout', 60)),
     )
     solr_kwargs.update(kwargs)
@@ -75,10 +86,18 @@ class Solr(object):
     Also, accepts default values for `commit` and `commitWithin`
     and passes those values through to each `add` and `delete` call,
     unless explicitly overridden.
+
+    Documents given to `add` are sent in chunks of `batch_size` (all at once
+    if 0), to all push servers concurrently.  A chunk which fails with a
+    transient error (connection problem, timeout, or a 5xx response) is sent
+    again up to `retries` times, waiting `retry_backoff` seconds before the
+    first retry and twice as long before each next one.  Totals of what was
+    sent are kept in `stats`.
     """
 
     def __init__(self, push_servers, query_server=None,
-                 commit=True, commitWithin=None, **kw):
+                 commit=True, commitWithin=None,
+                 batch_size=0, retries=0, retry_backoff=1, **kw):
         self.push_pool = [pysolr.Solr(s, **kw) for s in push_servers]
         if query_server:
             self.query_server = pysolr.Solr(query_server, **kw)
@@ -86,35 +105,166 @@ def __init__(self, push_servers, query_server=None,
             self.query_server = self.push_pool[0]
         self._commit = commit
         self.commitWithin = commitWithin
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.stats = SolrStats()
 
-    def add(self, *args, **kw):
+    def add(self, docs, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
         if self.commitWithin and 'commitWithin' not in kw:
             kw['commitWithin'] = self.commitWithin
+        if self.batch_size and isinstance(docs, list):
+            chunks = [docs[i:i + self.batch_size]
+                      for i in range(0, len(docs), self.batch_size)]
+        else:
+            chunks = [docs]
         responses = []
-        for solr in self.push_pool:
-            responses.append(solr.add(*args, **kw))
+        for chunk in chunks:
+            start = time.time()
+            responses.extend(self._push('add', chunk, **kw))
+            elapsed = time.time() - start
+            if isinstance(chunk, list):
+                self.stats.add_batch(len(chunk), elapsed)
+                log.debug('Sent %d docs to solr in %.3fs', len(chunk), elapsed)
         return responses
 
+    def _push(self, method, *args, **kw):
+        """Call `method` on every push server, concurrently if there are several"""
+        if len(self.push_pool) == 1:
+            return [self._call(self.push_pool[0], method, *args, **kw)]
+        results = [None] * len(self.push_pool)
+        errors = []
+
+        def call(i, solr):
+            try:
+                results[i] = self._call(solr, method, *args, **kw)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=call, args=(i, solr))
+                   for i, solr in enumerate(self.push_pool)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def _call(self, solr, method, *args, **kw):
+        delay = self.retry_backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return getattr(solr, method)(*args, **kw)
+            except pysolr.SolrError as e:
+                if attempt == self.retries or not is_transient_error(e):
+                    raise
+                log.warn('Solr %s failed (%s), retrying in %ss', method, e, delay)
+                self.stats.add_retry()
+                time.sleep(delay)
+                delay *= 2
+
     def delete(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.delete(*args, **kw))
-        return responses
+        return self._push('delete', *args, **kw)
 
     def commit(self, *args, **kw):
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.commit(*args, **kw))
-        return responses
+        return self._push('commit', *args, **kw)
 
     def search(self, *args, **kw):
         return self.query_server.search(*args, **kw)
 
 
+def is_transient_error(error):
+    """Is a :class:`pysolr.SolrError` worth retrying?"""
+    match = re.search(r'\(HTTP (\d+)\)', unicode(error))
+    if match:
+        return int(match.group(1)) >= 500
+    # timeouts and connection errors
+    return True
+
+
+class SolrStats(object):
+
+    """Running totals of documents sent to solr by a :class:`Solr`"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.docs = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self.max_batch_seconds = 0.0
+        self.retries = 0
+
+    def add_batch(self, docs, seconds):
+        with self._lock:
+            self.docs += docs
+            self.batches += 1
+            self.seconds += seconds
+            self.max_batch_seconds = max(self.max_batch_seconds, seconds)
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    @property
+    def docs_per_second(self):
+        return self.docs / self.seconds if self.seconds else 0.0
+
+    @property
+    def avg_batch_seconds(self):
+        return self.seconds / self.batches if self.batches else 0.0
+
+    def __str__(self):
+        return ('%d docs in %d batches, %.1f docs/s, %.3fs avg / %.3fs max batch latency, %d retries' % (
+            self.docs, self.batches, self.docs_per_second,
+            self.avg_batch_seconds, self.max_batch_seconds, self.retries))
+
+
+class SolrUpdateBuffer(object):
+
+    """Collects documents and adds them to `solr` once `size` have piled up,
+    so that no more than that many are held in memory at once.
+    """
+
+    def __init__(self, solr, size=None):
+        self.solr = solr
+        if size is None:
+            size = asint(config.get('solr.batch_size', 500))
+        self.size = max(size, 1)
+        self.docs = []
+        self.sent = 0
+        self.seconds = 0.0
+
+    def add(self, doc):
+        self.docs.append(doc)
+        if len(self.docs) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.docs:
+            return
+        docs, self.docs = self.docs, []
+        start = time.time()
+        try:
+            self.solr.add(docs)
+        except Exception:
+            log.error('Error sending %d docs to solr: %s', len(docs),
+                      ', '.join(str(doc.get('id')) for doc in docs))
+            raise
+        self.seconds += time.time() - start
+        self.sent += len(docs)
+
+    @property
+    def docs_per_second(self):
+        return self.sent / self.seconds if self.seconds else 0.0
+
+
 class MockSOLR(object):
 
     class MockHits(list):
@@ -127,9 +277,13 @@ def hits(self):
         def docs(self):
             return self
 
+        facet_queries = {}
+
         @property
         def facets(self):
-            return {'facet_fields': {}}
+            return {'facet_fields': {}, 'facet_queries': self.facet_queries}
+
+    any_of_re = re.compile(r'^\((.*?)\)( OR \(\*:\* -\S+:\[\* TO \*\]\))?$')
 
     def __init__(self):
         self.db = {}
@@ -153,7 +307,7 @@ def search(self, q, fq=None, **kw):
         if fq:
             q_parts += fq
         for part in q_parts:
-            if part == '&&':
+            if part in ('&&', '*:*'):
                 continue
             if ':' in part:
                 field, value = part.split(':', 1)
@@ -164,10 +318,20 @@ def search(self, q, fq=None, **kw):
         for obj in self.db.values():
             for field, value in preds:
                 neg = False
-                if field[0] == '!':
+                if field[0] in '!-':
                     neg = True
                     field = field[1:]
-                if field == 'text' or field.endswith('_t'):
+                any_of = self.any_of_re.match(value)
+                if any_of:
+                    # e.g. field:(a OR b), optionally OR (*:* -field:[* TO *])
+                    if field in obj:
+                        tokens = str(obj[field]).split()
+                        found = bool(set(any_of.group(1).split(' OR ')) & set(tokens))
+                    else:
+                        found = bool(any_of.group(2))
+                    if found == neg:
+                        break
+                elif field == 'text' or field.endswith('_t'):
                     if (value not in str(obj.get(field, ''))) ^ neg:
                         break
                 else:
@@ -175,6 +339,11 @@ def search(self, q, fq=None, **kw):
                         break
             else:
                 result.append(obj)
+        if kw.get('facet.query'):
+            ids = set(obj['id'] for obj in result)
+            result.facet_queries = dict(
+                (query, len([obj for obj in self.search(query) if obj['id'] in ids]))
+                for query in kw['facet.query'])
         return result
 
     def delete(self, *args, **kwargs):
@@ -0,0 +1,168 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+'''
+Index of the static files served by
+:class:`allura.lib.custom_middleware.StaticFilesMiddleware`.
+
+The files under ``allura/public/nf/`` are served at ``<static.script_name>/``,
+and those under ``<module>/nf/<tool>/`` of each tool at
+``<static.script_name>/<tool>/``.  The index is built once, instead of
+searching the tools' packages on each request.  It also knows:
+
+- each file's fingerprint (a hash of its contents).  Fingerprinted URLs like
+  ``js/allura-base.0123456789ab.js`` can be cached forever.
+- the precompressed ``.br`` and ``.gz`` variants next to a file, which are
+  served to clients that accept them.
+'''
+
+import os
+import re
+import logging
+import mimetypes
+import threading
+from hashlib import md5
+
+import pkg_resources
+
+log = logging.getLogger(__name__)
+
+FINGERPRINT_RE = re.compile(r'^(.+)\.([0-9a-f]{12})(\.[^./]+)$')
+
+# preferred first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+class StaticAssetIndex(object):
+
+    def __init__(self, entry_points=()):
+        self.files = {}
+        self.variants = {}
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+        for ep in entry_points:
+            self.add_tool(ep)
+        self.add_tree(pkg_resources.resource_filename('allura', os.path.join('public', 'nf')), '')
+        self.find_variants()
+
+    def add_tool(self, ep):
+        from allura.app import Application
+        name = ep.name.lower()
+        try:
+            cls = ep.load()
+        except Exception:
+            log.exception('Error loading tool %s for its static files', name)
+            return
+        # like Application.has_resource, a tool's own files override its parents'
+        for klass in cls.__mro__:
+            if isinstance(klass, type) and issubclass(klass, Application):
+                self.add_tree(pkg_resources.resource_filename(
+                    klass.__module__, os.path.join('nf', name)), name + '/')
+
+    def add_tree(self, root, prefix):
+        '''Add the files under ``root`` at ``prefix``, unless already added'''
+        if not os.path.isdir(root):
+            return
+        for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+            rel = os.path.relpath(dirpath, root)
+            rel = '' if rel == '.' else rel.replace(os.sep, '/') + '/'
+            for filename in filenames:
+                self.files.setdefault(prefix + rel + filename, os.path.join(dirpath, filename))
+
+    def find_variants(self):
+        self.variants = {}
+        for path, filename in self.files.iteritems():
+            for encoding, ext in ENCODINGS:
+                compressed = filename + ext
+                if self.files.get(path + ext) != compressed:
+                    continue
+                if os.path.getmtime(compressed) < os.path.getmtime(filename):
+                    log.warn('Ignoring %s, it is older than %s', compressed, filename)
+                    continue
+                self.variants.setdefault(path, {})[encoding] = compressed
+
+    def resolve(self, path):
+        '''The indexed path for a request path, which may be fingerprinted,
+        and whether it was fingerprinted with the current contents'''
+        if path in self.files:
+            return path, False
+        match = FINGERPRINT_RE.match(path)
+        if match:
+            base = match.group(1) + match.group(3)
+            if base in self.files:
+                return base, self.fingerprint(base) == match.group(2)
+        return None, False
+
+    def fingerprint(self, path):
+        with self._lock:
+            fp = self._fingerprints.get(path)
+        if fp is None:
+            digest = md5()
+            with open(self.files[path], 'rb') as f:
+                for chunk in iter(lambda: f.read(64 * 1024), ''):
+                    digest.update(chunk)
+            fp = digest.hexdigest()[:12]
+            with self._lock:
+                self._fingerprints[path] = fp
+        return fp
+
+    def fingerprinted(self, path):
+        '''The fingerprinted form of a path, or the path itself if it isn't
+        indexed'''
+        if path not in self.files:
+            return path
+        root, ext = os.path.splitext(path)
+        return '%s.%s%s' % (root, self.fingerprint(path), ext)
+
+    def choose(self, path, accept_encoding=''):
+        '''The file to send for ``path`` and its content encoding, picking a
+        precompressed variant if the client accepts it'''
+        variants = self.variants.get(path)
+        if variants and accept_encoding:
+            accepted = set(e.split(';')[0].strip().lower() for e in accept_encoding.split(','))
+            for encoding, ext in ENCODINGS:
+                if encoding in accepted and encoding in variants:
+                    return variants[encoding], encoding
+        return self.files[path], None
+
+    def content_type(self, path):
+        return mimetypes.guess_type(self.files[path])[0] or 'application/octet-stream'
+
+    def manifest(self):
+        '''Every file with its fingerprinted path and compressed variants, for
+        a front end proxy to serve them directly'''
+        return dict(
+            (path, dict(
+                file=filename,
+                fingerprinted=self.fingerprinted(path),
+                content_type=self.content_type(path),
+                encodings=self.variants.get(path, {})))
+            for path, filename in self.files.iteritems())
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    '''The process-wide :class:`StaticAssetIndex` of all tools' static files'''
+    global _index
+    with _index_lock:
+        if _index is None:
+            from allura.lib import helpers as h
+            _index = StaticAssetIndex(list(h.iter_entry_points('allura')))
+        return _index
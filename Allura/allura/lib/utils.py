@@ -541,8 +541,17 @@ def take_while_true(source):
 
 
 def serve_file(fp, filename, content_type, last_modified=None,
-               cache_expires=None, size=None, embed=True, etag=None):
-    '''Sets the response headers and serves as a wsgi iter'''
+               cache_expires=None, size=None, embed=True, etag=None,
+               accept_ranges=False, block_size=None):
+    '''Sets the response headers and serves as a wsgi iter
+
+    With ``accept_ranges`` (which needs ``size`` and a seekable ``fp``),
+    a single-range ``Range`` request is answered with just that part of
+    the file.  ``fp`` is read ``block_size`` bytes at a time (by default
+    ``files.block_size`` from the config).  It can also be a function
+    opening the file, so that it isn't opened for a request answered
+    without the contents (e.g. 304 Not Modified).
+    '''
     if not etag and filename and last_modified:
         etag = u'{0}?{1}'.format(filename, last_modified).encode('utf-8')
     if etag:
@@ -562,14 +571,40 @@ def serve_file(fp, filename, content_type, last_modified=None,
         pylons.response.headers.add(
             'Content-Disposition',
             'attachment;filename="%s"' % filename.encode('utf-8'))
+    block_size = block_size or asint(tg.config.get('files.block_size', 4096))
+    content_range = None
+    if accept_ranges and size:
+        pylons.response.headers['Accept-Ranges'] = 'bytes'
+        req = tg.request
+        if req.range and req.if_range.match(etag=etag, last_modified=last_modified):
+            content_range = req.range.content_range(size)
+            if content_range is None:
+                raise exc.HTTPRequestRangeNotSatisfiable()
+            pylons.response.status_int = 206
+            pylons.response.content_range = content_range
+            pylons.response.content_length = content_range.stop - content_range.start
+    if callable(fp):
+        fp = fp()
+    if content_range is not None:
+        fp.seek(content_range.start)
+        return file_range_iter(fp, content_range.stop - content_range.start, block_size)
     # http://code.google.com/p/modwsgi/wiki/FileWrapperExtension
-    block_size = 4096
     if 'wsgi.file_wrapper' in tg.request.environ:
         return tg.request.environ['wsgi.file_wrapper'](fp, block_size)
     else:
         return iter(lambda: fp.read(block_size), '')
 
 
+def file_range_iter(fp, length, block_size=4096):
+    '''Iterate over the next ``length`` bytes of ``fp``'''
+    while length > 0:
+        block = fp.read(min(block_size, length))
+        if not block:
+            break
+        length -= len(block)
+        yield block
+
+
 class ForgeHTMLSanitizer(html5lib.sanitizer.HTMLSanitizer):
     # remove some elements from the sanitizer whitelist
     # <form> and <input> could be used for a social engineering attack to construct a form
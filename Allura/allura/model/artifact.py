@@ -23,7 +23,7 @@
 from pylons import tmpl_context as c, app_globals as g
 from pylons import request
 from ming import schema as S
-from ming.orm import state, session
+from ming.orm import state, session, mapper
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
 from ming.orm.declarative import MappedClass
 from ming.utils import LazyProperty
@@ -601,6 +601,91 @@ def commit(self, update_stats=True):
                     self.type_s, self.mod_date, self.project, c.user)
         return ss
 
+    @classmethod
+    def commit_many(cls, artifacts, update_stats=True):
+        '''Like :meth:`commit`, for many artifacts of this class at once.
+
+        The snapshots are inserted together, rather than one by one.
+        Versions already taken, e.g. by a concurrent edit, are looked up in
+        one query and skipped, and a snapshot whose version is taken in
+        between is inserted again with the next free one, as by
+        :meth:`commit`.
+
+        :returns: the new snapshots, in the order of ``artifacts``
+        '''
+        if not artifacts:
+            return []
+        try:
+            ip_address = utils.ip_address(request)
+        except:
+            ip_address = '0.0.0.0'
+        author = dict(
+            id=c.user._id,
+            username=c.user.username,
+            display_name=c.user.get_pref('display_name'),
+            logged_ip=ip_address)
+        history_class = cls.__mongometa__.history_class
+        taken = set(
+            (doc['artifact_id'], doc['version'])
+            for doc in mapper(history_class).collection.m.collection.find(
+                {'$or': [{'artifact_id': a._id, 'version': {'$gt': a.version}}
+                         for a in artifacts]},
+                fields=['artifact_id', 'version']))
+        timestamp = datetime.utcnow()
+        snapshots = []
+        for artifact in artifacts:
+            data = state(artifact).clone()
+            artifact.version += 1
+            while (artifact._id, artifact.version) in taken:
+                log.warning('Skipping existing version %s of %s',
+                            artifact.version, artifact.__class__)
+                artifact.version += 1
+            snapshots.append(history_class(
+                artifact_id=artifact._id,
+                artifact_class='%s.%s' % (
+                    artifact.__class__.__module__,
+                    artifact.__class__.__name__),
+                author=dict(author),
+                data=data,
+                version=artifact.version,
+                timestamp=timestamp))
+            if update_stats:
+                if artifact.version > 1:
+                    g.statsUpdater.modifiedArtifact(
+                        artifact.type_s, artifact.mod_date, artifact.project, c.user)
+                else:
+                    g.statsUpdater.newArtifact(
+                        artifact.type_s, artifact.mod_date, artifact.project, c.user)
+        cls._insert_snapshots(artifacts, snapshots)
+        log.debug('Snapshot %s versions of %s', len(snapshots), cls)
+        return snapshots
+
+    @classmethod
+    def _insert_snapshots(cls, artifacts, snapshots):
+        collection = mapper(cls.__mongometa__.history_class).collection
+        docs = [collection(state(ss).document, skip_from_bson=True) for ss in snapshots]
+        try:
+            collection.m.collection.insert(docs, continue_on_error=True)
+        except pymongo.errors.DuplicateKeyError:
+            inserted = set(doc['_id'] for doc in collection.m.collection.find(
+                {'_id': {'$in': [ss._id for ss in snapshots]}}, fields=['_id']))
+        else:
+            inserted = None
+        for artifact, ss in zip(artifacts, snapshots):
+            if inserted is None or ss._id in inserted:
+                state(ss).status = state(ss).clean
+                continue
+            while True:
+                try:
+                    session(ss).insert_now(ss, state(ss))
+                except pymongo.errors.DuplicateKeyError:
+                    log.warning('Trying to create duplicate version %s of %s',
+                                artifact.version, artifact.__class__)
+                    artifact.version += 1
+                    ss.version = artifact.version
+                else:
+                    break
+
     def get_version(self, n):
         if n < 0:
             n = self.version + n + 1
@@ -15,14 +15,20 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import logging
+
+import PIL
 from pylons import tmpl_context as c
-from ming.orm import FieldProperty
+from ming.orm import FieldProperty, session, state
 from ming import schema as S
 
 from allura.lib import helpers as h
+from allura.lib import utils
 
 from .session import project_orm_session
-from .filesystem import File
+from .filesystem import File, async_thumbnails
+
+log = logging.getLogger(__name__)
 
 
 class BaseAttachment(File):
@@ -65,6 +71,8 @@ def save_attachment(cls, filename, fp, content_type=None, **kwargs):
         thumbnail_meta.update(kwargs)
         original_meta = dict(type="attachment", app_config_id=c.app.config._id)
         original_meta.update(kwargs)
+        if async_thumbnails():
+            return cls._save_attachment_async(filename, fp, content_type, original_meta)
         # Try to save as image, with thumbnail
         orig, thumbnail = cls.save_image(
             filename, fp,
@@ -74,12 +82,72 @@ def save_attachment(cls, filename, fp, content_type=None, **kwargs):
             save_original=True,
             original_meta=original_meta)
         if orig is not None:
+            orig.set_sha256()
+            orig.share_identical_file()
             return orig, thumbnail
         else:
             # No, generic attachment
             # stream may have been partially consumed in a failed save_image
             # attempt
             fp.seek(0)
-            return cls.from_stream(
+            orig = cls.from_stream(
                 filename, fp, content_type=content_type,
                 **original_meta)
+            orig.share_identical_file()
+            return orig
+
+    @classmethod
+    def _save_attachment_async(cls, filename, fp, content_type, original_meta):
+        '''Save the attachment as is, and queue a task to make the thumbnail
+        of an image'''
+        from allura.tasks import thumbnail_tasks
+        if content_type is None:
+            content_type = utils.guess_mime_type(filename)
+        orig = cls.from_stream(filename, fp, content_type=content_type, **original_meta)
+        orig.share_identical_file()
+        if not orig.is_image():
+            return orig
+        # the task may run before the end of the request
+        session(orig).flush(orig)
+        thumbnail_tasks.attachment_thumbnail.post(
+            '%s.%s' % (cls.__module__, cls.__name__), orig._id)
+        return orig, None
+
+    def thumbnail_query(self):
+        '''Query for the thumbnail of this attachment, which has the same
+        metadata except for its type'''
+        doc = dict(state(self).document)
+        for field in ('_id', 'file_id', 'sha256'):
+            doc.pop(field, None)
+        doc['type'] = 'thumbnail'
+        return doc
+
+    def make_thumbnail(self):
+        '''
+        Make the thumbnail of this (image) attachment, unless it exists.  An
+        identical image which already has a thumbnail shares it.
+        '''
+        cls = self.__class__
+        query = self.thumbnail_query()
+        thumbnail = cls.query.find(query).first()
+        if thumbnail is not None:
+            return thumbnail
+        meta = dict(query)
+        del meta['filename'], meta['content_type']
+        # attachments sharing this one's file (see share_identical_file) are
+        # the same image
+        twins = cls.query.find({
+            'type': 'attachment', 'file_id': self.file_id, '_id': {'$ne': self._id}}).limit(10)
+        for twin in twins:
+            twin_thumbnail = cls.query.find(twin.thumbnail_query()).first()
+            if twin_thumbnail is not None and cls._share_file(twin_thumbnail.file_id):
+                return cls(filename=self.filename, content_type=twin_thumbnail.content_type,
+                           file_id=twin_thumbnail.file_id, **meta)
+        try:
+            image = PIL.Image.open(self.rfile())
+        except IOError as e:
+            log.error('Error opening image %s %s', self.filename, e)
+            return None
+        return cls.save_thumbnail(self.filename, image, self.content_type,
+                                  thumbnail_size=self.thumbnail_size,
+                                  thumbnail_meta=meta, square=True)
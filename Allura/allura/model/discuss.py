@@ -161,6 +161,10 @@ class __mongometa__:
     first_post = RelationProperty('Post', via='first_post_id')
     ref = RelationProperty('ArtifactReference')
 
+    # the 'ok' posts in chronological order, when they were loaded together
+    # with those of other threads (see Application.prefetch_for_export)
+    prefetched_posts = None
+
     def should_update_index(self, old_doc, new_doc):
         """Skip index update if only `num_views` has changed.
 
@@ -201,10 +205,15 @@ def __json__(self, limit=None, page=None, is_export=False):
                         timestamp=p.timestamp,
                         last_edited=p.last_edit_date,
                         attachments=self.attachment_for_export(p) if is_export else self.attachments_for_json(p))
-                   for p in self.query_posts(status='ok', style='chronological', limit=limit, page=page)
+                   for p in self.chronological_posts(limit, page)
                    ]
         )
 
+    def chronological_posts(self, limit=None, page=None):
+        if self.prefetched_posts is not None and limit is None:
+            return self.prefetched_posts
+        return self.query_posts(status='ok', style='chronological', limit=limit, page=page)
+
     @property
     def activity_name(self):
         return 'thread %s' % self.subject
@@ -723,9 +732,19 @@ def reply_subject(self):
             return 'Re: ' + (self.subject or '(no subject)')
 
     def delete(self):
+        shown = self.status == 'ok' and not self.deleted
         self.deleted = True
         session(self).flush(self)
         self.thread.update_stats()
+        if shown:
+            self._call_artifact_hook('post_removed')
+
+    def _call_artifact_hook(self, name):
+        '''Call e.g. ``post_approved(post)`` of the thread's artifact, if it
+        has one, for it to keep its own counts of (shown) posts'''
+        artifact = self.thread.artifact or self.thread
+        if hasattr(artifact, name):
+            getattr(artifact, name)(self)
 
     def approve(self, file_info=None, notify=True, notification_text=None):
         if self.status == 'ok':
@@ -752,6 +771,7 @@ def approve(self, file_info=None, notify=True, notification_text=None):
         self.thread.update_stats()
         if hasattr(artifact, 'update_stats'):
             artifact.update_stats()
+        self._call_artifact_hook('post_approved')
         if self.text and not self.is_meta:
             g.director.create_activity(author, 'posted', self, target=artifact,
                                        related_nodes=[self.app_config.project],
@@ -795,17 +815,23 @@ def notify(self, file_info=None, notification_text=None):
                 n.send_simple(artifact.monitoring_email)
 
     def spam(self, submit_spam_feedback=True):
+        shown = self.status == 'ok' and not self.deleted
         self.status = 'spam'
         if submit_spam_feedback:
             g.spam_checker.submit_spam(self.text, artifact=self, user=self.author())
         session(self).flush(self)
         self.thread.update_stats()
+        if shown:
+            self._call_artifact_hook('post_removed')
 
     def undo(self, prev_status):
         if prev_status in ('ok', 'pending'):
+            shown = self.status == 'ok' and not self.deleted
             self.status = prev_status
             session(self).flush(self)
             self.thread.update_stats()
+            if not shown and self.status == 'ok' and not self.deleted:
+                self._call_artifact_hook('post_approved')
 
 
 class DiscussionAttachment(BaseAttachment):
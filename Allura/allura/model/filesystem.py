@@ -18,16 +18,22 @@
 import os
 from cStringIO import StringIO
 import logging
+import hashlib
+import threading
+from collections import OrderedDict
 
 import PIL
 from gridfs import GridFS
+import pylons
+from tg import config
+from paste.deploy.converters import asint, asbool
 
 from ming import schema
 from ming.orm import session, FieldProperty
 from ming.orm.declarative import MappedClass
 
 from .session import project_orm_session
-from allura.lib import utils
+from allura.lib import utils, snapshot_cache
 
 log = logging.getLogger(__name__)
 
@@ -40,17 +46,32 @@
     'image/gif'])
 
 
+# md5, length and chunk size of GridFS files by id, as File.serve needs them
+# even for files in the disk cache (the contents of a GridFS file never change)
+_gridfs_info = OrderedDict()
+_gridfs_info_lock = threading.Lock()
+GRIDFS_INFO_SIZE = 10000
+
+
+def async_thumbnails():
+    '''Whether thumbnails are made by background tasks (see
+    :mod:`allura.tasks.thumbnail_tasks`) instead of during the upload'''
+    return asbool(config.get('thumbnails.async', False))
+
+
 class File(MappedClass):
 
     class __mongometa__:
         session = project_orm_session
         name = 'fs'
-        indexes = ['filename']
+        indexes = ['filename', 'sha256', 'file_id']
 
     _id = FieldProperty(schema.ObjectId)
     file_id = FieldProperty(schema.ObjectId)
     filename = FieldProperty(str, if_missing='unknown')
     content_type = FieldProperty(str)
+    # hex sha256 of the contents, see share_identical_file
+    sha256 = FieldProperty(str, if_missing=None)
 
     def __init__(self, **kw):
         super(File, self).__init__(**kw)
@@ -82,12 +103,15 @@ def remove(cls, spec):
     @classmethod
     def from_stream(cls, filename, stream, **kw):
         obj = cls(filename=filename, **kw)
+        digest = hashlib.sha256()
         with obj.wfile() as fp_w:
             while True:
                 s = stream.read()
                 if not s:
                     break
+                digest.update(s)
                 fp_w.write(s)
+        obj.sha256 = digest.hexdigest()
         return obj
 
     @classmethod
@@ -101,9 +125,82 @@ def from_data(cls, filename, data, **kw):
         return cls.from_stream(filename, StringIO(data), **kw)
 
     def delete(self):
-        self._fs().delete(self.file_id)
+        if self._release_file():
+            self._fs().delete(self.file_id)
         super(File, self).delete()
 
+    @classmethod
+    def _fs_files(cls):
+        return session(cls).impl.db[cls._root_collection() + '.files']
+
+    def _release_file(self):
+        '''
+        Stop using this document's GridFS file.  True if no other document
+        uses it, in which case it is marked so that nothing starts sharing it
+        and the caller deletes it.
+
+        The GridFS files doc counts the other documents using it in
+        ``shared``; these atomic updates, rather than a search for other
+        documents, keep a concurrent :meth:`share_identical_file` from
+        picking a file that is about to be deleted.
+        '''
+        if self.file_id is None:
+            return False
+        files = self._fs_files()
+        while True:
+            if files.find_and_modify({'_id': self.file_id, 'shared': {'$gt': 0}},
+                                     {'$inc': {'shared': -1}}):
+                return False
+            if files.find_and_modify({'_id': self.file_id,
+                                      '$or': [{'shared': {'$exists': False}}, {'shared': {'$lte': 0}}]},
+                                     {'$set': {'deleting': True}}):
+                return True
+            if files.find_one({'_id': self.file_id}, fields=['_id']) is None:
+                return False
+
+    @classmethod
+    def _share_file(cls, file_id):
+        '''Count one more document using the GridFS file ``file_id``.  False
+        if it is (being) deleted, and can't be used.'''
+        result = cls._fs_files().update({'_id': file_id, 'deleting': {'$ne': True}},
+                                        {'$inc': {'shared': 1}})
+        return bool(result and result['n'])
+
+    def set_sha256(self):
+        '''Set :attr:`sha256` from the stored contents, for files not saved
+        with :meth:`from_stream`'''
+        digest = hashlib.sha256()
+        fp = self.rfile()
+        while True:
+            s = fp.read(fp.chunk_size)
+            if not s:
+                break
+            digest.update(s)
+        self.sha256 = digest.hexdigest()
+
+    def share_identical_file(self):
+        '''
+        If identical contents (by sha256 and length) were stored before, use
+        that GridFS file instead of this one's own copy.
+        '''
+        if not self.sha256:
+            return False
+        files = self._fs_files()
+        own = files.find_one({'_id': self.file_id}, fields=['length'])
+        if own is None:
+            return False
+        coll = session(self).impl.db[self._root_collection()]
+        others = coll.find({'sha256': self.sha256, 'file_id': {'$nin': [self.file_id, None]}},
+                           fields=['file_id']).limit(10)
+        for other in others:
+            other_file = files.find_one({'_id': other['file_id'], 'length': own['length']},
+                                        fields=['_id'])
+            if other_file is not None and self._share_file(other['file_id']):
+                own_file_id, self.file_id = self.file_id, other['file_id']
+                self._fs().delete(own_file_id)
+                return True
+        return False
+
     def rfile(self):
         return self._fs().get(self.file_id)
 
@@ -115,12 +212,49 @@ def wfile(self):
         return fp
 
     def serve(self, embed=True):
-        '''Sets the response headers and serves as a wsgi iter'''
-        gridfs_file = self.rfile()
-        return utils.serve_file(gridfs_file, self.filename, self.content_type,
-                                last_modified=self._id.generation_time,
-                                size=gridfs_file.length,
-                                embed=embed)
+        '''Sets the response headers and serves as a wsgi iter
+
+        Range requests are supported, and the ETag is the file's md5.  The
+        file is read a whole GridFS chunk at a time, unless
+        ``files.block_size`` is set.  Popular files are kept in the local
+        file cache (if configured), and served from there.  The GridFS file
+        is only looked up once per process, and the cached file only opened
+        for a response with the contents.
+        '''
+        cache = snapshot_cache.get_file_cache()
+        key = cache.key(str(self.file_id), self.filename) if cache else None
+        cached_path = cache.get(key) if cache else None
+        gridfs_file = None
+        with _gridfs_info_lock:
+            info = _gridfs_info.pop(self.file_id, None)
+            if info is not None:
+                _gridfs_info[self.file_id] = info
+        if info is None:
+            gridfs_file = self.rfile()
+            info = (gridfs_file.md5, gridfs_file.length, gridfs_file.chunk_size)
+            with _gridfs_info_lock:
+                _gridfs_info[self.file_id] = info
+                while len(_gridfs_info) > GRIDFS_INFO_SIZE:
+                    _gridfs_info.popitem(last=False)
+        md5, length, chunk_size = info
+        # opened only once it's known that the contents are needed
+        if cached_path:
+            fp = lambda: open(cached_path, 'rb')
+        elif gridfs_file is not None:
+            fp = lambda: gridfs_file
+        else:
+            fp = self.rfile
+        app_iter = utils.serve_file(
+            fp, self.filename, self.content_type,
+            last_modified=self._id.generation_time,
+            size=length,
+            embed=embed,
+            etag=md5,
+            accept_ranges=True,
+            block_size=asint(config.get('files.block_size', chunk_size)))
+        if cache and not cached_path and pylons.response.status_int == 200 and cache.should_store(key):
+            app_iter = cache.store(key, app_iter)
+        return app_iter
 
     @classmethod
     def save_thumbnail(cls, filename, image,
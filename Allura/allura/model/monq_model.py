@@ -16,27 +16,33 @@
 #       under the License.
 
 import sys
+import json
 import time
+import hashlib
 import traceback
 import logging
+import threading
 from datetime import datetime, timedelta
 
 import pymongo
 from pylons import tmpl_context as c, app_globals as g
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint, aslist
 
 import ming
 from ming.utils import LazyProperty
 from ming import schema as S
-from ming.orm import session, FieldProperty
+from ming.orm import session, mapper, FieldProperty
 from ming.orm.declarative import MappedClass
 
 from allura.lib.helpers import log_output, null_contextmanager
-from .session import task_orm_session
+from .session import task_orm_session, task_doc_session
 
 log = logging.getLogger(__name__)
 
+# the task being run in this thread, see MonQTask.report_progress
+_running = threading.local()
+
 
 class MonQTask(MappedClass):
 
@@ -53,11 +59,15 @@ class MonQTask(MappedClass):
         - time_start - time taskd began working on the task
         - time_stop - time taskd stopped working on the task
         - task_name - full dotted name of the task function to run
+        - lane - name of the lane the task was queued in, None for the default lane
+        - coalesce_key - identifies tasks that later posts may be merged into (see post())
+        - coalesce_size - number of items (or posts) coalesced into the task so far
         - process - identifier for which taskd process is working on the task
         - context - values used to set c.project, c.app, c.user for the task
         - args - ``*args`` to be sent to the task function
         - kwargs - ``**kwargs`` to be sent to the task function
         - result - if the task is complete, the return value. If in error, the traceback.
+        - progress - how far a long task has got, as reported by the task itself
     '''
     states = ('ready', 'busy', 'error', 'complete', 'skipped')
     result_types = ('keep', 'forget')
@@ -73,10 +83,21 @@ class __mongometa__:
                 ('priority', ming.DESCENDING),
                 ('time_queue', ming.ASCENDING)
             ],
+            [
+                # used in MonQTask.get() method with lanes
+                ('state', ming.ASCENDING),
+                ('lane', ming.ASCENDING),
+                ('priority', ming.DESCENDING),
+                ('time_queue', ming.ASCENDING)
+            ],
             [
                 # used by repo tarball status check, etc
                 'state', 'task_name', 'time_queue'
             ],
+            [
+                # used to find a task to coalesce with in MonQTask.post()
+                'coalesce_key', 'state'
+            ],
         ]
 
     _id = FieldProperty(S.ObjectId)
@@ -88,6 +109,9 @@ class __mongometa__:
     time_stop = FieldProperty(datetime, if_missing=None)
 
     task_name = FieldProperty(str)
+    lane = FieldProperty(str, if_missing=None)
+    coalesce_key = FieldProperty(str, if_missing=None)
+    coalesce_size = FieldProperty(int, if_missing=0)
     process = FieldProperty(str)
     context = FieldProperty(dict(
         project_id=S.ObjectId,
@@ -97,6 +121,7 @@ class __mongometa__:
     args = FieldProperty([])
     kwargs = FieldProperty({None: None})
     result = FieldProperty(None, if_missing=None)
+    progress = FieldProperty(str, if_missing=None)
 
     def __repr__(self):
         from allura import model as M
@@ -135,8 +160,27 @@ def post(cls,
              kwargs=None,
              result_type='forget',
              priority=10,
-             delay=0):
-        '''Create a new task object based on the current context.'''
+             delay=0,
+             lane=None,
+             coalesce=None):
+        '''Create a new task object based on the current context.
+
+        Tasks go to the given ``lane``, or else the one configured for their
+        name by :meth:`lane_for`.
+
+        ``coalesce`` lets a post be merged into a task which is still waiting
+        in the queue, for the same function and context:
+
+        - ``'same'``: if a task with the same arguments is waiting, return it
+          instead of creating another one.
+        - ``'union'``: the first argument is a list; if a task with the same
+          other arguments is waiting and has room for them (up to
+          ``monq.coalesce.max_batch`` items), the items are added to it.
+
+        Coalescable tasks wait in the queue for ``monq.coalesce.max_delay``
+        seconds (or ``delay``, if longer) to give later posts the chance to
+        be merged in.
+        '''
         if args is None:
             args = ()
         if kwargs is None:
@@ -144,24 +188,28 @@ def post(cls,
         task_name = '%s.%s' % (
             function.__module__,
             function.__name__)
-        context = dict(
-            project_id=None,
-            app_config_id=None,
-            user_id=None,
-            notifications_disabled=False)
-        if getattr(c, 'project', None):
-            context['project_id'] = c.project._id
-            context[
-                'notifications_disabled'] = c.project.notifications_disabled
-        if getattr(c, 'app', None):
-            context['app_config_id'] = c.app.config._id
-        if getattr(c, 'user', None):
-            context['user_id'] = c.user._id
+        if lane is None:
+            lane = cls.lane_for(task_name)
+        context = cls._context()
+        coalesce_key = None
+        coalesce_size = 0
+        if coalesce == 'union' and not args:
+            coalesce = None
+        if coalesce:
+            coalesce_key = cls._coalesce_key(task_name, context, args, kwargs, coalesce)
+            obj = cls._coalesce(coalesce_key, coalesce, args)
+            if obj is not None:
+                return obj
+            coalesce_size = len(args[0]) if coalesce == 'union' else 1
+            delay = max(delay, asint(config.get('monq.coalesce.max_delay', 0)))
         obj = cls(
             state='ready',
             priority=priority,
             result_type=result_type,
             task_name=task_name,
+            lane=lane,
+            coalesce_key=coalesce_key,
+            coalesce_size=coalesce_size,
             args=args,
             kwargs=kwargs,
             process=None,
@@ -169,45 +217,215 @@ def post(cls,
             context=context,
             time_queue=datetime.utcnow() + timedelta(seconds=delay))
         session(obj).flush(obj)
+        if not delay and TaskWakeup.enabled():
+            TaskWakeup.instance().notify(task_name, lane)
         return obj
 
     @classmethod
-    def get(cls, process='worker', state='ready', waitfunc=None, only=None):
+    def post_many(cls,
+                  function,
+                  calls,
+                  result_type='forget',
+                  priority=10,
+                  lane=None):
+        '''Create a task for each ``(args, kwargs)`` in ``calls``, with a
+        single insert.  Coalescing and delays are not supported.
+
+        Returns the ids of the new tasks.
+        '''
+        task_name = '%s.%s' % (
+            function.__module__,
+            function.__name__)
+        if lane is None:
+            lane = cls.lane_for(task_name)
+        context = cls._context()
+        collection = mapper(cls).collection
+        now = datetime.utcnow()
+        docs = [collection.make(dict(
+            state='ready',
+            priority=priority,
+            result_type=result_type,
+            task_name=task_name,
+            lane=lane,
+            args=list(args or ()),
+            kwargs=kwargs or {},
+            process=None,
+            result=None,
+            context=context,
+            time_queue=now)) for args, kwargs in calls]
+        if not docs:
+            return []
+        collection.m.collection.insert(docs)
+        if TaskWakeup.enabled():
+            TaskWakeup.instance().notify(task_name, lane)
+        return [doc['_id'] for doc in docs]
+
+    @classmethod
+    def _context(cls):
+        context = dict(
+            project_id=None,
+            app_config_id=None,
+            user_id=None,
+            notifications_disabled=False)
+        if getattr(c, 'project', None):
+            context['project_id'] = c.project._id
+            context[
+                'notifications_disabled'] = c.project.notifications_disabled
+        if getattr(c, 'app', None):
+            context['app_config_id'] = c.app.config._id
+        if getattr(c, 'user', None):
+            context['user_id'] = c.user._id
+        return context
+
+    @classmethod
+    def _coalesce_key(cls, task_name, context, args, kwargs, coalesce):
+        if coalesce == 'union':
+            args = args[1:]
+        key = json.dumps([task_name, context, args, kwargs],
+                         sort_keys=True, default=str)
+        return hashlib.sha1(key).hexdigest()
+
+    @classmethod
+    def _coalesce(cls, coalesce_key, coalesce, args):
+        '''Merge a post into a waiting task, returning that task, or None'''
+        query = dict(coalesce_key=coalesce_key, state='ready')
+        if coalesce != 'union':
+            return cls._find_and_modify(query, {'$inc': dict(coalesce_size=1)})
+        items = list(args[0])
+        max_batch = asint(config.get('monq.coalesce.max_batch', 1000))
+        if len(items) > max_batch:
+            return None
+        query['coalesce_size'] = {'$lte': max_batch - len(items)}
+        # the list is rewritten as a whole, guarded by coalesce_size (which
+        # only grows) so that concurrent merges into the same task can't
+        # overwrite each other; a lost race is retried
+        for attempt in range(3):
+            doc = cls.query.get(**query)
+            if doc is None:
+                return None
+            merged = list(doc.args[0])
+            seen = set(merged)
+            for item in items:
+                if item not in seen:
+                    seen.add(item)
+                    merged.append(item)
+            if len(merged) == doc.coalesce_size:
+                return doc
+            obj = cls._find_and_modify(
+                dict(_id=doc._id, state='ready', coalesce_size=doc.coalesce_size),
+                {'$set': dict(args=[merged] + list(doc.args[1:]),
+                              coalesce_size=len(merged))})
+            if obj is not None:
+                return obj
+        return None
+
+    @classmethod
+    def _find_and_modify(cls, query, update):
+        try:
+            return cls.query.find_and_modify(query=query, update=update, new=True)
+        except pymongo.errors.OperationFailure, exc:
+            if 'No matching object found' not in exc.args[0]:
+                raise
+        return None
+
+    @classmethod
+    def lane_for(cls, task_name):
+        '''The lane configured for a task name, or None for the default lane.
+
+        Lanes are configured with ``monq.lane.<name>`` settings listing task
+        names or module prefixes, e.g. ``monq.lane.bulk = allura.tasks.index_tasks``.
+        The longest matching prefix wins.
+        '''
+        best, best_len = None, 0
+        for key, value in config.iteritems():
+            if not key.startswith('monq.lane.'):
+                continue
+            for prefix in aslist(value, ','):
+                if len(prefix) > best_len and (
+                        task_name == prefix or task_name.startswith(prefix + '.')):
+                    best, best_len = key[len('monq.lane.'):], len(prefix)
+        return best
+
+    @classmethod
+    def get(cls, process='worker', state='ready', waitfunc=None, only=None, lanes=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
         current process.  If no task is available and waitfunc is supplied, call
         the waitfunc before trying to get the task again.  If waitfunc is None
         and no tasks are available, return None.  If waitfunc raises a
-        StopIteration, stop waiting for a task
+        StopIteration, stop waiting for a task.  ``only`` and ``lanes``
+        restrict the task names and lanes (None being the default lane) to
+        pick from.
+        '''
+        task, _ = cls.claim(process, 1, state, waitfunc, only, lanes)
+        return task
+
+    @classmethod
+    def claim(cls, process='worker', limit=1, state='ready', waitfunc=None, only=None, lanes=None):
+        '''Like :meth:`get`, but lock up to ``limit`` tasks at once, in a
+        single update.  Returns ``(task, next_tasks)``, the tasks after the
+        first to be run in order by the same process.
+
+        The batch is leased to ``process`` from the time of the claim
+        (``time_start``), so :meth:`timeout_tasks` makes the tasks ready
+        again if the process dies before getting to them.  A process which
+        stops early should hand them back with :meth:`release`.
         '''
         sort = [
             ('priority', ming.DESCENDING),
             ('time_queue', ming.ASCENDING)]
         while True:
-            try:
-                query = dict(state=state)
-                query['time_queue'] = {'$lte': datetime.utcnow()}
-                if only:
-                    query['task_name'] = {'$in': only}
-                obj = cls.query.find_and_modify(
-                    query=query,
-                    update={
-                        '$set': dict(
-                            state='busy',
-                            process=process)
-                    },
-                    new=True,
-                    sort=sort)
-                if obj is not None:
-                    return obj
-            except pymongo.errors.OperationFailure, exc:
-                if 'No matching object found' not in exc.args[0]:
-                    raise
+            query = dict(state=state)
+            query['time_queue'] = {'$lte': datetime.utcnow()}
+            if only:
+                query['task_name'] = {'$in': only}
+            if lanes:
+                query['lane'] = {'$in': list(lanes)}
+            update = {'$set': dict(state='busy', process=process)}
+            if limit <= 1:
+                try:
+                    obj = cls.query.find_and_modify(
+                        query=query, update=update, new=True, sort=sort)
+                    if obj is not None:
+                        return obj, []
+                except pymongo.errors.OperationFailure, exc:
+                    if 'No matching object found' not in exc.args[0]:
+                        raise
+            else:
+                collection = mapper(cls).collection.m.collection
+                ids = [doc['_id'] for doc in collection.find(
+                    query, fields=['_id'], sort=sort, limit=limit)]
+                if ids:
+                    # to the millisecond, as stored by mongo
+                    now = datetime.utcnow()
+                    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+                    collection.update(
+                        {'_id': {'$in': ids}, 'state': state},
+                        {'$set': dict(state='busy', process=process, time_start=now)},
+                        multi=True)
+                    # another worker may have claimed some of them in between
+                    tasks = cls.query.find({
+                        '_id': {'$in': ids},
+                        'state': 'busy',
+                        'process': process,
+                        'time_start': now}).sort(sort).all()
+                    if tasks:
+                        return tasks[0], tasks[1:]
+                    continue
             if waitfunc is None:
-                return None
+                return None, []
             try:
                 waitfunc()
             except StopIteration:
-                return None
+                return None, []
+
+    @classmethod
+    def release(cls, tasks):
+        '''Make tasks claimed by :meth:`claim` but not run ready again'''
+        for task in tasks:
+            cls.query.update(
+                dict(_id=task._id, state='busy', process=task.process,
+                     time_start=task.time_start),
+                {'$set': dict(state='ready', process=None, time_start=None)})
 
     @classmethod
     def timeout_tasks(cls, older_than):
@@ -256,8 +474,12 @@ def __call__(self, restore_context=True, nocapture=False):
                 if app_config:
                     c.app = c.project.app_instance(app_config)
             c.user = M.User.query.get(_id=self.context.user_id)
-            with null_contextmanager() if nocapture else log_output(log):
-                self.result = func(*self.args, **self.kwargs)
+            old_task, _running.task = getattr(_running, 'task', None), self
+            try:
+                with null_contextmanager() if nocapture else log_output(log):
+                    self.result = func(*self.args, **self.kwargs)
+            finally:
+                _running.task = old_task
             self.state = 'complete'
             return self.result
         except Exception, exc:
@@ -279,9 +501,26 @@ def __call__(self, restore_context=True, nocapture=False):
                 c.app = old_capp
                 c.user = old_cuser
 
-    def join(self, poll_interval=0.1):
-        '''Wait until this task is either complete or errors out, then return the result.'''
+    @classmethod
+    def report_progress(cls, progress):
+        '''Save how far the task running in this thread has got, e.g.
+        "500/5000 tickets", on the task.  Only logged outside of a task.'''
+        task = getattr(_running, 'task', None)
+        log.info('Progress of %r: %s', task, progress)
+        if task is not None:
+            task.progress = progress
+            session(task).flush(task)
+
+    def join(self, poll_interval=0.1, timeout=None):
+        '''Wait until this task is either complete or errors out, then return the result.
+
+        With a ``timeout`` (in seconds), give up waiting after it, leaving the
+        task's state something other than 'complete' or 'error'.
+        '''
+        deadline = time.time() + timeout if timeout is not None else None
         while self.state not in ('complete', 'error'):
+            if deadline is not None and time.time() >= deadline:
+                break
             time.sleep(poll_interval)
             self.query.find(dict(_id=self._id), refresh=True).first()
         return self.result
@@ -291,3 +530,92 @@ def list(cls, state='ready'):
         '''Print all tasks of a certain status to sys.stdout.  Used for debugging.'''
         for t in cls.query.find(dict(state=state)):
             sys.stdout.write('%r\n' % t)
+
+
+class TaskWakeup(object):
+
+    '''
+    Lets idle taskd workers wait for new tasks instead of sleeping for
+    ``monq.poll_interval``.  :meth:`MonQTask.post` adds a small document to a
+    capped collection, which waiting workers follow with a tailable cursor.
+    Enabled with ``monq.wakeup = true``.
+
+    A worker still polls for tasks every ``monq.poll_interval`` seconds, so
+    a missed notification only delays a task, it never loses one.
+    '''
+
+    collection_name = 'monq_wakeup'
+    _instance = None
+
+    def __init__(self, db, size=1024 * 1024, max_docs=1000):
+        self.db = db
+        self.size = size
+        self.max_docs = max_docs
+        self._cursor = None
+
+    @classmethod
+    def enabled(cls):
+        return asbool(config.get('monq.wakeup', False))
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls(task_doc_session.db)
+        return cls._instance
+
+    @LazyProperty
+    def collection(self):
+        if self.collection_name not in self.db.collection_names():
+            try:
+                self.db.create_collection(
+                    self.collection_name, capped=True,
+                    size=self.size, max=self.max_docs)
+                # a tailable cursor on an empty collection is closed right away
+                self.db[self.collection_name].insert(dict(task_name=None, lane=None))
+            except pymongo.errors.CollectionInvalid:
+                pass  # created by another process in the meantime
+        return self.db[self.collection_name]
+
+    def notify(self, task_name, lane=None):
+        try:
+            self.collection.insert(dict(task_name=task_name, lane=lane), w=0)
+        except pymongo.errors.PyMongoError:
+            log.warn('Could not notify taskd workers about %s', task_name, exc_info=True)
+
+    def _open_cursor(self):
+        cursor = self.collection.find(tailable=True, await_data=True)
+        # skip notifications sent before we started listening
+        for doc in cursor:
+            pass
+        return cursor
+
+    def wait(self, timeout, only=None, lanes=None):
+        '''
+        Block until a task matching ``only`` and ``lanes`` (as for
+        :meth:`MonQTask.get`) is posted, or ``timeout`` seconds pass.
+        Returns True if woken up by a new task.
+        '''
+        deadline = time.time() + timeout
+        try:
+            while time.time() < deadline:
+                if self._cursor is None or not self._cursor.alive:
+                    self._cursor = self._open_cursor()
+                    if not self._cursor.alive:
+                        break
+                try:
+                    # with await_data the server holds this open for a while
+                    doc = self._cursor.next()
+                except StopIteration:
+                    continue
+                if only and doc.get('task_name') not in only:
+                    continue
+                if lanes and doc.get('lane') not in lanes:
+                    continue
+                return True
+        except pymongo.errors.PyMongoError:
+            log.warn('Error waiting for new tasks, falling back to polling', exc_info=True)
+            self._cursor = None
+        remaining = deadline - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        return False
@@ -34,6 +34,7 @@
 
 '''
 
+import time
 import logging
 from bson import ObjectId
 from datetime import datetime, timedelta
@@ -43,15 +44,14 @@
 from tg import config
 import pymongo
 import jinja2
-from paste.deploy.converters import asbool, aslist
+from paste.deploy.converters import asbool, asint, aslist
 
 from ming import schema as S
-from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty, session
+from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty, session, mapper
 from ming.orm.declarative import MappedClass
 
 from allura.lib import helpers as h
 from allura.lib import security
-from allura.lib.utils import take_while_true
 import allura.tasks.mail_tasks
 
 from .session import main_orm_session
@@ -424,6 +424,9 @@ class __mongometa__:
     # a list of notification _id values
     queue = FieldProperty([str])
     queue_empty = FieldProperty(bool)
+    # set when the queue is emptied by fire_ready(), to tell which mailboxes
+    # of a batch it emptied
+    drain_id = FieldProperty(S.ObjectId, if_missing=None)
 
     project = RelationProperty('Project')
     app_config = RelationProperty('AppConfig')
@@ -543,24 +546,27 @@ def deliver(cls, nid, artifact_index_ids, topic):
             'artifact_index_id': {'$in': artifact_index_ids},
             'topic': {'$in': [None, topic]}
         }
-        mboxes = cls.query.find(d).all()
-        log.debug('Delivering notification %s to mailboxes [%s]', nid, ', '.join([str(m._id) for m in mboxes]))
-        for mbox in mboxes:
-            try:
-                mbox.query.update(
-                    # _id is automatically specified by ming's "query", so this matches the current mbox
-                    {'$push': dict(queue=nid),
-                     '$set': dict(last_modified=datetime.utcnow(),
-                                  queue_empty=False),
-                     })
-                # Make sure the mbox doesn't stick around to be flush()ed
-                session(mbox).expunge(mbox)
-            except:
-                # log error but try to keep processing, lest all the other eligible
-                # mboxes for this notification get skipped and lost forever
-                log.exception(
-                    'Error adding notification: %s for artifact %s on project %s to user %s',
-                    nid, artifact_index_ids, c.project._id, mbox.user_id)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Delivering notification %s to mailboxes [%s]', nid, ', '.join(
+                [str(m['_id']) for m in cls._collection().find(d, fields=['_id'])]))
+        start = time.time()
+        # one multi-update for all mailboxes, rather than one per subscriber
+        result = cls._collection().update(
+            d,
+            {'$push': dict(queue=nid),
+             '$set': dict(last_modified=datetime.utcnow(),
+                          queue_empty=False),
+             },
+            multi=True)
+        elapsed = time.time() - start
+        delivered = result.get('n', 0) if result else 0
+        log.info('Delivered notification %s to %d mailboxes in %.3fs (%.1f/s)',
+                 nid, delivered, elapsed, delivered / elapsed if elapsed else 0)
+        return delivered
+
+    @classmethod
+    def _collection(cls):
+        return mapper(cls).collection.m.collection
 
     @classmethod
     def fire_ready(cls):
@@ -580,24 +586,34 @@ def fire_ready(cls):
             type={'$in': ['digest', 'summary']},
             next_scheduled={'$lt': now})
 
-        def find_and_modify_direct_mbox():
-            return cls.query.find_and_modify(
-                query=q_direct,
-                update={'$set': dict(
-                    queue=[],
-                    queue_empty=True,
-                )},
-                new=False)
-
-        for mbox in take_while_true(find_and_modify_direct_mbox):
-            try:
-                mbox.fire(now)
-            except:
-                log.exception(
-                    'Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
-                # re-raise so we don't keep (destructively) trying to process
-                # mboxes
-                raise
+        start = time.time()
+        fired = 0
+        batch_size = asint(config.get('mailbox.fire_batch_size', 100))
+        while True:
+            candidates, mboxes = cls._drain_direct(q_direct, batch_size)
+            if not candidates:
+                break
+            # load the notifications for the whole batch at once
+            nids = set(nid for mbox in mboxes for nid in mbox.queue)
+            notifications = dict(
+                (n._id, n) for n in Notification.query.find(dict(_id={'$in': list(nids)})))
+            for i, mbox in enumerate(mboxes):
+                try:
+                    mbox.fire(now, notifications)
+                except:
+                    log.exception(
+                        'Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
+                    # the rest of the batch was drained too: queue their
+                    # notifications again for the next run
+                    cls._requeue(mboxes[i + 1:])
+                    # re-raise so we don't keep (destructively) trying to process
+                    # mboxes
+                    raise
+            fired += len(mboxes)
+        if fired:
+            elapsed = time.time() - start
+            log.info('Fired %d direct mailboxes in %.3fs (%.1f/s)',
+                     fired, elapsed, fired / elapsed if elapsed else 0)
 
         for mbox in cls.query.find(q_digest):
             next_scheduled = now
@@ -617,12 +633,51 @@ def find_and_modify_direct_mbox():
                 new=False)
             mbox.fire(now)
 
-    def fire(self, now):
+    @classmethod
+    def _drain_direct(cls, query, limit):
+        '''Empty the queues of up to ``limit`` mailboxes matching ``query``.
+
+        Each mailbox is only emptied if its queue hasn't changed since it was
+        read, so a notification delivered meanwhile is never lost; such a
+        mailbox is left for the next batch.  Returns the mailboxes read, and
+        those emptied (with the queue they had).
+        '''
+        candidates = cls.query.find(query).limit(limit).all()
+        if not candidates:
+            return [], []
+        for mbox in candidates:
+            session(mbox).expunge(mbox)
+        drain_id = ObjectId()
+        cls._collection().update(
+            {'$or': [dict(_id=mbox._id, queue=list(mbox.queue)) for mbox in candidates]},
+            {'$set': dict(queue=[], queue_empty=True, drain_id=drain_id)},
+            multi=True)
+        drained = set(doc['_id'] for doc in cls._collection().find(
+            dict(drain_id=drain_id), fields=['_id']))
+        return candidates, [mbox for mbox in candidates if mbox._id in drained]
+
+    @classmethod
+    def _requeue(cls, mboxes):
+        '''Put back the queues emptied by :meth:`_drain_direct` of mailboxes
+        that weren't fired'''
+        for mbox in mboxes:
+            cls._collection().update(
+                dict(_id=mbox._id),
+                {'$push': dict(queue={'$each': list(mbox.queue)}),
+                 '$set': dict(queue_empty=False)})
+
+    def fire(self, now, notifications=None):
         '''
         Send all notifications that this mailbox has enqueued.
+
+        ``notifications`` may map notification ids to already loaded
+        notifications, e.g. those of a whole batch of mailboxes.
         '''
-        notifications = Notification.query.find(dict(_id={'$in': self.queue}))
-        notifications = notifications.all()
+        if notifications is None:
+            notifications = Notification.query.find(dict(_id={'$in': self.queue}))
+            notifications = notifications.all()
+        else:
+            notifications = [notifications[nid] for nid in self.queue if nid in notifications]
         if len(notifications) != len(self.queue):
             log.error('Mailbox queue error: Mailbox %s queued [%s], found [%s]', str(
                 self._id), ', '.join(self.queue), ', '.join([n._id for n in notifications]))
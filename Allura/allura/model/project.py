@@ -58,7 +58,7 @@
 from .types import ACL, ACE
 from .monq_model import MonQTask
 
-from filesystem import File
+from filesystem import File, async_thumbnails
 
 log = logging.getLogger(__name__)
 
@@ -370,14 +370,22 @@ def save_icon(self, filename, file_input, content_type=None):
         # store the dimensions so we don't have to read the whole image each time we need to know
         icon_orig_img = PIL.Image.open(icon_orig.rfile())
         self.set_tool_data('allura', icon_original_size=icon_orig_img.size)
+        if async_thumbnails():
+            from allura.tasks import thumbnail_tasks
+            with h.push_config(c, project=self):
+                thumbnail_tasks.icon_sizes.post()
 
     @property
     def icon(self):
         return self.icon_sized(DEFAULT_ICON_WIDTH)
 
+    @staticmethod
+    def icon_sizes():
+        return map(int, aslist(config.get('project_icon_sizes', '16 24 32 48 64 72 96')))
+
     @memoize
     def icon_sized(self, w):
-        allowed_sizes = map(int, aslist(config.get('project_icon_sizes', '16 24 32 48 64 72 96')))
+        allowed_sizes = self.icon_sizes()
         if w not in allowed_sizes:
             raise ValueError('Width must be one of {} (see project_icon_sizes in your .ini file)'.format(allowed_sizes))
         if w == DEFAULT_ICON_WIDTH:
@@ -389,15 +397,36 @@ def icon_sized(self, w):
             orig = self.icon_original
             if not orig:
                 return self.icon
-            sized = orig.save_thumbnail(filename='',
-                                        image=PIL.Image.open(orig.rfile()),
-                                        content_type=orig.content_type,
-                                        thumbnail_size=(w, w),
-                                        thumbnail_meta=dict(project_id=c.project._id, category=icon_cat_name),
-                                        square=True,
-                                        )
+            if async_thumbnails():
+                # the default size stands in until the task has made this one
+                from allura.tasks import thumbnail_tasks
+                with h.push_config(c, project=self):
+                    thumbnail_tasks.icon_sizes.post()
+                return self.icon
+            sized = self._save_icon_size(orig, w, icon_cat_name)
         return sized
 
+    def _save_icon_size(self, orig, w, icon_cat_name):
+        return orig.save_thumbnail(filename='',
+                                   image=PIL.Image.open(orig.rfile()),
+                                   content_type=orig.content_type,
+                                   thumbnail_size=(w, w),
+                                   thumbnail_meta=dict(project_id=self._id, category=icon_cat_name),
+                                   square=True,
+                                   )
+
+    def make_icon_sizes(self):
+        '''Make each of the project_icon_sizes of the icon which doesn't exist yet'''
+        orig = self.icon_original
+        if not orig:
+            return
+        for w in self.icon_sizes():
+            if w == DEFAULT_ICON_WIDTH:
+                continue
+            icon_cat_name = 'icon-{}'.format(w)
+            if not ProjectFile.query.get(project_id=self._id, category=icon_cat_name):
+                self._save_icon_size(orig, w, icon_cat_name)
+
     @LazyProperty
     def icon_original(self):
         return ProjectFile.query.get(project_id=self._id, category='icon_original')
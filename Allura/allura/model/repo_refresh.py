@@ -15,16 +15,19 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
 import logging
+from time import time
 from itertools import chain
 from cPickle import dumps
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 
 import bson
+from pymongo.errors import DuplicateKeyError
 
 import tg
 import jinja2
-from paste.deploy.converters import asint
+from paste.deploy.converters import asint, asbool
 from pylons import tmpl_context as c, app_globals as g
 
 from ming.base import Object
@@ -66,21 +69,57 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
     log.info('Refreshing %d commits on %s', len(commit_ids), repo.full_fs_path)
 
     # Refresh commits
-    seen = set()
-    for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i + 1), oid)
-
-    refresh_commit_repos(all_commit_ids, repo)
+    bulk_size = asint(tg.config.get('scm.refresh.bulk_write_size', 1000))
+    bulk_min = asint(tg.config.get('scm.refresh.bulk_min_commits', 1000))
+    writer = None
+    if repo._refresh_bulk_write and bulk_size > 0 and len(commit_ids) >= bulk_min:
+        writer = BulkRefreshWriter(bulk_size)
+        log.info('Using bulk writes (batches of %d) for %s', bulk_size, repo.full_fs_path)
+
+    parallel_size = asint(tg.config.get('scm.refresh.parallel_chunk_size', 0))
+    parallel = (repo._refresh_bulk_write and parallel_size > 0 and
+                len(commit_ids) > parallel_size)
+
+    start_time = time()
+    if parallel:
+        log.info('Refreshing commit info in chunks of %d for %s',
+                 parallel_size, repo.full_fs_path)
+        refresh_commit_info_parallel(
+            commit_ids, not all_commits, parallel_size,
+            asint(tg.config.get('scm.refresh.parallel_chunk_timeout', 3600)))
+    else:
+        seen = set()
+        for i, oid in enumerate(commit_ids):
+            repo.refresh_commit_info(oid, seen, not all_commits, writer=writer)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh commit info %d: %s', (i + 1), oid)
+        if writer:
+            writer.flush()
+    _log_phase(repo, 'commit info', len(commit_ids), start_time, writer)
+
+    if commit_ids:
+        repo.update_commit_graph()
+
+    start_time = time()
+    refresh_commit_repos(all_commit_ids, repo, writer=writer)
+    _log_phase(repo, 'commit repos', len(all_commit_ids), start_time, writer)
 
     # Refresh child references
-    for i, oid in enumerate(commit_ids):
-        ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-        refresh_children(ci)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh child info %d for parents of %s',
-                     (i + 1), ci._id)
+    start_time = time()
+    if parallel:
+        merge_child_links(commit_ids)
+    elif writer:
+        # children within this refresh were already set on the inserted docs;
+        # only parents from earlier refreshes are left to update
+        writer.refresh_children()
+    else:
+        for i, oid in enumerate(commit_ids):
+            ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
+            refresh_children(ci)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh child info %d for parents of %s',
+                         (i + 1), ci._id)
+    _log_phase(repo, 'child info', len(commit_ids), start_time, writer)
 
     if repo._refresh_precompute:
         # Refresh commit runs
@@ -115,8 +154,14 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
     repo.get_tags()
 
     if commits_are_new:
+        line_counts = None
+        if g.statsUpdater.listeners and asbool(tg.config.get('userstats.count_lines_of_code', True)):
+            # count the lines of the whole push at once, for the stats
+            line_counts = repo.lines_added(commit_ids)
         for commit in commit_ids:
             new = repo.commit(commit)
+            if line_counts is not None:
+                new.lines_added = line_counts.get(commit)
             user = User.by_email_address(new.committed.email)
             if user is None:
                 user = User.by_username(new.committed.name)
@@ -148,10 +193,11 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
         send_notifications(repo, reversed(commit_ids))
 
 
-def refresh_commit_repos(all_commit_ids, repo):
+def refresh_commit_repos(all_commit_ids, repo, writer=None):
     '''Refresh the list of repositories within which a set of commits are
     contained'''
     for oids in utils.chunked_iter(all_commit_ids, QSIZE):
+        added_oids = []
         for ci in CommitDoc.m.find(dict(
                 _id={'$in': list(oids)},
                 repo_ids={'$ne': repo._id})):
@@ -181,10 +227,93 @@ def refresh_commit_repos(all_commit_ids, repo):
                 app_config_id=repo.app.config._id,
                 link=oid,
                 url=repo.url_for_commit(oid)))
+            if writer:
+                added_oids.append(oid)
+                writer.save(ref)
+                writer.insert(link0)
+                writer.insert(link1)
+                continue
             ci.m.save(safe=False, validate=False)
             ref.m.save(safe=False, validate=False)
             link0.m.save(safe=False, validate=False)
             link1.m.save(safe=False, validate=False)
+        if added_oids:
+            CommitDoc.m.update_partial(
+                dict(_id={'$in': added_oids}),
+                {'$addToSet': dict(repo_ids=repo._id)},
+                multi=True)
+    if writer:
+        writer.flush()
+
+
+def refresh_commit_info_parallel(commit_ids, lazy, chunk_size, timeout=3600):
+    '''
+    Split ``commit_ids`` into consecutive chunks of ``chunk_size`` and refresh
+    each chunk in its own :func:`~allura.tasks.repo_tasks.refresh_commits`
+    task, so that idle taskd workers can share the work.  Chunks which no
+    worker has picked up yet are run here rather than waited on, so this
+    still finishes (serially) when no other worker is free.  A chunk another
+    worker hasn't finished within ``timeout`` seconds (e.g. as that worker
+    died) is taken over and run here too; chunks can safely be run twice.
+
+    Child links between commits in different chunks are not set; call
+    :func:`merge_child_links` once this returns.
+    '''
+    from allura.model.monq_model import MonQTask
+    from allura.tasks import repo_tasks
+    tasks = [repo_tasks.refresh_commits.post(list(oids), lazy=lazy)
+             for oids in utils.chunked_iter(commit_ids, chunk_size)]
+    process = '%s pid %s' % (os.uname()[1], os.getpid())
+    for i, task in enumerate(tasks):
+        claimed = MonQTask.query.find_and_modify(
+            query=dict(_id=task._id, state='ready'),
+            update={'$set': dict(state='busy', process=process)},
+            new=True)
+        if claimed is None:
+            task.join(timeout=timeout)
+            if task.state not in ('complete', 'error'):
+                log.warning('Commit info chunk %d/%d not done by %s after %ds, running it here',
+                            i + 1, len(tasks), task.process, timeout)
+                claimed = MonQTask.query.find_and_modify(
+                    query=dict(_id=task._id, state={'$in': ['ready', 'busy']}),
+                    update={'$set': dict(state='busy', process=process)},
+                    new=True)
+        if claimed is not None:
+            claimed()
+        log.info('Refresh commit info chunk %d/%d done', i + 1, len(tasks))
+    failed = MonQTask.query.find(dict(
+        _id={'$in': [t._id for t in tasks]},
+        state={'$ne': 'complete'})).count()
+    if failed:
+        raise RuntimeError(
+            '%d of %d commit info chunks failed' % (failed, len(tasks)))
+
+
+def refresh_commit_chunk(repo, commit_ids, lazy=True):
+    '''Refresh the commit info for one chunk of a parallel refresh'''
+    writer = BulkRefreshWriter(
+        asint(tg.config.get('scm.refresh.bulk_write_size', 1000)) or QSIZE)
+    seen = set()
+    for oid in commit_ids:
+        repo.refresh_commit_info(oid, seen, lazy, writer=writer)
+    # parents outside this chunk are linked up by merge_child_links
+    writer.flush()
+
+
+def merge_child_links(commit_ids):
+    '''Add any child links missing from the parents of the given commits'''
+    children = defaultdict(set)
+    for oids in utils.chunked_iter(commit_ids, QSIZE):
+        for ci in CommitDoc.m.find(dict(_id={'$in': list(oids)}), validate=False):
+            for parent_id in ci.parent_ids:
+                children[parent_id].add(ci._id)
+    for oids in utils.chunked_iter(children.keys(), QSIZE):
+        for ci in CommitDoc.m.find(dict(_id={'$in': list(oids)}), validate=False):
+            missing = children[ci._id].difference(ci.child_ids)
+            if missing:
+                CommitDoc.m.update_partial(
+                    dict(_id=ci._id),
+                    {'$addToSet': dict(child_ids={'$each': sorted(missing)})})
 
 
 def refresh_children(ci):
@@ -195,6 +324,101 @@ def refresh_children(ci):
         multi=True)
 
 
+class BulkRefreshWriter(object):
+
+    '''
+    Accumulates the documents generated while refreshing a repo and writes
+    them in unordered multi-document batches of ``batch_size``, rather than
+    with one round-trip per document.
+
+    Commits must be added in topological order (heads first, as yielded by
+    ``all_commit_ids``), which means every child of a commit within the same
+    refresh has been seen by the time the commit itself is added.  That lets
+    ``child_ids`` be filled in before the commit is written, leaving only the
+    parents from earlier refreshes for :meth:`refresh_children`.
+    '''
+
+    def __init__(self, batch_size=QSIZE):
+        self.batch_size = batch_size
+        self._pending = OrderedDict()  # (doc class, replace) => [doc, ...]
+        self._children = defaultdict(list)  # parent commit ID => [child ID, ...]
+        self.written = defaultdict(int)  # collection name => docs written
+        self.batches = 0
+
+    def add_commit(self, ci_doc, replace=False):
+        for parent_id in ci_doc.parent_ids:
+            self._children[parent_id].append(ci_doc._id)
+        ci_doc.child_ids = self._children.pop(ci_doc._id, [])
+        if replace:
+            self.save(ci_doc)
+        else:
+            self.insert(ci_doc)
+
+    def insert(self, doc):
+        '''Queue a new document; ones that already exist are left alone'''
+        self._add(doc, False)
+
+    def save(self, doc):
+        '''Queue a document to update any existing one with the same _id.
+
+        Only the fields the refresh works out are set, so an existing commit
+        keeps its ``repo_ids`` (e.g. the forks that share it).
+        '''
+        self._add(doc, True)
+
+    def _add(self, doc, replace):
+        key = (doc.__class__, replace)
+        docs = self._pending.setdefault(key, [])
+        docs.append(doc)
+        if len(docs) >= self.batch_size:
+            self._write(key, self._pending.pop(key))
+
+    def flush(self):
+        while self._pending:
+            key, docs = self._pending.popitem(last=False)
+            self._write(key, docs)
+
+    def refresh_children(self):
+        '''Add child links to parent commits that weren't part of this batch'''
+        self.flush()
+        for parent_id, child_ids in self._children.iteritems():
+            CommitDoc.m.update_partial(
+                dict(_id=parent_id),
+                {'$addToSet': dict(child_ids={'$each': child_ids})})
+        self._children.clear()
+
+    def _write(self, key, docs):
+        cls, replace = key
+        collection = cls.m.collection
+        data = [dict(cls.m.schema.validate(doc)) for doc in docs]
+        if replace:
+            for d in data:
+                fields = dict((k, v) for k, v in d.iteritems()
+                              if k not in ('_id', 'repo_ids'))
+                collection.update(dict(_id=d['_id']), {'$set': fields}, upsert=True)
+        else:
+            try:
+                collection.insert(data, continue_on_error=True)
+            except DuplicateKeyError:
+                # commits and trees are content-addressed, so an existing doc
+                # already has the same data
+                pass
+        self.written[cls.m.collection_name] += len(data)
+        self.batches += 1
+
+
+def _log_phase(repo, phase, count, start_time, writer=None):
+    elapsed = time() - start_time
+    rate = count / elapsed if elapsed else 0
+    extra = ''
+    if writer:
+        extra = ' (%d bulk batches; docs written: %s)' % (
+            writer.batches,
+            ', '.join('%s=%d' % item for item in sorted(writer.written.items())))
+    log.info('Refresh %s for %s: %d commits in %.2fs, %.1f commits/s%s',
+             phase, repo.full_fs_path, count, elapsed, rate, extra)
+
+
 class CommitRunBuilder(object):
 
     '''Class used to build up linear runs of single-parent commits'''
@@ -22,6 +22,7 @@
 import string
 import re
 from subprocess import Popen, PIPE
+from tempfile import TemporaryFile
 from hashlib import sha1
 from datetime import datetime, timedelta
 from time import time
@@ -64,6 +65,12 @@
     common_suffix='forgemail.domain',
 )
 
+# archive formats (and their content types) that snapshot_stream can produce
+SNAPSHOT_FORMATS = OrderedDict([
+    ('zip', 'application/zip'),
+    ('tar.gz', 'application/x-gzip'),
+])
+
 README_RE = re.compile('^README(\.[^.]*)?$', re.IGNORECASE)
 VIEWABLE_EXTENSIONS = frozenset([
     '.php', '.py', '.js', '.java', '.html', '.htm', '.yaml', '.sh',
@@ -99,6 +106,11 @@
 DIFF_SIMILARITY_THRESHOLD = .5  # used for determining file renames
 
 
+def line_count_max_file_size():
+    '''Files bigger than this aren't included in commit line counts'''
+    return asint(tg.config.get('scm.line_counts.max_file_size', 1024 * 1024))
+
+
 class RepositoryImplementation(object):
 
     # Repository-specific code
@@ -128,9 +140,24 @@ def commit_parents(self, commit):  # pragma no cover
         raise NotImplementedError('commit_parents')
 
     def refresh_commit_info(self, oid, lazy=True):  # pragma no cover
-        '''Refresh the data in the commit with id oid'''
+        '''Refresh the data in the commit with id oid
+
+        Implementations on a Repository with ``_refresh_bulk_write`` set also
+        accept a ``writer`` keyword argument: a
+        :class:`~allura.model.repo_refresh.BulkRefreshWriter` to hand the
+        commit (via ``add_commit``) and tree docs to, instead of saving them.
+        '''
         raise NotImplementedError('refresh_commit_info')
 
+    def update_commit_graph(self):
+        '''Bring any SCM-side commit graph / changed-path index up to date.
+
+        Called at the end of each refresh so that later path-limited history
+        lookups (e.g., :meth:`last_commit_ids`) can use it.  SCMs without
+        such an index can leave this as a no-op.
+        '''
+        pass
+
     def _setup_hooks(self, source_path=None):  # pragma no cover
         '''Install a hook in the repository that will ping the refresh url for
         the repo.  Optionally provide a path from which to copy existing hooks.'''
@@ -175,6 +202,14 @@ def tarball(self, revision, path=None):
         '''Create a tarball for the revision'''
         raise NotImplementedError('tarball')
 
+    def snapshot_stream(self, revision, archive_name, fmt='zip', path=None):
+        '''
+        Return an iterator over the chunks of an archive of the revision,
+        generated while it is being read.  ``fmt`` is one of
+        :data:`SNAPSHOT_FORMATS`.
+        '''
+        raise NotImplementedError('snapshot_stream')
+
     def is_empty(self):
         '''Determine if the repository is empty by checking the filesystem'''
         raise NotImplementedError('is_empty')
@@ -338,6 +373,17 @@ def merge_request_commits(self, mr):
         """Given MergeRequest :param mr: return list of commits to be merged"""
         raise NotImplementedError('merge_request_commits')
 
+    def lines_added(self, commit_ids, max_file_size=None):
+        """
+        Return a dict of the number of lines each commit adds, compared to
+        its first parent, as counted by the SCM in as few calls as possible.
+        Files bigger than :param max_file_size: bytes aren't counted.
+
+        Returns None if the SCM can't count lines itself, in which case they
+        are counted by diffing the blobs.
+        """
+        return None
+
 
 class Repository(Artifact, ActivityObject):
     BATCH_SIZE = 100
@@ -349,6 +395,7 @@ class __mongometa__:
     repo_id = 'repo'
     type_s = 'Repository'
     _refresh_precompute = True
+    _refresh_bulk_write = False
 
     name = FieldProperty(str)
     tool = FieldProperty(str)
@@ -451,9 +498,14 @@ def commit(self, rev):
     def all_commit_ids(self):
         return self._impl.all_commit_ids()
 
-    def refresh_commit_info(self, oid, seen, lazy=True):
+    def refresh_commit_info(self, oid, seen, lazy=True, writer=None):
+        if writer is not None:
+            return self._impl.refresh_commit_info(oid, seen, lazy, writer=writer)
         return self._impl.refresh_commit_info(oid, seen, lazy)
 
+    def update_commit_graph(self):
+        return self._impl.update_commit_graph()
+
     def open_blob(self, blob):
         return self._impl.open_blob(blob)
 
@@ -524,6 +576,11 @@ def set_default_branch(self, name):
     def paged_diffs(self, commit_id, start=0, end=None,  onlyChangedFiles=False):
         return self._impl.paged_diffs(commit_id, start, end, onlyChangedFiles)
 
+    def lines_added(self, commit_ids, max_file_size=None):
+        if max_file_size is None:
+            max_file_size = line_count_max_file_size()
+        return self._impl.lines_added(commit_ids, max_file_size)
+
     def _log(self, rev, skip, limit):
         head = self.commit(rev)
         if head is None:
@@ -745,6 +802,12 @@ def tarball(self, revision, path=None):
             path = path.strip('/')
         self._impl.tarball(revision, path)
 
+    def snapshot_stream(self, revision, fmt='zip', path=None):
+        if path:
+            path = path.strip('/')
+        archive_name = self.tarball_filename(revision, path)
+        return self._impl.snapshot_stream(revision, archive_name, fmt, path)
+
     def rev_to_commit_id(self, rev):
         raise NotImplementedError('rev_to_commit_id')
 
@@ -1120,6 +1183,16 @@ def committer_url(self):
     def tree(self):
         return self.get_tree(create=True)
 
+    @LazyProperty
+    def lines_added(self):
+        '''Number of lines added by this commit, or None if the SCM can't
+        count them (see :meth:`RepositoryImplementation.lines_added`).
+        repo_refresh sets this for all the new commits of a push at once.'''
+        counts = self.repo.lines_added([self._id])
+        if counts is None:
+            return None
+        return counts.get(self._id)
+
     def get_tree(self, create=True):
         if self.tree_id is None and create:
             self.tree_id = self.repo.compute_tree_new(self)
@@ -1984,6 +2057,30 @@ def prefix_paths_union(a, b):
     return union
 
 
+def stream_command(command, cwd=None, block_size=64 * 1024):
+    '''
+    Run ``command`` and yield its stdout in blocks as it is produced.  The
+    process is killed if the iterator is closed before the end.
+    '''
+    # stderr goes to a file so a chatty command can't block on a full pipe
+    stderr = TemporaryFile()
+    p = Popen(command, cwd=cwd, stdout=PIPE, stderr=stderr, close_fds=True)
+    try:
+        for block in iter(lambda: p.stdout.read(block_size), ''):
+            yield block
+        if p.wait() != 0:
+            stderr.seek(0)
+            raise Exception(
+                "Command: {0} returned non-zero exit code {1}\n"
+                "STDERR: {2}".format(command, p.returncode, stderr.read()))
+    finally:
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+        p.stdout.close()
+        stderr.close()
+
+
 def zipdir(source, zipfile, exclude=None):
     """Create zip archive using zip binary."""
     zipbin = tg.config.get('scm.repos.tarball.zip_binary', '/usr/bin/zip')
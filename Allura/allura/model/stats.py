@@ -27,6 +27,7 @@
 import difflib
 
 from allura.model.session import main_orm_session
+from allura.model.repository import line_count_max_file_size
 
 
 class Stats(MappedClass):
@@ -439,29 +440,6 @@ def addClosedTicket(self, open_datetime, close_datetime, project):
         self.checkOldArtifacts()
 
     def addCommit(self, newcommit, commit_datetime, project):
-        def _computeLines(newblob, oldblob=None):
-            if oldblob:
-                listold = list(oldblob)
-            else:
-                listold = []
-            if newblob:
-                listnew = list(newblob)
-            else:
-                listnew = []
-
-            if oldblob is None:
-                lines = len(listnew)
-            elif newblob and newblob.has_html_view:
-                diff = difflib.unified_diff(
-                    listold, listnew,
-                    ('old' + oldblob.path()).encode('utf-8'),
-                    ('new' + newblob.path()).encode('utf-8'))
-                lines = len(
-                    [l for l in diff if len(l) > 0 and l[0] == '+']) - 1
-            else:
-                lines = 0
-            return lines
-
         def _addCommitData(stats, topics, languages, lines):
             lt = topics + [None]
             ll = languages + [None]
@@ -492,25 +470,13 @@ def _addCommitData(stats, topics, languages, lines):
         topics = [t for t in project.trove_topic if t]
         languages = [l for l in project.trove_language if l]
 
-        d = newcommit.diffs
-        if len(newcommit.parent_ids) > 0:
-            oldcommit = newcommit.repo.commit(newcommit.parent_ids[0])
-
         totlines = 0
         if asbool(config.get('userstats.count_lines_of_code', True)):
-            for changed in d.changed:
-                newblob = newcommit.tree.get_blob_by_path(changed)
-                oldblob = oldcommit.tree.get_blob_by_path(changed)
-                totlines += _computeLines(newblob, oldblob)
-
-            for copied in d.copied:
-                newblob = newcommit.tree.get_blob_by_path(copied['new'])
-                oldblob = oldcommit.tree.get_blob_by_path(copied['old'])
-                totlines += _computeLines(newblob, oldblob)
-
-            for added in d.added:
-                newblob = newcommit.tree.get_blob_by_path(added)
-                totlines += _computeLines(newblob)
+            # counted by the SCM if it can, which is much cheaper than
+            # diffing the blobs here
+            totlines = newcommit.lines_added
+            if totlines is None:
+                totlines = self._diffCommitLines(newcommit)
 
         _addCommitData(self, topics, languages, totlines)
 
@@ -521,6 +487,54 @@ def _addCommitData(stats, topics, languages, lines):
             lines=totlines))
         self.checkOldArtifacts()
 
+    def _diffCommitLines(self, newcommit):
+        max_size = line_count_max_file_size()
+
+        def _computeLines(newblob, oldblob=None):
+            if max_size and newblob and newblob.size > max_size:
+                return 0
+            if oldblob:
+                listold = list(oldblob)
+            else:
+                listold = []
+            if newblob:
+                listnew = list(newblob)
+            else:
+                listnew = []
+
+            if oldblob is None:
+                lines = len(listnew)
+            elif newblob and newblob.has_html_view:
+                diff = difflib.unified_diff(
+                    listold, listnew,
+                    ('old' + oldblob.path()).encode('utf-8'),
+                    ('new' + newblob.path()).encode('utf-8'))
+                lines = len(
+                    [l for l in diff if len(l) > 0 and l[0] == '+']) - 1
+            else:
+                lines = 0
+            return lines
+
+        d = newcommit.diffs
+        if len(newcommit.parent_ids) > 0:
+            oldcommit = newcommit.repo.commit(newcommit.parent_ids[0])
+
+        totlines = 0
+        for changed in d.changed:
+            newblob = newcommit.tree.get_blob_by_path(changed)
+            oldblob = oldcommit.tree.get_blob_by_path(changed)
+            totlines += _computeLines(newblob, oldblob)
+
+        for copied in d.copied:
+            newblob = newcommit.tree.get_blob_by_path(copied['new'])
+            oldblob = oldcommit.tree.get_blob_by_path(copied['old'])
+            totlines += _computeLines(newblob, oldblob)
+
+        for added in d.added:
+            newblob = newcommit.tree.get_blob_by_path(added)
+            totlines += _computeLines(newblob)
+        return totlines
+
     def _updateArtifactsStats(self, art_type, art_datetime, project, action):
         if action not in ['created', 'modified']:
             return
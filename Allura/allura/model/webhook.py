@@ -18,7 +18,8 @@
 import datetime as dt
 import json
 
-from ming.odm import FieldProperty, session
+from ming import schema as S
+from ming.odm import FieldProperty, session, mapper
 from paste.deploy.converters import asint
 from tg import config
 
@@ -35,6 +36,13 @@ class __mongometa__:
     hook_url = FieldProperty(str)
     secret = FieldProperty(str)
     last_sent = FieldProperty(dt.datetime, if_missing=None)
+    # delivery attempts, updated by record_delivery()
+    stats = FieldProperty(dict(
+        attempts=S.Int(if_missing=0),
+        failures=S.Int(if_missing=0),
+        total_time=S.Float(if_missing=0.0),
+        last_status=int,
+        last_attempt=dt.datetime))
 
     def url(self):
         app = self.app_config.load()
@@ -56,6 +64,24 @@ def update_limit(self):
         self.last_sent = dt.datetime.utcnow()
         session(self).flush(self)
 
+    def record_delivery(self, ok, elapsed, status=None):
+        '''Add a delivery attempt to :attr:`stats`.  Updates the document in
+        place, so it doesn't count as a modification of the webhook.'''
+        inc = {'stats.attempts': 1, 'stats.total_time': elapsed}
+        if not ok:
+            inc['stats.failures'] = 1
+        mapper(self).collection.m.update_partial(
+            {'_id': self._id},
+            {'$inc': inc,
+             '$set': {'stats.last_status': status,
+                      'stats.last_attempt': dt.datetime.utcnow()}})
+
+    @property
+    def avg_delivery_time(self):
+        if not self.stats.attempts:
+            return None
+        return self.stats.total_time / self.stats.attempts
+
     @classmethod
     def max_hooks(self, type, tool_name):
         type = type.replace('-', '_')
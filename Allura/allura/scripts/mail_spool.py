@@ -0,0 +1,84 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+'''
+Send the messages in the outgoing mail spool (``smtp_spool_dir``).
+'''
+
+import argparse
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+from allura.scripts import ScriptTask
+from allura.lib.mail_util import MailSpool
+
+
+log = logging.getLogger(__name__)
+
+
+def send_spool(spool, client, threads=1):
+    '''Send everything in the spool once.  Returns (sent, failed) counts.'''
+    names = spool.names()
+    if not names:
+        return 0, 0
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(lambda name: spool.send(client, name), names)
+    finally:
+        pool.close()
+        pool.join()
+    sent = sum(1 for ok in results if ok)
+    return sent, len(results) - sent
+
+
+class MailSpoolSender(ScriptTask):
+
+    @classmethod
+    def execute(cls, options):
+        from allura.tasks.mail_tasks import smtp_client
+        spool = MailSpool.from_config()
+        if spool is None:
+            log.error('smtp_spool_dir is not set, there is no mail spool to send')
+            return
+        while True:
+            sent, failed = send_spool(spool, smtp_client, options.threads)
+            if sent or failed:
+                log.info('Sent %d spooled messages, %d failed', sent, failed)
+            if not options.loop:
+                break
+            time.sleep(options.interval)
+        smtp_client.close()
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(description='Send the messages in the outgoing mail spool')
+        parser.add_argument('--threads', dest='threads', type=int, default=4,
+                            help='Number of messages sent at once (limited by smtp_pool_size)')
+        parser.add_argument('--loop', action='store_true', dest='loop',
+                            help='Keep checking the spool for new messages')
+        parser.add_argument('--interval', dest='interval', type=float, default=5,
+                            help='Seconds between checks of the spool, with --loop')
+        return parser
+
+
+def get_parser():
+    return MailSpoolSender.parser()
+
+
+if __name__ == '__main__':
+    MailSpoolSender.main()
@@ -20,6 +20,7 @@
 import faulthandler
 from datetime import datetime
 
+import tg
 from paste.util.converters import asbool
 from pylons import tmpl_context as c
 from ming.orm import ThreadLocalORMSession
@@ -117,6 +118,8 @@ def execute(cls, options):
                         else:
                             log.info('Refreshing NEW commits in %r',
                                      c.app.repo)
+                        if options.parallel_chunk_size is not None:
+                            tg.config['scm.refresh.parallel_chunk_size'] = options.parallel_chunk_size
                         if options.profile:
                             import cProfile
                             cProfile.runctx(
@@ -184,6 +187,11 @@ def repo_type_list(s):
         parser.add_argument('--dry-run', action='store_true', dest='dry_run',
                             default=False, help='Log names of projects that would have their '
                             'repos refreshed, but do not perform the actual refresh.')
+        parser.add_argument('--parallel-chunk-size', dest='parallel_chunk_size',
+                            type=int, default=None, metavar='N',
+                            help='Split the commits to refresh into chunks of N and queue each as '
+                            'a task that other taskd workers can pick up. Overrides '
+                            'scm.refresh.parallel_chunk_size.')
         parser.add_argument('--profile', action='store_true', dest='profile',
                             default=False, help='Enable the profiler (slow). Will log '
                             'profiling output to ./refresh.profile')
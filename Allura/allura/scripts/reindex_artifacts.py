@@ -0,0 +1,259 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+'''
+Site-wide reindex of all artifacts, which can be resumed after a crash.
+
+The artifacts of each collection are split into partitions of consecutive
+``_id`` ranges.  Partitions are recorded in the ``reindex_partition``
+collection, which is updated as each chunk of a partition is indexed, so a
+job started again with ``--resume`` carries on where it stopped.  Partitions
+can be worked on by several processes at once.
+'''
+
+import argparse
+import logging
+import multiprocessing
+from datetime import datetime
+
+from pylons import tmpl_context as c
+from ming.orm import mapper
+
+from allura.scripts import ScriptTask
+from allura import model as M
+from allura.tasks.index_tasks import add_artifacts
+from allura.lib.exceptions import CompoundError
+from allura.lib.utils import chunked_list
+
+
+log = logging.getLogger(__name__)
+
+
+def checkpoints():
+    return M.main_doc_session.db.reindex_partition
+
+
+def artifact_classes():
+    '''The mapped Artifact class to query for each artifact collection.
+
+    Subclasses which share a collection with their base class are left out,
+    since querying the base class already finds their documents.
+    '''
+    from allura.command.show_models import build_model_inheritance_graph, dfs
+    graph = build_model_inheritance_graph()
+    seen = set()
+    for _, cls in dfs(M.Artifact, graph):
+        m = mapper(cls).collection.m
+        if m.collection_name is None:
+            continue
+        if m.collection.full_name in seen:
+            continue
+        seen.add(m.collection.full_name)
+        yield cls
+
+
+def class_path(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def load_class(path):
+    smod, scls = path.rsplit('.', 1)
+    return getattr(__import__(smod, fromlist=[scls]), scls)
+
+
+def partition_bounds(cls, query, size):
+    '''Lower ``_id`` bounds splitting the artifacts matching ``query`` into
+    partitions of ``size``'''
+    coll = mapper(cls).collection.m.collection
+    bounds = []
+    for i, doc in enumerate(coll.find(query, fields=['_id']).sort('_id', 1)):
+        if i % size == 0:
+            bounds.append(doc['_id'])
+    return bounds
+
+
+def create_partitions(job, since=None, size=10000):
+    '''Split all artifacts (modified since ``since``) into partitions for a new job'''
+    coll = checkpoints()
+    coll.remove({'job': job})
+    query = {'mod_date': {'$gte': since}} if since else {}
+    for cls in artifact_classes():
+        bounds = partition_bounds(cls, query, size)
+        log.info('%s: %d partitions', class_path(cls), len(bounds))
+        for i, lo in enumerate(bounds):
+            hi = bounds[i + 1] if i + 1 < len(bounds) else None
+            coll.insert({
+                '_id': '%s:%s:%d' % (job, class_path(cls), i),
+                'job': job,
+                'cls': class_path(cls),
+                'lo': lo,
+                'hi': hi,
+                'since': since,
+                'last_id': None,
+                'done': 0,
+                'state': 'pending',
+            })
+
+
+def pending_partitions(job):
+    return [doc['_id'] for doc in checkpoints().find(
+        {'job': job, 'state': {'$ne': 'complete'}}, fields=['_id']).sort('_id', 1)]
+
+
+def reindex_partition(partition_id, chunk_size=1000, update_solr=True, update_refs=True,
+                      solr_hosts=None):
+    '''Index the artifacts of a partition, continuing after its last checkpoint.
+
+    Returns the number of artifacts indexed.
+    '''
+    coll = checkpoints()
+    part = coll.find_one({'_id': partition_id})
+    cls = load_class(part['cls'])
+    query = {'_id': {'$gte': part['lo']}}
+    if part['last_id'] is not None:
+        query['_id'] = {'$gt': part['last_id']}
+    if part['hi'] is not None:
+        query['_id']['$lt'] = part['hi']
+    if part['since']:
+        query['mod_date'] = {'$gte': part['since']}
+    raw = mapper(cls).collection.m.collection
+    kwargs = dict(update_solr=update_solr, update_refs=update_refs)
+    if solr_hosts:
+        kwargs['solr_hosts'] = solr_hosts
+    count = 0
+    ids = [doc['_id'] for doc in raw.find(query, fields=['_id']).sort('_id', 1)]
+    for chunk in chunked_list(ids, chunk_size):
+        ref_ids = []
+        for a in cls.query.find({'_id': {'$in': chunk}}):
+            c.project = a.project
+            if update_refs:
+                try:
+                    M.ArtifactReference.from_artifact(a)
+                    M.Shortlink.from_artifact(a)
+                except Exception:
+                    log.exception('Making ArtifactReference/Shortlink from %s', a)
+                    continue
+            ref_ids.append(a.index_id())
+        M.main_orm_session.flush()
+        M.artifact_orm_session.clear()
+        try:
+            add_artifacts(ref_ids, **kwargs)
+        except CompoundError as err:
+            log.exception('Error indexing artifacts:\n%r', err)
+            log.error('%s', err.format_error())
+        M.main_orm_session.flush()
+        M.main_orm_session.clear()
+        count += len(chunk)
+        coll.update({'_id': partition_id},
+                    {'$set': {'last_id': chunk[-1], 'state': 'busy'},
+                     '$inc': {'done': len(chunk)}})
+    coll.update({'_id': partition_id}, {'$set': {'state': 'complete'}})
+    log.info('Partition %s done, %d artifacts', partition_id, count)
+    return count
+
+
+def _reindex_partition_star(args):
+    # unpacks arguments for multiprocessing.Pool.imap_unordered
+    partition_id, kwargs = args
+    try:
+        c.project = c.app = None
+        return reindex_partition(partition_id, **kwargs)
+    except Exception:
+        log.exception('Error reindexing partition %s', partition_id)
+        return 0
+
+
+class ReindexArtifacts(ScriptTask):
+
+    @classmethod
+    def execute(cls, options):
+        since = parse_datetime(options.since) if options.since else None
+        if options.resume:
+            partitions = pending_partitions(options.job)
+            if not partitions and not checkpoints().find_one({'job': options.job}):
+                log.error('No reindex job named %s to resume', options.job)
+                return
+        else:
+            create_partitions(options.job, since, options.partition_size)
+            partitions = pending_partitions(options.job)
+        log.info('Reindexing %d partitions with %d processes',
+                 len(partitions), options.processes)
+        kwargs = dict(
+            chunk_size=options.max_chunk,
+            update_solr=options.solr or not options.refs,
+            update_refs=options.refs or not options.solr,
+            solr_hosts=options.solr_hosts.split(',') if options.solr_hosts else None)
+        work = [(partition_id, kwargs) for partition_id in partitions]
+        if options.processes > 1:
+            pool = multiprocessing.Pool(options.processes)
+            try:
+                total = sum(pool.imap_unordered(_reindex_partition_star, work))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            total = sum(map(_reindex_partition_star, work))
+        remaining = len(pending_partitions(options.job))
+        if remaining:
+            log.error('Reindexed %d artifacts, %d partitions failed; run again with --resume --job %s',
+                      total, remaining, options.job)
+        else:
+            log.info('Reindexed %d artifacts', total)
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(
+            description='Reindex all artifacts into Solr and re-shortlink them, in partitions '
+                        'which are checkpointed so an interrupted reindex can be resumed')
+        parser.add_argument('--job', dest='job', default='reindex',
+                            help='Name of the reindex job, for its checkpoints (default: %(default)s)')
+        parser.add_argument('--resume', action='store_true', dest='resume',
+                            help='Carry on with the unfinished partitions of a previous run of the job')
+        parser.add_argument('--since', dest='since', default=None,
+                            help='Only reindex artifacts modified since this UTC date/time, '
+                                 'e.g. 2016-01-31 or 2016-01-31T12:00:00')
+        parser.add_argument('--processes', dest='processes', type=int, default=1,
+                            help='Number of processes working on partitions at once')
+        parser.add_argument('--partition-size', dest='partition_size', type=int, default=10000,
+                            help='Number of artifacts in each partition')
+        parser.add_argument('--max-chunk', dest='max_chunk', type=int, default=1000,
+                            help='Number of artifacts indexed between checkpoints')
+        parser.add_argument('--solr', action='store_true', dest='solr',
+                            help='Only update solr (artifact references must already exist)')
+        parser.add_argument('--refs', action='store_true', dest='refs',
+                            help='Only update artifact references and shortlinks')
+        parser.add_argument('--solr-hosts', dest='solr_hosts',
+                            help='Override the solr host(s) to post to, e.g. a new core to switch to '
+                                 'once the reindex is done.  Comma-separated list of solr server URLs')
+        return parser
+
+
+def parse_datetime(value):
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Invalid date/time: %s' % value)
+
+
+def get_parser():
+    return ReindexArtifacts.parser()
+
+
+if __name__ == '__main__':
+    ReindexArtifacts.main()
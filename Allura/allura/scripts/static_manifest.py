@@ -0,0 +1,112 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+'''
+Precompress the static files and write a manifest of them, for deploys.
+'''
+
+import os
+import gzip
+import json
+import shutil
+import argparse
+import logging
+
+from allura.scripts import ScriptTask
+from allura.lib import helpers as h
+from allura.lib.static_assets import StaticAssetIndex
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+log = logging.getLogger(__name__)
+
+COMPRESSIBLE = set(['.css', '.js', '.map', '.json', '.svg', '.html', '.txt', '.xml',
+                    '.ico', '.eot', '.ttf', '.otf'])
+
+
+def compress_file(filename, min_size=512):
+    '''Write .gz (and .br, if the brotli module is installed) variants of a
+    file, unless they are up to date.  Returns the variants written.'''
+    if os.path.splitext(filename)[1].lower() not in COMPRESSIBLE:
+        return []
+    if os.path.getsize(filename) < min_size:
+        return []
+    written = []
+    mtime = os.path.getmtime(filename)
+    gz = filename + '.gz'
+    if not os.path.exists(gz) or os.path.getmtime(gz) < mtime:
+        with open(filename, 'rb') as src:
+            with open(gz, 'wb') as raw:
+                # no filename or timestamp, so the output doesn't change between builds
+                dest = gzip.GzipFile('', 'wb', 9, raw, 0)
+                shutil.copyfileobj(src, dest)
+                dest.close()
+        written.append(gz)
+    br = filename + '.br'
+    if brotli is not None and (not os.path.exists(br) or os.path.getmtime(br) < mtime):
+        with open(filename, 'rb') as src:
+            data = brotli.compress(src.read())
+        with open(br, 'wb') as dest:
+            dest.write(data)
+        written.append(br)
+    return written
+
+
+class StaticManifest(ScriptTask):
+
+    @classmethod
+    def execute(cls, options):
+        index = StaticAssetIndex(list(h.iter_entry_points('allura')))
+        if options.compress:
+            written = []
+            for path, filename in sorted(index.files.iteritems()):
+                if not filename.endswith(('.gz', '.br')):
+                    written.extend(compress_file(filename, options.min_size))
+            log.info('Wrote %d compressed files%s', len(written),
+                     '' if brotli else ' (brotli module not installed, gzip only)')
+            index = StaticAssetIndex(list(h.iter_entry_points('allura')))
+        if options.output:
+            manifest = index.manifest()
+            with open(options.output, 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            log.info('Wrote manifest of %d files to %s', len(manifest), options.output)
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(
+            description='Precompress the static files served under static.script_name and/or '
+                        'write a JSON manifest of them with their fingerprinted paths')
+        parser.add_argument('--compress', action='store_true', dest='compress',
+                            help='Write .gz (and .br, if the brotli module is installed) files next '
+                                 'to each compressible static file, for the app to serve')
+        parser.add_argument('--min-size', dest='min_size', type=int, default=512,
+                            help='Files smaller than this many bytes are not compressed')
+        parser.add_argument('--output', dest='output', default=None,
+                            help='Write the manifest to this file')
+        return parser
+
+
+def get_parser():
+    return StaticManifest.parser()
+
+
+if __name__ == '__main__':
+    StaticManifest.main()
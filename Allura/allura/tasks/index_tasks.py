@@ -25,7 +25,7 @@
 from allura.lib import helpers as h
 from allura.lib.decorators import task
 from allura.lib.exceptions import CompoundError
-from allura.lib.solr import make_solr_from_config
+from allura.lib.solr import make_solr_from_config, SolrUpdateBuffer
 
 
 log = logging.getLogger(__name__)
@@ -70,7 +70,7 @@ def del_users(user_solr_ids):
     __del_objects(user_solr_ids)
 
 
-@task
+@task(coalesce='union')
 def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
     '''
     Add the referenced artifacts to SOLR and shortlinks.
@@ -82,9 +82,19 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
     from allura.lib.search import find_shortlinks
 
     exceptions = []
-    solr_updates = []
+    solr_updates = SolrUpdateBuffer(__get_solr(solr_hosts))
+
+    def send(method, *args):
+        # outside of the per-artifact error handling, as a failure of a whole
+        # batch isn't down to the artifact which happened to fill it
+        try:
+            method(*args)
+        except Exception:
+            exceptions.append(sys.exc_info())
+
     with _indexing_disabled(M.session.artifact_orm_session._get()):
         for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
+            doc = None
             try:
                 artifact = ref.artifact
                 if artifact is None:
@@ -95,10 +105,8 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
                     if s is None:
                         continue
                     if update_solr:
-                        solr_updates.append(s)
-                    if update_refs:
-                        if isinstance(artifact, M.Snapshot):
-                            continue
+                        doc = s
+                    if update_refs and not isinstance(artifact, M.Snapshot):
                         # Find shortlinks in the raw text, not the escaped html
                         # created by the `solarize()`.
                         link_text = artifact.index().get('text') or ''
@@ -107,7 +115,12 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
             except Exception:
                 log.error('Error indexing artifact %s', ref._id)
                 exceptions.append(sys.exc_info())
-        __get_solr(solr_hosts).add(solr_updates)
+            if doc is not None:
+                send(solr_updates.add, doc)
+        send(solr_updates.flush)
+    if solr_updates.sent:
+        log.info('Sent %d docs to solr in %.2fs (%.1f docs/s)',
+                 solr_updates.sent, solr_updates.seconds, solr_updates.docs_per_second)
 
     if len(exceptions) == 1:
         raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
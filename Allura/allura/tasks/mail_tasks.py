@@ -160,18 +160,29 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
             fromaddr = g.noreply
         else:
             fromaddr = user.email_address_header()
+    # Look up all the destination users at once
+    user_ids = []
+    for addr in destinations:
+        if not mail_util.isvalid(addr):
+            try:
+                user_ids.append(ObjectId(addr))
+            except:
+                log.exception('Error looking up user with ID: %r' % addr)
+    users = {}
+    if user_ids:
+        users = dict((user._id, user) for user in M.User.query.find(
+            dict(_id={'$in': user_ids}, disabled=False, pending=False)))
     # Divide addresses based on preferred email formats
     for addr in destinations:
         if mail_util.isvalid(addr):
             addrs_plain.append(addr)
         else:
             try:
-                user = M.User.query.get(_id=ObjectId(addr), disabled=False, pending=False)
-                if not user:
-                    log.warning('Cannot find user with ID: %s', addr)
-                    continue
+                user = users.get(ObjectId(addr))
             except:
-                log.exception('Error looking up user with ID: %r' % addr)
+                continue
+            if not user:
+                log.warning('Cannot find user with ID: %s', addr)
                 continue
             addr = user.email_address_header()
             if not addr and user.email_addresses:
@@ -62,7 +62,7 @@ def reclone(*args, **kwargs):
     clone(*args, **kwargs)
 
 
-@task
+@task(coalesce='same')
 def refresh(**kwargs):
     from allura import model as M
     log = logging.getLogger(__name__)
@@ -87,6 +87,12 @@ def refresh(**kwargs):
                  c.project.shortname, c.app.config.options.mount_point)
 
 
+@task
+def refresh_commits(commit_ids, lazy=True):
+    from allura.model.repo_refresh import refresh_commit_chunk
+    refresh_commit_chunk(c.app.repo, commit_ids, lazy)
+
+
 @task
 def uninstall(**kwargs):
     from allura import model as M
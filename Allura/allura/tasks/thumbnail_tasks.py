@@ -0,0 +1,50 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+'''
+Background image processing, used when ``thumbnails.async`` is set: the
+thumbnails of uploaded image attachments, and all the sizes of project icons.
+Uploads return without waiting for PIL, and a placeholder is shown until the
+thumbnails are ready.
+'''
+
+import logging
+
+from pylons import tmpl_context as c
+
+from allura.lib.decorators import task
+
+log = logging.getLogger(__name__)
+
+
+@task
+def attachment_thumbnail(class_name, attachment_id):
+    '''Make the thumbnail of an image attachment'''
+    module_name, cls_name = class_name.rsplit('.', 1)
+    cls = getattr(__import__(module_name, fromlist=[cls_name]), cls_name)
+    attachment = cls.query.get(_id=attachment_id)
+    if attachment is None:
+        log.info('Attachment %s %s is gone, no thumbnail needed', class_name, attachment_id)
+        return
+    if attachment.make_thumbnail() is None:
+        log.warn('Could not make a thumbnail of %s %s', class_name, attachment_id)
+
+
+@task(coalesce='same')
+def icon_sizes():
+    '''Make all the sizes of c.project's icon'''
+    c.project.make_icon_sizes()
@@ -127,6 +127,20 @@ def wrapped(*a, **kw):
     return _without_module
 
 
+@contextlib.contextmanager
+def mock_smtp():
+    """
+    Patches the connections of the outgoing mail client, and yields the mock
+    that stands for them (check its ``sendmail`` calls).
+    """
+    from allura.tasks.mail_tasks import smtp_client
+    # drop pooled connections, which may be mocks of other tests
+    smtp_client.close()
+    with patch.object(smtp_client, '_connect') as connect:
+        yield connect.return_value
+    smtp_client.close()
+
+
 class patch_middleware_config(object):
 
     '''
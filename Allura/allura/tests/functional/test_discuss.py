@@ -19,7 +19,7 @@
 from mock import patch
 from nose.tools import assert_in, assert_not_in, assert_equal, assert_false, assert_true, assert_raises
 from webtest.app import AppError
-from ming.odm import session
+from ming.odm import session, ThreadLocalORMSession
 
 from allura.tests import TestController
 from allura import model as M
@@ -403,6 +403,22 @@ def test_deleted_post_attachment(self):
         self.app.get(alink, status=404)
         self.app.get(thumblink, status=404)
 
+    def test_async_thumbnail(self):
+        f = os.path.join(os.path.dirname(__file__), '..', 'data', 'user.png')
+        with open(f) as f:
+            pic = f.read()
+        with h.push_config(config, **{'thumbnails.async': 'true'}):
+            self.app.post(
+                self.post_link + 'attach',
+                upload_files=[('file_info', 'user.png', pic)])
+            thumblink = self.attach_link() + '/thumb'
+            r = self.app.get(thumblink, status=302)
+            assert r.location.endswith('/images/spinner.gif'), r.location
+            M.MonQTask.run_ready()
+            ThreadLocalORMSession.flush_all()
+            r = self.app.get(thumblink, status=200)
+            assert_equal(r.content_type, 'image/png')
+
     def test_unmoderated_post_attachments(self):
         ordinary_user = {'username': 'test-user'}
         moderator = {'username': 'test-admin'}
@@ -138,6 +138,31 @@ def test_task_view(self):
         r = self.app.get(url)
         assert 'math.ceil' in r, r
 
+    @patch('allura.controllers.site_admin.slow_requests')
+    def test_slow_requests(self, slow_requests):
+        slow_requests.return_value = M.main_doc_session.db.slow_requests
+        _id = slow_requests().insert(dict(
+            url='/p/test/wiki/', method='GET', ms=2500.0, trigger='sample',
+            created=dt.datetime.utcnow(), mongo_calls=40,
+            timings=[dict(name='total', ms=2500.0, count=1), dict(name='mongo', ms=900.0, count=40)],
+            repeated=[['user.find(_id)', 30, 800.0]],
+            calls=[dict(name='mongo', call='user.find(_id)', start=1.0, ms=2.0)],
+            tree=[dict(name='total', start=0, ms=2500.0, children=[
+                dict(name='mongo', call='user.find(_id)', start=1.0, ms=2.0, children=[])])]))
+        r = self.app.get('/nf/admin/slow_requests',
+                         extra_environ=dict(username='*anonymous'), status=302)
+        r = self.app.get('/nf/admin/slow_requests')
+        assert_in('/p/test/wiki/', r)
+        assert_in('user.find(_id) &times; 30', r)
+        r = self.app.get('/nf/admin/slow_requests?url=/p/other/')
+        assert_not_in('/p/test/wiki/', r)
+
+        r = self.app.get('/nf/admin/slow_requests/view/%s' % _id)
+        assert_in('GET /p/test/wiki/', r)
+        assert_equal(len(r.html.find('table', {'id': 'repeated'}).findAll('tr')), 2)
+        assert_in('user.find(_id)', r.html.find('div', {'id': 'call_tree'}).text)
+        self.app.get('/nf/admin/slow_requests/view/%s' % ObjectId(), status=404)
+
     def test_task_new(self):
         r = self.app.get('/nf/admin/task_manager/new')
         assert 'New Task' in r, r
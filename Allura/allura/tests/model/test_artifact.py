@@ -28,7 +28,7 @@
 from nose import with_setup
 from mock import patch
 from ming.orm.ormsession import ThreadLocalORMSession
-from ming.orm import Mapper
+from ming.orm import Mapper, mapper
 from bson import ObjectId
 from webob import Request
 
@@ -190,6 +190,53 @@ def test_versioning():
     assert pg.history().count() == 3
 
 
+@with_setup(setUp, tearDown)
+def test_commit_many():
+    pages = [WM.Page(title='Page %s' % i, text='') for i in range(3)]
+    WM.Page.commit_many(pages)
+    ThreadLocalORMSession.flush_all()
+    # version 2 of the first page was taken by an edit the other copy missed
+    pages[0].commit()
+    ThreadLocalORMSession.flush_all()
+    pages[0].version = 1
+    for pg in pages:
+        pg.text = 'changed'
+    snapshots = WM.Page.commit_many(pages)
+    assert_equal([ss.version for ss in snapshots], [3, 2, 2])
+    assert_equal([pg.version for pg in pages], [3, 2, 2])
+    ThreadLocalORMSession.flush_all()
+    for pg in pages:
+        assert_equal(pg.get_version(1).text, '')
+        assert_equal(pg.get_version(-1).text, 'changed')
+        assert_equal(pg.get_version(-1).author.username, c.user.username)
+
+
+@with_setup(setUp, tearDown)
+def test_commit_many_version_taken_in_between():
+    pages = [WM.Page(title='Page %s' % i, text='') for i in range(3)]
+    WM.Page.commit_many(pages)
+    ThreadLocalORMSession.flush_all()
+    pages[1].commit()
+    ThreadLocalORMSession.flush_all()
+    pages[1].version = 1
+    history = mapper(WM.PageHistory).collection.m.collection
+    real_find = history.find
+    calls = []
+
+    def find(*args, **kw):
+        # the version 2 of the second page is taken after it is looked for
+        calls.append(args)
+        return [] if len(calls) == 1 else real_find(*args, **kw)
+    with patch.object(history, 'find', side_effect=find):
+        snapshots = WM.Page.commit_many(pages)
+    assert_equal([ss.version for ss in snapshots], [2, 3, 2])
+    ThreadLocalORMSession.flush_all()
+    assert_equal([pg.version for pg in pages], [2, 3, 2])
+    assert_equal(WM.PageHistory.query.find().count(), 7)
+    for pg in pages:
+        assert_equal(pg.get_version(-1).version, pg.version)
+
+
 @with_setup(setUp, tearDown)
 def test_messages_unknown_lookup():
     from bson import ObjectId
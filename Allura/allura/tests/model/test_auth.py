@@ -120,7 +120,7 @@ def test_email_address_send_verification_link():
 
     addr.send_verification_link()
 
-    with patch('allura.tasks.mail_tasks.smtp_client._client') as _client:
+    with td.mock_smtp() as _client:
         M.MonQTask.run_ready()
     return_path, rcpts, body = _client.sendmail.call_args[0]
     assert_equal(rcpts, ['test_admin@domain.net'])
@@ -18,17 +18,22 @@
 #       under the License.
 
 import os
+import shutil
+import tempfile
 from unittest import TestCase
 from cStringIO import StringIO
 from io import BytesIO
 
+import tg
 from pylons import tmpl_context as c
 from ming.orm import session, Mapper
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
 from mock import patch
-from webob import Request, Response
+from webob import Request, Response, exc
 
 from allura import model as M
+from allura.lib import helpers as h
+from allura.lib import snapshot_cache
 from alluratest.controller import setup_unit_test
 
 
@@ -129,8 +134,7 @@ def test_serve_embed(self):
                 patch('allura.lib.utils.pylons.response', Response()) as response, \
                 patch('allura.lib.utils.etag_cache') as etag_cache:
             response_body = list(f.serve())
-            etag_cache.assert_called_once_with(u'{}?{}'.format(f.filename,
-                                                               f._id.generation_time).encode('utf-8'))
+            etag_cache.assert_called_once_with(f.rfile().md5)
             assert_equal(['test1'], response_body)
             assert_equal(response.content_type, f.content_type)
             assert 'Content-Disposition' not in response.headers
@@ -142,13 +146,53 @@ def test_serve_embed_false(self):
                 patch('allura.lib.utils.pylons.response', Response()) as response, \
                 patch('allura.lib.utils.etag_cache') as etag_cache:
             response_body = list(f.serve(embed=False))
-            etag_cache.assert_called_once_with(u'{}?{}'.format(f.filename,
-                                                               f._id.generation_time).encode('utf-8'))
+            etag_cache.assert_called_once_with(f.rfile().md5)
             assert_equal(['test1'], response_body)
             assert_equal(response.content_type, f.content_type)
             assert_equal(response.headers['Content-Disposition'],
                          'attachment;filename="te s\xe0\xad\xae1.txt"')
 
+    def test_serve_range(self):
+        f = File.from_data(u'test.txt', 'test1 test2')
+        self.session.flush()
+        req = Request.blank('/', headers={'Range': 'bytes=2-6'})
+        with patch('allura.lib.utils.tg.request', req), \
+                patch('allura.lib.utils.pylons.response', Response()) as response, \
+                patch('allura.lib.utils.etag_cache'):
+            assert_equal(''.join(f.serve()), 'st1 t')
+            assert_equal(response.status_int, 206)
+            assert_equal(response.headers['Accept-Ranges'], 'bytes')
+            assert_equal(response.headers['Content-Range'], 'bytes 2-6/11')
+
+    def test_serve_cached(self):
+        f = File.from_data(u'test.txt', 'test1')
+        self.session.flush()
+        root = tempfile.mkdtemp()
+        try:
+            with h.push_config(tg.config, **{'files.cache.root': root, 'files.cache.min_hits': '1'}):
+                for i in range(2):
+                    with patch('allura.lib.utils.tg.request', Request.blank('/')), \
+                            patch('allura.lib.utils.pylons.response', Response()), \
+                            patch('allura.lib.utils.etag_cache'):
+                        assert_equal(''.join(f.serve()), 'test1')
+                cache = snapshot_cache.get_file_cache()
+                cached = cache.get(cache.key(str(f.file_id), f.filename))
+                assert cached
+                with open(cached) as fp:
+                    assert_equal(fp.read(), 'test1')
+                # neither GridFS nor the cached file are needed for a 304
+                with patch('allura.lib.utils.tg.request', Request.blank('/')), \
+                        patch('allura.lib.utils.pylons.response', Response()), \
+                        patch('allura.lib.utils.etag_cache', side_effect=exc.HTTPNotModified), \
+                        patch('allura.model.filesystem.open', create=True) as open_, \
+                        patch.object(File, 'rfile') as rfile:
+                    with assert_raises(exc.HTTPNotModified):
+                        f.serve()
+                    assert not open_.called
+                    assert not rfile.called
+        finally:
+            shutil.rmtree(root)
+
     def test_image(self):
         path = os.path.join(
             os.path.dirname(__file__), '..', 'data', 'user.png')
@@ -211,6 +255,89 @@ def test_attachment_name_encoding(self):
         assert type(attachment) != tuple   # tuple is for (img, thumb) pairs
         assert_equal(attachment.filename, u'Strukturpr\xfcfung.dvi')
 
+    def test_share_identical_file(self):
+        f1 = File.from_data(u'a.txt', 'same')
+        self.session.flush()
+        assert not f1.share_identical_file()
+        f2 = File.from_data(u'b.txt', 'same')
+        f3 = File.from_data(u'c.txt', 'other')
+        self.session.flush()
+        assert_equal(f1.sha256, f2.sha256)
+        assert f2.share_identical_file()
+        assert not f3.share_identical_file()
+        self.session.flush()
+        assert_equal(f2.file_id, f1.file_id)
+        assert_equal(self.db.fs.files.count(), 2)
+        # the contents stay until nothing uses them
+        f1.delete()
+        self.session.flush()
+        self._assert_content(f2, 'same')
+        f2.delete()
+        f3.delete()
+        self.session.flush()
+        assert_equal(self.db.fs.files.count(), 0)
+
+    def test_share_identical_file_checks_length(self):
+        f1 = File.from_data(u'a.txt', 'same')
+        f2 = File.from_data(u'b.txt', 'same!')
+        f2.sha256 = f1.sha256  # a collision
+        self.session.flush()
+        assert not f2.share_identical_file()
+        self._assert_content(f2, 'same!')
+
+    def test_share_identical_file_being_deleted(self):
+        f1 = File.from_data(u'a.txt', 'same')
+        self.session.flush()
+        # another request is deleting f1
+        assert f1._release_file()
+        f2 = File.from_data(u'b.txt', 'same')
+        self.session.flush()
+        assert not f2.share_identical_file()
+        f1.delete()
+        self.session.flush()
+        self._assert_content(f2, 'same')
+
+    def test_attachment_shares_identical_file(self):
+        c.app.config._id = None
+        a1 = M.BaseAttachment.save_attachment(u'a.txt', StringIO('same'))
+        session(a1).flush()
+        a2 = M.BaseAttachment.save_attachment(u'b.txt', StringIO('same'))
+        assert_equal(a2.file_id, a1.file_id)
+        path = os.path.join(os.path.dirname(__file__),
+                            '..', 'data', 'user.png')
+        with open(path, 'rb') as fp:
+            img1, _ = M.BaseAttachment.save_attachment('user.png', fp)
+        session(img1).flush()
+        with open(path, 'rb') as fp:
+            img2, _ = M.BaseAttachment.save_attachment('copy.png', fp)
+        assert_equal(img2.file_id, img1.file_id)
+
+    @patch('allura.tasks.thumbnail_tasks.attachment_thumbnail')
+    def test_async_thumbnail(self, attachment_thumbnail):
+        path = os.path.join(os.path.dirname(__file__),
+                            '..', 'data', 'user.png')
+        c.app.config._id = None
+        with h.push_config(tg.config, **{'thumbnails.async': 'true'}):
+            with open(path, 'rb') as fp:
+                orig, thumbnail = M.BaseAttachment.save_attachment('user.png', fp)
+            assert_equal(thumbnail, None)
+            attachment_thumbnail.post.assert_called_once_with(
+                'allura.model.attachments.BaseAttachment', orig._id)
+            thumbnail = orig.make_thumbnail()
+            session(thumbnail).flush()
+            assert_equal(thumbnail.type, 'thumbnail')
+            assert_equal(thumbnail.filename, 'user.png')
+            assert thumbnail.is_image()
+            assert_equal(orig.make_thumbnail(), thumbnail)
+
+            # an identical upload shares both the contents and the thumbnail
+            with open(path, 'rb') as fp:
+                orig2, _ = M.BaseAttachment.save_attachment('copy.png', fp)
+            assert_equal(orig2.file_id, orig.file_id)
+            thumbnail2 = orig2.make_thumbnail()
+            assert_equal(thumbnail2.filename, 'copy.png')
+            assert_equal(thumbnail2.file_id, thumbnail.file_id)
+
     def _assert_content(self, f, content):
         result = f.rfile().read()
         assert result == content, result
@@ -16,12 +16,17 @@
 #       under the License.
 
 import pprint
-from nose.tools import with_setup
+from datetime import datetime, timedelta
+
+import mock
+from nose.tools import with_setup, assert_equal
+from tg import config
 
 from ming.orm import ThreadLocalORMSession
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura import model as M
+from allura.lib import helpers as h
 
 
 def setUp():
@@ -40,3 +45,169 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+
+@with_setup(setUp)
+def test_join_timeout():
+    task = M.MonQTask.post(pprint.pformat, ([5, 6],))
+    ThreadLocalORMSession.flush_all()
+    assert_equal(task.join(poll_interval=0.01, timeout=0.05), None)
+    assert_equal(task.state, 'ready')
+
+
+@with_setup(setUp)
+def test_claim_batch():
+    low = M.MonQTask.post(pprint.pformat, ([1],), priority=1)
+    high = M.MonQTask.post(pprint.pformat, ([2],), priority=20)
+    mid = M.MonQTask.post(pprint.pformat, ([3],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    task, next_tasks = M.MonQTask.claim(process='w1', limit=2)
+    assert_equal((task._id, task.state, task.process), (high._id, 'busy', 'w1'))
+    assert_equal([t._id for t in next_tasks], [mid._id])
+    assert_equal(M.MonQTask.query.get(_id=mid._id).state, 'busy')
+    task, next_tasks2 = M.MonQTask.claim(process='w2', limit=2)
+    assert_equal((task._id, task.process), (low._id, 'w2'))
+    assert_equal(next_tasks2, [])
+    assert_equal(M.MonQTask.claim(process='w2', limit=2), (None, []))
+    # handed back unrun
+    M.MonQTask.release(next_tasks)
+    ThreadLocalORMSession.close_all()
+    task, next_tasks = M.MonQTask.claim(process='w2', limit=2)
+    assert_equal((task._id, task.process), (mid._id, 'w2'))
+
+
+@with_setup(setUp)
+def test_claim_batch_timeout():
+    M.MonQTask.post(pprint.pformat, ([1],))
+    M.MonQTask.post(pprint.pformat, ([2],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    task, next_tasks = M.MonQTask.claim(process='w1', limit=2)
+    assert_equal(len(next_tasks), 1)
+    # the worker died before getting to the rest of its batch
+    M.MonQTask.timeout_tasks(datetime.utcnow() + timedelta(seconds=1))
+    ThreadLocalORMSession.close_all()
+    assert_equal(M.MonQTask.query.find(dict(state='ready')).count(), 2)
+
+
+@with_setup(setUp)
+def test_lanes():
+    with h.push_config(config, **{'monq.lane.bulk': 'pprint, allura.tasks.index_tasks',
+                                  'monq.lane.special': 'pprint.pformat'}):
+        assert_equal(M.MonQTask.lane_for('pprint.pformat'), 'special')
+        assert_equal(M.MonQTask.lane_for('pprint.pprint'), 'bulk')
+        assert_equal(M.MonQTask.lane_for('allura.tasks.index_tasks.add_artifacts'), 'bulk')
+        assert_equal(M.MonQTask.lane_for('allura.tasks.mail_tasks.sendmail'), None)
+        M.MonQTask.post(pprint.pformat, ([1],))
+        M.MonQTask.post(pprint.pformat, ([2],), lane='bulk')
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    assert_equal(M.MonQTask.get(lanes=[None]), None)
+    assert_equal(M.MonQTask.get(lanes=['bulk']).args, [[2]])
+    assert_equal(M.MonQTask.get(lanes=['bulk', 'special']).args, [[1]])
+
+
+@with_setup(setUp)
+def test_post_many():
+    assert_equal(M.MonQTask.post_many(pprint.pformat, []), [])
+    ids = M.MonQTask.post_many(pprint.pformat, [(([1],), {}), (([2],), dict(width=1))])
+    assert_equal(len(ids), 2)
+    ThreadLocalORMSession.close_all()
+    task, next_tasks = M.MonQTask.claim(process='w1', limit=2)
+    tasks = [task] + next_tasks
+    assert_equal(sorted(t._id for t in tasks), sorted(ids))
+    for task in tasks:
+        assert_equal(task.task_name, 'pprint.pformat')
+        task()
+    assert_equal(sorted(t.result for t in tasks), ['I[1]', 'I[2]'])
+
+
+@with_setup(setUp)
+def test_report_progress():
+    M.MonQTask.report_progress('not in a task')
+    task = M.MonQTask.post(pprint.pformat, ([1],))
+    ThreadLocalORMSession.flush_all()
+    task.function = lambda *args: M.MonQTask.report_progress('1/2 items')
+    task()
+    ThreadLocalORMSession.close_all()
+    assert_equal(M.MonQTask.query.get(_id=task._id).progress, '1/2 items')
+
+
+class TestTaskWakeup(object):
+
+    def setUp(self):
+        db = mock.MagicMock()
+        db.collection_names.return_value = ['monq_wakeup']
+        self.wakeup = M.monq_model.TaskWakeup(db)
+        self.cursor = self.wakeup.collection.find.return_value
+        self.cursor.alive = True
+        self.cursor.__iter__.return_value = iter([{'task_name': 'old'}])
+
+    def test_notify_on_post(self):
+        with h.push_config(config, **{'monq.wakeup': 'true'}), \
+                mock.patch.object(M.monq_model.TaskWakeup, 'instance', return_value=self.wakeup):
+            M.MonQTask.post(pprint.pformat, ([1],))
+            M.MonQTask.post(pprint.pformat, ([2],), delay=10)
+        self.wakeup.collection.insert.assert_called_once_with(
+            dict(task_name='pprint.pformat', lane=None), w=0)
+
+    def test_wait(self):
+        self.cursor.next.side_effect = [
+            StopIteration,
+            dict(task_name='other', lane=None),
+            dict(task_name='pprint.pformat', lane='bulk'),
+            dict(task_name='pprint.pformat', lane=None),
+        ]
+        assert self.wakeup.wait(10, only=['pprint.pformat'], lanes=[None])
+        assert_equal(self.cursor.next.call_count, 4)
+
+    @mock.patch('allura.model.monq_model.time')
+    def test_wait_timeout(self, time):
+        time.time.side_effect = [0, 0, 5, 11, 11]
+        self.cursor.next.side_effect = StopIteration
+        assert not self.wakeup.wait(10)
+        assert_equal(self.cursor.next.call_count, 2)
+        assert not time.sleep.called
+
+    @mock.patch('allura.model.monq_model.time')
+    def test_wait_cursor_dead(self, time):
+        time.time.side_effect = [0, 0, 1]
+        self.cursor.alive = False
+        assert not self.wakeup.wait(10)
+        time.sleep.assert_called_once_with(9)
+
+
+@with_setup(setUp)
+def test_coalesce_union():
+    with h.push_config(config, **{'monq.coalesce.max_batch': '4'}):
+        task = M.MonQTask.post(pprint.pformat, ([1, 2], 'x'), coalesce='union')
+        assert_equal(M.MonQTask.post(pprint.pformat, ([2, 3], 'x'), coalesce='union')._id, task._id)
+        # different other arguments
+        other = M.MonQTask.post(pprint.pformat, ([4], 'y'), coalesce='union')
+        assert other._id != task._id
+        # no room left
+        full = M.MonQTask.post(pprint.pformat, ([5, 6], 'x'), coalesce='union')
+        assert full._id != task._id
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.query.get(_id=task._id)
+    assert_equal(task.args, [[1, 2, 3], 'x'])
+    assert_equal(task.coalesce_size, 3)
+    assert_equal(M.MonQTask.query.find().count(), 3)
+
+    # running tasks are left alone
+    task.state = 'busy'
+    ThreadLocalORMSession.flush_all()
+    assert M.MonQTask.post(pprint.pformat, ([7], 'x'), coalesce='union')._id != task._id
+
+
+@with_setup(setUp)
+def test_coalesce_same():
+    task = M.MonQTask.post(pprint.pformat, ('a',), coalesce='same')
+    assert_equal(M.MonQTask.post(pprint.pformat, ('a',), coalesce='same')._id, task._id)
+    assert M.MonQTask.post(pprint.pformat, ('b',), coalesce='same')._id != task._id
+    assert M.MonQTask.post(pprint.pformat, ('a',))._id != task._id
+    with h.push_config(config, **{'monq.coalesce.max_delay': '60'}):
+        delayed = M.MonQTask.post(pprint.pformat, ('c',), coalesce='same')
+    assert delayed.time_queue > datetime.utcnow() + timedelta(seconds=50)
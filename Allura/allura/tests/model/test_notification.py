@@ -20,7 +20,7 @@
 import collections
 
 from pylons import tmpl_context as c, app_globals as g
-from nose.tools import assert_equal, assert_in
+from nose.tools import assert_equal, assert_in, assert_raises
 from ming.orm import ThreadLocalORMSession
 import mock
 import bson
@@ -206,13 +206,68 @@ def test_post_user_notification(self):
     def test_delivery(self):
         self._subscribe()
         self._post_notification()
-        M.MonQTask.run_ready()
+        with mock.patch.object(M.Mailbox, 'fire_ready'):
+            M.MonQTask.run_ready()
         ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
         assert M.Mailbox.query.find().count() == 1
         mbox = M.Mailbox.query.get()
         assert len(mbox.queue) == 1
         assert not mbox.queue_empty
 
+        # and emptied when fired
+        M.Mailbox.fire_ready()
+        ThreadLocalORMSession.close_all()
+        mbox = M.Mailbox.query.get()
+        assert_equal(mbox.queue, [])
+        assert mbox.queue_empty
+        assert_equal(M.MonQTask.query.find(
+            {'task_name': 'allura.tasks.mail_tasks.sendmail'}).count(), 1)
+
+    def test_fire_ready_concurrent_delivery(self):
+        self._subscribe()
+        self._post_notification()
+        with mock.patch.object(M.Mailbox, 'fire_ready'):
+            M.MonQTask.run_ready()
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        q_direct = dict(type='direct', queue_empty=False)
+        real_find = M.Mailbox.query.find
+
+        def find_then_deliver(*args, **kw):
+            # another notification arrives after the mailbox was read
+            result = real_find(*args, **kw).all()
+            M.Mailbox._collection().update({}, {'$push': dict(queue='late')}, multi=True)
+            return mock.Mock(limit=lambda n: mock.Mock(all=lambda: result))
+        with mock.patch.object(M.Mailbox.query, 'find', side_effect=find_then_deliver):
+            candidates, drained = M.Mailbox._drain_direct(q_direct, 10)
+        assert_equal(len(candidates), 1)
+        assert_equal(drained, [])
+        # nothing lost, emptied by the next batch instead
+        candidates, drained = M.Mailbox._drain_direct(q_direct, 10)
+        assert_equal(len(drained), 1)
+        assert_equal(drained[0].queue[-1], 'late')
+        assert_equal(M.Mailbox._drain_direct(q_direct, 10), ([], []))
+
+    def test_fire_ready_error_requeues_rest(self):
+        self._subscribe()
+        user2 = M.User.query.get(username='test-user-2')
+        self._subscribe(user=user2)
+        self._post_notification()
+        with mock.patch.object(M.Mailbox, 'fire_ready'):
+            M.MonQTask.run_ready()
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        with mock.patch.object(M.Mailbox, 'fire', side_effect=ValueError('bad')):
+            assert_raises(ValueError, M.Mailbox.fire_ready)
+        # the mailbox that failed is emptied, the other one is fired next time
+        ThreadLocalORMSession.close_all()
+        queues = sorted(len(mbox.queue) for mbox in M.Mailbox.query.find())
+        assert_equal(queues, [0, 1])
+        M.Mailbox.fire_ready()
+        assert_equal(M.MonQTask.query.find(
+            {'task_name': 'allura.tasks.mail_tasks.sendmail'}).count(), 1)
+
     def test_email(self):
         self._subscribe()  # as current user: test-admin
         user2 = M.User.query.get(username='test-user-2')
@@ -226,13 +281,16 @@ def test_email(self):
 
         # sends the notification out into "mailboxes", and from mailboxes into
         # email tasks
-        M.MonQTask.run_ready()
+        with mock.patch.object(M.Mailbox, 'fire_ready'):
+            M.MonQTask.run_ready()
+        ThreadLocalORMSession.close_all()
         mboxes = M.Mailbox.query.find().all()
         assert_equal(len(mboxes), 2)
         assert_equal(len(mboxes[0].queue), 1)
         assert not mboxes[0].queue_empty
         assert_equal(len(mboxes[1].queue), 1)
         assert not mboxes[1].queue_empty
+        M.Mailbox.fire_ready()
 
         email_tasks = M.MonQTask.query.find({'state': 'ready'}).all()
         # make sure both subscribers will get an email
@@ -0,0 +1,107 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+from datetime import datetime, timedelta
+
+from mock import patch
+from nose.tools import assert_equal, assert_in
+from ming.orm import ThreadLocalORMSession
+
+from alluratest.controller import setup_basic_test, setup_global_objects
+from allura import model as M
+from allura.scripts import reindex_artifacts
+from allura.scripts.reindex_artifacts import ReindexArtifacts
+
+
+class TestReindexArtifacts(object):
+
+    def setUp(self):
+        setup_basic_test()
+        setup_global_objects()
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        reindex_artifacts.checkpoints().remove({})
+
+    def run_script(self, options):
+        ReindexArtifacts.execute(ReindexArtifacts.parser().parse_args(options))
+
+    def partitions(self, **query):
+        return list(reindex_artifacts.checkpoints().find(query).sort('_id', 1))
+
+    def num_artifacts(self):
+        return sum(len(reindex_artifacts.partition_bounds(cls, {}, 1))
+                   for cls in reindex_artifacts.artifact_classes())
+
+    def test_artifact_classes(self):
+        classes = list(reindex_artifacts.artifact_classes())
+        assert_in(M.Post, classes)
+        assert_in(M.Thread, classes)
+        # subclasses sharing a collection are covered by their base class
+        for cls in classes:
+            assert not [base for base in classes if base is not cls and issubclass(cls, base)
+                        and base.query.mapper.collection.m.collection_name ==
+                        cls.query.mapper.collection.m.collection_name]
+
+    @patch('allura.scripts.reindex_artifacts.add_artifacts')
+    def test_reindex(self, add_artifacts):
+        num = self.num_artifacts()
+        assert num > 1
+        self.run_script(['--partition-size', '1', '--solr-hosts', 'http://a/solr,http://b/solr'])
+        parts = self.partitions()
+        assert_equal(len(parts), num)
+        assert_equal(set(p['state'] for p in parts), set(['complete']))
+        assert_equal(add_artifacts.call_count, num)
+        assert_equal(add_artifacts.call_args[1], dict(
+            update_solr=True, update_refs=True, solr_hosts=['http://a/solr', 'http://b/solr']))
+        assert M.ArtifactReference.query.find().count()
+
+    @patch('allura.scripts.reindex_artifacts.add_artifacts')
+    def test_resume(self, add_artifacts):
+        add_artifacts.side_effect = [None, Exception('crash')] + [None] * 1000
+        self.run_script(['--partition-size', '100', '--max-chunk', '1'])
+        busy = self.partitions(state='busy')
+        assert_equal(len(busy), 1)
+        assert_equal(busy[0]['done'], 1)
+        indexed, crashed = [args[0] for args, kw in add_artifacts.call_args_list[:2]]
+        add_artifacts.reset_mock()
+
+        self.run_script(['--resume', '--max-chunk', '1'])
+        assert_equal(self.partitions(state={'$ne': 'complete'}), [])
+        # the crashed chunk is done again, the one before it isn't
+        resumed = [args[0] for args, kw in add_artifacts.call_args_list]
+        assert_equal(resumed[0], crashed)
+        assert indexed not in resumed
+
+    @patch('allura.scripts.reindex_artifacts.add_artifacts')
+    def test_resume_unknown_job(self, add_artifacts):
+        self.run_script(['--resume', '--job', 'nope'])
+        assert not add_artifacts.called
+
+    @patch('allura.scripts.reindex_artifacts.add_artifacts')
+    def test_since(self, add_artifacts):
+        tomorrow = (datetime.utcnow() + timedelta(days=1)).strftime('%Y-%m-%d')
+        self.run_script(['--since', tomorrow])
+        assert_equal(self.partitions(), [])
+        assert not add_artifacts.called
+        self.run_script(['--since', '2000-01-01T00:00:00', '--refs'])
+        assert self.partitions()
+        assert_equal(add_artifacts.call_args[1], dict(update_solr=False, update_refs=True))
+
+    def test_parse_datetime(self):
+        assert_equal(reindex_artifacts.parse_datetime('2016-01-31'), datetime(2016, 1, 31))
+        assert_equal(reindex_artifacts.parse_datetime('2016-01-31T12:30:00'),
+                     datetime(2016, 1, 31, 12, 30))
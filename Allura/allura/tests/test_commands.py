@@ -15,6 +15,11 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import Queue
+import socket
+import time
+from datetime import datetime, timedelta
+
 from nose.tools import assert_raises, assert_in
 from datadiff.tools import assert_equal
 
@@ -26,7 +31,7 @@
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.command import base, script, set_neighborhood_features, \
-    create_neighborhood, show_models, taskd_cleanup
+    create_neighborhood, show_models, taskd_cleanup, taskd, smtp_server
 from allura import model as M
 from allura.lib.exceptions import InvalidNBFeatureValueError
 from allura.tests import decorators as td
@@ -376,6 +381,161 @@ def test_status_log_retries():
     assert cmd._taskd_status.mock_calls == expected_calls
 
 
+class TestTaskdCommand(object):
+
+    def setUp(self):
+        self.cmd = taskd.TaskdCommand('taskd')
+        self.cmd.stats = taskd.WorkerStats()
+        self.cmd.max_tasks = self.cmd.max_rss = 0
+
+    def test_recycle_reason(self):
+        assert_equal(self.cmd.recycle_reason(), None)
+        self.cmd.max_tasks = 2
+        self.cmd.stats.tasks = 2
+        assert_equal(self.cmd.recycle_reason(), 'handled 2 tasks')
+        self.cmd.max_tasks = 0
+        self.cmd.max_rss = 100
+        with patch.object(taskd, 'current_rss', return_value=101):
+            assert_equal(self.cmd.recycle_reason(), 'using 101MB of memory')
+        with patch.object(taskd, 'current_rss', return_value=99):
+            assert_equal(self.cmd.recycle_reason(), None)
+
+    def test_worker_stats(self):
+        start = datetime.utcnow()
+        self.cmd.stats.add(Mock(time_queue=start - timedelta(seconds=3)), start)
+        assert_equal(self.cmd.stats.tasks, 1)
+        assert_equal(self.cmd.stats.last_lag, 3)
+        assert_in('1 tasks, ', str(self.cmd.stats))
+        assert_in('last queue lag 3.0s', str(self.cmd.stats))
+
+    @patch.object(taskd, 'setproctitle')
+    @patch.object(taskd, 'os')
+    def test_supervise(self, os, setproctitle):
+        self.cmd.keep_running = True
+        self.cmd.workers = {}
+        os.fork.side_effect = [101, 102, 103]
+
+        def wait():
+            if os.fork.call_count == 3:
+                self.cmd.keep_running = False
+            return min(self.cmd.workers), 0
+        os.wait.side_effect = wait
+        self.cmd.supervise(2)
+        # 101 exited and was replaced, then everything was waited for
+        assert_equal(os.fork.call_count, 3)
+        assert_equal(os.wait.call_count, 3)
+        assert_equal(self.cmd.workers, {})
+
+
+class TestSMTPServer(object):
+
+    def setUp(self):
+        self.server = Mock(max_message_size=50, stats=smtp_server.MailServerStats())
+        self.server.process_message.return_value = None
+        self.sock, self.client = socket.socketpair()
+        self.channel = smtp_server.MailChannel(self.server, self.sock, None)
+
+    def tearDown(self):
+        self.channel.close()
+        self.client.close()
+
+    def send(self, line):
+        self.channel.collect_incoming_data(line)
+        self.channel.found_terminator()
+        return self.client.recv(4096).splitlines()[-1]
+
+    def test_max_message_size(self):
+        self.client.recv(4096)  # greeting
+        self.send('HELO example.com')
+        for i in range(2):
+            self.send('MAIL FROM:<a@example.com>')
+            self.send('RCPT TO:<b@example.com>')
+            assert_equal(self.send('DATA')[:3], '354')
+            if i == 0:
+                assert_equal(self.send('x' * 60)[:3], '552')
+                assert not self.server.process_message.called
+            else:
+                assert_equal(self.send('x' * 40), '250 Ok')
+                self.server.process_message.assert_called_once_with(
+                    '', 'a@example.com', ['b@example.com'], 'x' * 40)
+        assert_equal(self.server.stats['rejected_size'], 1)
+
+    def test_queue_full(self):
+        server = smtp_server.MailServer(('127.0.0.1', 0), None, queue=Queue.Queue(1))
+        try:
+            assert_equal(server.process_message(None, 'a@example.com', ['b@example.com'], 'hi'), None)
+            assert_in('451', server.process_message(None, 'a@example.com', ['b@example.com'], 'hi'))
+        finally:
+            server.close()
+        assert_equal(server.queue.qsize(), 1)
+        assert_equal((server.stats['accepted'], server.stats['rejected_busy']), (1, 1))
+
+    @patch('allura.tasks.mail_tasks.route_email')
+    def test_writer(self, route_email):
+        queue = Queue.Queue()
+        stats = smtp_server.MailServerStats()
+        writer = smtp_server.RouteEmailWriter(queue, stats, batch_size=2)
+        for i in range(3):
+            queue.put(dict(peer=None, mailfrom='a@example.com', rcpttos=['b@example.com'], data='%d' % i))
+        writer.start()
+        writer.stop()
+        batches = [args[0] for args, kw in route_email.post_many.call_args_list]
+        assert_equal([len(batch) for batch in batches], [2, 1])
+        assert_equal(batches[1][0], ((), dict(peer=None, mailfrom='a@example.com',
+                                              rcpttos=['b@example.com'], data=u'2')))
+        assert_equal(stats['posted'], 3)
+
+    @patch('allura.tasks.mail_tasks.route_email')
+    def test_writer_failed(self, route_email):
+        route_email.post_many.side_effect = [Exception('mongo down'), None]
+        stats = smtp_server.MailServerStats()
+        queue = Queue.Queue()
+        writer = smtp_server.RouteEmailWriter(queue, stats, batch_size=1)
+        writer.retries = 0
+        writer.retry_wait = 0.1
+        server = smtp_server.MailServer(('127.0.0.1', 0), None, queue=queue, stats=stats, writer=writer)
+        try:
+            queue.put(dict(peer=None, mailfrom='a@example.com', rcpttos=[], data=''))
+            writer.start()
+            time.sleep(0.05)
+            # held, and the server refuses mail meanwhile
+            assert writer.failing
+            assert_in('451', server.process_message(None, 'a@example.com', ['b@example.com'], 'hi'))
+            time.sleep(0.2)
+            assert not writer.failing
+            writer.stop()
+        finally:
+            server.close()
+        assert_equal(route_email.post_many.call_count, 2)
+        assert_equal((stats['posted'], stats['failed'], stats['rejected_busy']), (1, 0, 1))
+
+    @patch.object(smtp_server.base, 'log')
+    @patch('allura.tasks.mail_tasks.route_email')
+    def test_writer_gives_up_when_stopped(self, route_email, log):
+        route_email.post_many.side_effect = Exception('mongo down')
+        stats = smtp_server.MailServerStats()
+        queue = Queue.Queue()
+        writer = smtp_server.RouteEmailWriter(queue, stats, batch_size=1)
+        writer.retries = 0
+        for i in range(2):
+            queue.put(dict(peer=None, mailfrom='a@example.com', rcpttos=['b@example.com'], data='msg %d' % i))
+        writer.start()
+        time.sleep(0.05)
+        writer.stop()
+        assert_equal(stats['failed'], 2)
+        lost = [args for args, kw in log.error.call_args_list if 'lost' in args[0]]
+        assert_equal([args[-1] for args in lost], ['msg 0', 'msg 1'])
+
+    @patch.object(smtp_server.base, 'log')
+    def test_writer_stats_while_idle(self, log):
+        writer = smtp_server.RouteEmailWriter(Queue.Queue(), smtp_server.MailServerStats(),
+                                              stats_interval=0.1)
+        writer.start()
+        time.sleep(0.5)
+        writer.stop()
+        assert log.info.call_count >= 2, log.info.call_args_list
+
+
 class TestBackgroundCommand(object):
 
     cmd = 'allura.command.show_models.ReindexCommand'
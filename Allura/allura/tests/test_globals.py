@@ -76,6 +76,16 @@ def test_app_globals():
             'css/wiki.css') == '/nf/_static_/wiki/css/wiki.css', g.app_static('css/wiki.css')
 
 
+@td.with_wiki
+def test_static_fingerprint():
+    with h.push_context('test', 'wiki', neighborhood='Projects'), \
+            h.push_config(tg.config, **{'static.fingerprint': 'true'}):
+        assert re.match(r'^/nf/_static_/wiki/js/browse\.[0-9a-f]{12}\.js$', g.app_static('js/browse.js'))
+        assert re.match(r'^/nf/_static_/js/allura-base\.[0-9a-f]{12}\.js$', g.forge_static('js/allura-base.js'))
+        # not a static file, left alone
+        assert_equal(g.forge_static('images/nope.png'), '/nf/_static_/images/nope.png')
+
+
 @with_setup(setUp)
 def test_macro_projects():
     file_name = 'neo-icon-set-454545-256x350.png'
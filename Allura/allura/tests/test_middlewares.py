@@ -15,10 +15,23 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
+import gzip
+import mimetypes
+import shutil
+import tempfile
+
+from bson import BSON
 from mock import MagicMock, patch
+from ming import mim
 from datadiff.tools import assert_equal
 from nose.tools import assert_not_equal
-from allura.lib.custom_middleware import CORSMiddleware
+from timermiddleware import Timer
+from webob import Request, Response
+
+from allura.lib.custom_middleware import CORSMiddleware, AlluraTimerMiddleware, ProfileRecord
+from allura.lib.custom_middleware import StaticFilesMiddleware
+from allura.lib.static_assets import StaticAssetIndex
 
 
 class TestCORSMiddleware(object):
@@ -105,3 +118,158 @@ def test_get_access_control_request_headers(self):
         assert_equal(f({key: ''}), set())
         assert_equal(f({key: 'Authorization, Accept'}),
                      set(['authorization', 'accept']))
+
+
+class _Finder(object):
+
+    def find(self, spec):
+        return spec
+
+
+class _ProfiledMiddleware(AlluraTimerMiddleware):
+
+    def timers(self):
+        return [Timer('mongo', _Finder, 'find')]
+
+
+class TestAlluraTimerMiddleware(object):
+
+    def setUp(self):
+        def app(environ, start_response):
+            finder = _Finder()
+            finder.find({'_id': 1})
+            finder.find({'_id': 2})
+            return Response('ok')(environ, start_response)
+        self.mw = _ProfiledMiddleware(app, {
+            'stats.profile.header_token': 'sekrit',
+            'stats.profile.min_duration': '0',
+        })
+
+    def test_profile_record(self):
+        record = ProfileRecord(Request.blank('/p/test/'))
+        with record.timing('total'):
+            for i in range(2):
+                record.next_call = 'user.find(_id)'
+                with record.timing('mongo'):
+                    pass
+            with record.timing('jinja'):
+                with record.timing('solr'):
+                    pass
+        [total] = record.tree
+        assert_equal([n['name'] for n in total['children']], ['mongo', 'mongo', 'jinja'])
+        assert_equal(total['children'][2]['children'][0]['name'], 'solr')
+        assert_equal([call.get('call', call['name']) for call in record.calls],
+                     ['user.find(_id)', 'user.find(_id)', 'solr'])
+        assert_equal([r[:2] for r in record.repeated()], [('user.find(_id)', 2)])
+        assert_equal(record.counts['mongo'], 2)
+
+    @patch('allura.lib.custom_middleware.slow_requests')
+    def test_profile_by_header(self, slow_requests):
+        Request.blank('/p/test/', headers={'X-Allura-Profile': 'sekrit'}).get_response(self.mw)
+        profile = slow_requests().insert.call_args[0][0]
+        assert_equal(profile['url'], '/p/test/')
+        assert_equal(profile['trigger'], 'header')
+        assert_equal([call['call'] for call in profile['calls']], ['_Finder.find', '_Finder.find'])
+        assert_equal([r[:2] for r in profile['repeated']], [('_Finder.find', 2)])
+
+    @patch('allura.lib.custom_middleware.slow_requests')
+    def test_not_profiled(self, slow_requests):
+        Request.blank('/p/test/').get_response(self.mw)
+        Request.blank('/p/test/', headers={'X-Allura-Profile': 'wrong'}).get_response(self.mw)
+        assert not slow_requests().insert.called
+
+    @patch('allura.lib.custom_middleware.slow_requests')
+    def test_fast_requests_not_saved(self, slow_requests):
+        self.mw.profile_min_duration = 60 * 1000
+        self.mw.profile_sample_rate = 1
+        Request.blank('/p/test/').get_response(self.mw)
+        assert not slow_requests().insert.called
+        Request.blank('/p/test/', headers={'X-Allura-Profile': 'sekrit'}).get_response(self.mw)
+        assert slow_requests().insert.called
+
+    def test_profile_saved_with_dotted_timer_names(self):
+        collection = mim.Connection().db.slow_requests
+        record = ProfileRecord(Request.blank('/p/test/'))
+        with record.timing('total'):
+            with record.timing('repo.commit'):
+                pass
+        with patch('allura.lib.custom_middleware.slow_requests', return_value=collection):
+            self.mw.save_profile(record, 'header')
+        profile = collection.find_one()
+        [timing] = [t for t in profile['timings'] if t['name'] == 'repo.commit']
+        assert_equal(timing['count'], 1)
+        # as mongo (unlike mim) checks keys
+        BSON.encode(profile, check_keys=True)
+
+
+class TestStaticFilesMiddleware(object):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, 'js'))
+        with open(os.path.join(self.dir, 'js', 'foo.js'), 'w') as f:
+            f.write('var foo = 1;')
+        with open(os.path.join(self.dir, 'js', 'foo.js.gz'), 'wb') as raw:
+            gz = gzip.GzipFile('', 'wb', 9, raw)
+            gz.write('var foo = 1;')
+            gz.close()
+        self.index = StaticAssetIndex()
+        self.index.add_tree(self.dir, 'test/')
+        self.index.find_variants()
+        with patch('allura.lib.static_assets.get_index', return_value=self.index):
+            self.app = StaticFilesMiddleware(MagicMock(), '/static/')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def get(self, path, **headers):
+        return Request.blank(path, headers=headers).get_response(self.app)
+
+    def test_index(self):
+        assert_equal(self.index.files['test/js/foo.js'], os.path.join(self.dir, 'js', 'foo.js'))
+        assert_equal(self.index.variants['test/js/foo.js'],
+                     {'gzip': os.path.join(self.dir, 'js', 'foo.js.gz')})
+        assert 'js/allura-base.js' in self.index.files
+        fingerprinted = self.index.fingerprinted('test/js/foo.js')
+        assert fingerprinted.startswith('test/js/foo.')
+        assert_equal(self.index.resolve(fingerprinted), ('test/js/foo.js', True))
+        assert_equal(self.index.resolve('test/js/foo.000000000000.js'), ('test/js/foo.js', False))
+        assert_equal(self.index.resolve('test/js/bar.js'), (None, False))
+        assert_equal(self.index.fingerprinted('test/js/bar.js'), 'test/js/bar.js')
+
+    def test_serve(self):
+        r = self.get('/static/test/js/foo.js')
+        assert_equal(r.status_int, 200)
+        assert_equal(r.body, 'var foo = 1;')
+        assert_equal(r.content_type, mimetypes.guess_type('foo.js')[0])
+        assert_equal(r.content_encoding, None)
+        assert_equal(r.headers['Vary'], 'Accept-Encoding')
+        assert 'immutable' not in r.headers['Cache-Control']
+        assert_equal(r.headers['Access-Control-Allow-Origin'], '*')
+
+    def test_precompressed(self):
+        r = self.get('/static/test/js/foo.js', **{'Accept-Encoding': 'br, gzip;q=0.8'})
+        assert_equal(r.status_int, 200)
+        assert_equal(r.content_encoding, 'gzip')
+        assert_equal(r.content_type, mimetypes.guess_type('foo.js')[0])
+        r.decode_content()
+        assert_equal(r.body, 'var foo = 1;')
+
+    def test_fingerprinted(self):
+        r = self.get('/static/' + self.index.fingerprinted('test/js/foo.js'))
+        assert_equal(r.body, 'var foo = 1;')
+        assert_equal(r.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        # a stale fingerprint still gets the current file, but not forever
+        r = self.get('/static/test/js/foo.000000000000.js')
+        assert_equal(r.body, 'var foo = 1;')
+        assert_equal(r.headers['Cache-Control'], 'public, max-age=31536000')
+
+    def test_not_found(self):
+        assert_equal(self.get('/static/test/js/bar.js').status_int, 404)
+        assert_equal(self.get('/static/test/../js/foo.js').status_int, 404)
+
+    def test_not_static(self):
+        env = {'PATH_INFO': '/p/test/'}
+        start_response = MagicMock()
+        self.app(env, start_response)
+        self.app.app.assert_called_once_with(env, start_response)
@@ -17,12 +17,17 @@
 
 from pylons import tmpl_context as c
 from nose.tools import assert_equal
+from mock import patch
+import tg
 
 from ming.odm import ThreadLocalODMSession
 from allura.tests import decorators as td
 from allura.tests import TestController
 
-from allura.lib.security import Credentials, all_allowed, has_access
+from allura.lib import helpers as h
+from allura.lib import security
+from allura.lib.security import Credentials, all_allowed, has_access, filter_by_access
+from allura.lib.security import acl_principals, principals_filter
 from allura import model as M
 from forgewiki import model as WM
 
@@ -190,3 +195,80 @@ def test_deny_access_for_single_user(self):
             M.ACE.deny(M.ProjectRole.by_user(user, upsert=True)._id, 'read', 'Spammer'))
         Credentials.get().clear()
         assert not has_access(wiki, 'read', user)()
+
+    @td.with_wiki
+    def test_decision_cache(self):
+        wiki = c.project.app_instance('wiki')
+        page = WM.Page.query.get(app_config_id=wiki.config._id)
+        page2 = WM.Page(title='Other', app_config_id=wiki.config._id)
+        user = M.User.by_username('test-user')
+        user_role = M.ProjectRole.by_user(user, upsert=True)
+        ThreadLocalODMSession.flush_all()
+        Credentials.get().clear()
+        with patch('allura.lib.security._has_access', wraps=security._has_access) as evaluate:
+            assert has_access(page, 'read', user)()
+            calls = evaluate.call_count
+            # same ACLs all the way up, so the decision is reused
+            assert has_access(page2, 'read', user)()
+            assert_equal(evaluate.call_count, calls)
+        # changing an ACL doesn't need the cache cleared
+        page.acl.append(M.ACE.deny(user_role._id, 'read'))
+        assert not has_access(page, 'read', user)()
+        assert has_access(page2, 'read', user)()
+
+    @td.with_wiki
+    def test_shared_decision_cache(self):
+        wiki = c.project.app_instance('wiki')
+        user = M.User.by_username('test-user')
+        with h.push_config(tg.config, **{'security.decision_cache_size': '10'}):
+            Credentials.get().clear()
+            assert not has_access(wiki, 'admin', user)()
+            # a new request
+            Credentials.get().clear()
+            with patch('allura.lib.security._has_access') as evaluate:
+                assert not has_access(wiki, 'admin', user)()
+                assert not evaluate.called
+            # a role change means a new decision
+            _add_to_group(user, M.ProjectRole.by_name('Admin'))
+            assert has_access(wiki, 'admin', user)()
+
+    @td.with_wiki
+    def test_filter_by_access(self):
+        wiki = c.project.app_instance('wiki')
+        page = WM.Page.query.get(app_config_id=wiki.config._id)
+        hidden = WM.Page(title='Hidden', app_config_id=wiki.config._id)
+        hidden.acl = [M.DENY_ALL]
+        ThreadLocalODMSession.flush_all()
+        user = M.User.by_username('test-user')
+        assert_equal(filter_by_access([page, hidden], 'read', user), [page])
+        assert_equal(filter_by_access([page, hidden], 'read', M.User.by_username('test-admin')),
+                     [page, hidden])
+
+    @td.with_wiki
+    def test_acl_principals(self):
+        dev = M.ProjectRole.by_name('Developer')
+        user = M.ProjectRole.by_user(M.User.by_username('test-user'), upsert=True)
+        assert_equal(acl_principals([], 'read'), (['inherit'], []))
+        acl = [M.ACE.allow(dev._id, 'read'), M.ACE.allow(dev._id, 'update'), M.DENY_ALL]
+        assert_equal(acl_principals(acl, 'read'), ([str(dev._id)], []))
+        assert_equal(acl_principals(acl, 'update'), ([str(dev._id)], []))
+        assert_equal(acl_principals(acl, 'delete'), ([], []))
+        # the first entry for a role decides
+        acl = [M.ACE.deny(user._id, 'read'), M.ACE.allow(user._id, 'read'),
+               M.ACE.allow(None, 'read'), M.ACE.allow(dev._id, 'read')]
+        assert_equal(acl_principals(acl, 'read'), (['everyone'], [str(user._id)]))
+
+    @td.with_wiki
+    def test_principals_filter(self):
+        user = M.User.by_username('test-user')
+        project = c.project.root_project
+        assert_equal(principals_filter('a', 'd', M.User.by_username('test-admin'), project), [])
+        roles = Credentials.get().user_roles(user_id=user._id, project_id=project._id)
+        allowed, denied = principals_filter('a', 'd', user, project)
+        for rid in roles.reaching_ids:
+            assert str(rid) in allowed
+        assert allowed.startswith('a:(inherit OR everyone OR ')
+        assert denied.startswith('-d:(')
+        anon_fq = principals_filter('a', 'd', M.User.anonymous(), project, unindexed=True)
+        assert_equal(len(anon_fq), 1)
+        assert anon_fq[0].endswith(' OR (*:* -a:[* TO *])')
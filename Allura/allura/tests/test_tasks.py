@@ -20,15 +20,17 @@
 import operator
 import shutil
 import sys
+import tempfile
 import unittest
 from base64 import b64encode
 import logging
 
 import tg
 import mock
+from bson import ObjectId
 from pylons import tmpl_context as c, app_globals as g
 from datadiff.tools import assert_equal
-from nose.tools import assert_in
+from nose.tools import assert_in, assert_raises
 from ming.orm import FieldProperty, Mapper
 from ming.orm import ThreadLocalORMSession
 from testfixtures import LogCapture
@@ -39,6 +41,8 @@
 from allura.lib import helpers as h
 from allura.lib import search
 from allura.lib.exceptions import CompoundError
+from allura.lib.mail_util import MailSpool
+from allura.scripts import mail_spool
 from allura.tasks import event_tasks
 from allura.tasks import index_tasks
 from allura.tasks import mail_tasks
@@ -171,6 +175,25 @@ def test_add_artifacts(self):
             assert_equal(find_slinks.call_args_list,
                          [mock.call(a.index().get('text')) for a in artifacts])
 
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.log')
+    def test_add_artifacts_solr_error(self, log):
+        artifacts = [_TestArtifact() for x in range(3)]
+        for i, a in enumerate(artifacts):
+            a._shorthand_id = 't%d' % i
+            a.text = 'This is a reference to [t1]'
+        ref_ids = [M.ArtifactReference.from_artifact(a)._id for a in artifacts]
+        M.artifact_orm_session.flush()
+        with mock.patch.object(g.solr, 'add', side_effect=ValueError('solr down')), \
+                h.push_config(tg.config, **{'solr.batch_size': '2'}):
+            with assert_raises(CompoundError):
+                index_tasks.add_artifacts(ref_ids)
+        # a failed batch isn't put down to the artifacts
+        assert not log.error.called
+        M.artifact_orm_session.clear()
+        for ref_id in ref_ids:
+            assert_equal(len(M.ArtifactReference.query.get(_id=ref_id).references), 1)
+
     @td.with_wiki
     @mock.patch('allura.tasks.index_tasks.g.solr')
     def test_del_artifacts(self, solr):
@@ -213,7 +236,7 @@ def setUp(self):
 
     def test_send_email_ascii_with_user_lookup(self):
         c.user = M.User.by_username('test-admin')
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with td.mock_smtp() as _client:
             mail_tasks.sendmail(
                 fromaddr=str(c.user._id),
                 destinations=[str(c.user._id)],
@@ -236,7 +259,7 @@ def test_send_email_ascii_with_user_lookup(self):
                 '<div class="markdown_content"><p>This is a test</p></div>', body)
 
     def test_send_email_nonascii(self):
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with td.mock_smtp() as _client:
             mail_tasks.sendmail(
                 fromaddr=u'"По" <foo@bar.com>',
                 destinations=['blah@blah.com'],
@@ -269,7 +292,7 @@ def test_send_email_with_disabled_user(self):
         destination_user = M.User.by_username('test-user-1')
         destination_user.preferences['email_address'] = 'user1@mail.com'
         ThreadLocalORMSession.flush_all()
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with td.mock_smtp() as _client:
             mail_tasks.sendmail(
                 fromaddr=str(c.user._id),
                 destinations=[str(destination_user._id)],
@@ -288,7 +311,7 @@ def test_send_email_with_disabled_destination_user(self):
         destination_user.preferences['email_address'] = 'user1@mail.com'
         destination_user.disabled = True
         ThreadLocalORMSession.flush_all()
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with td.mock_smtp() as _client:
             mail_tasks.sendmail(
                 fromaddr=str(c.user._id),
                 destinations=[str(destination_user._id)],
@@ -300,7 +323,7 @@ def test_send_email_with_disabled_destination_user(self):
 
     def test_sendsimplemail_with_disabled_user(self):
         c.user = M.User.by_username('test-admin')
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with td.mock_smtp() as _client:
             mail_tasks.sendsimplemail(
                 fromaddr=str(c.user._id),
                 toaddr='test@mail.com',
@@ -329,7 +352,7 @@ def test_sendsimplemail_with_disabled_user(self):
 
     def test_email_sender_to_headers(self):
         c.user = M.User.by_username('test-admin')
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with td.mock_smtp() as _client:
             mail_tasks.sendsimplemail(
                 fromaddr=str(c.user._id),
                 toaddr='test@mail.com',
@@ -363,7 +386,7 @@ def test_email_sender_to_headers(self):
 
     def test_email_references_header(self):
         c.user = M.User.by_username('test-admin')
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with td.mock_smtp() as _client:
             mail_tasks.sendsimplemail(
                 fromaddr=str(c.user._id),
                 toaddr='test@mail.com',
@@ -395,7 +418,7 @@ def test_email_references_header(self):
 
     def test_cc(self):
         c.user = M.User.by_username('test-admin')
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with td.mock_smtp() as _client:
             mail_tasks.sendsimplemail(
                 fromaddr=str(c.user._id),
                 toaddr='test@mail.com',
@@ -411,7 +434,7 @@ def test_cc(self):
 
     def test_fromaddr_objectid_not_str(self):
         c.user = M.User.by_username('test-admin')
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with td.mock_smtp() as _client:
             mail_tasks.sendsimplemail(
                 fromaddr=c.user._id,
                 toaddr='test@mail.com',
@@ -423,6 +446,70 @@ def test_fromaddr_objectid_not_str(self):
             return_path, rcpts, body = _client.sendmail.call_args[0]
             assert_in('From: "Test Admin" <test-admin@users.localhost>', body)
 
+    def test_max_rcpts(self):
+        with td.mock_smtp() as _client, h.push_config(tg.config, smtp_max_rcpts='2'):
+            mail_tasks.sendmail(
+                fromaddr=u'foo@bar.com',
+                destinations=['a@x.com', 'b@x.com', 'c@x.com'],
+                text=u'This is a test',
+                reply_to=g.noreply,
+                subject=u'Test subject',
+                message_id=h.gen_message_id())
+            assert_equal([args[1] for args, kw in _client.sendmail.call_args_list],
+                         [['a@x.com', 'b@x.com'], ['c@x.com']])
+
+    def test_user_lookup(self):
+        admin = M.User.by_username('test-admin')
+        user = M.User.by_username('test-user')
+        user.set_pref('email_format', 'plain')
+        ThreadLocalORMSession.flush_all()
+        missing = str(ObjectId())
+        with td.mock_smtp() as _client, \
+                mock.patch.object(M.User, 'query', mock.Mock(wraps=M.User.query)) as query, \
+                LogCapture() as logs:
+            mail_tasks.sendmail(
+                fromaddr=u'foo@bar.com',
+                destinations=[str(admin._id), str(user._id), missing, 'not-an-id'],
+                text=u'This is a test',
+                reply_to=g.noreply,
+                subject=u'Test subject',
+                message_id=h.gen_message_id())
+            # users are looked up together, not one query each
+            assert not query.get.called
+            rcpts = sorted(args[1][0] for args, kw in _client.sendmail.call_args_list)
+            assert_equal(rcpts, [admin.get_pref('email_address'), user.get_pref('email_address')])
+        assert_in('Cannot find user with ID: %s' % missing, [r.getMessage() for r in logs.records])
+
+    def test_spool(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with td.mock_smtp() as _client, h.push_config(tg.config, smtp_spool_dir=tmpdir):
+                mail_tasks.sendmail(
+                    fromaddr=u'foo@bar.com',
+                    destinations=['a@x.com'],
+                    text=u'This is a test',
+                    reply_to=g.noreply,
+                    subject=u'Test subject',
+                    message_id=h.gen_message_id())
+                assert not _client.sendmail.called
+                spool = MailSpool.from_config()
+                names = spool.names()
+                assert_equal(len(names), 1)
+
+                _client.sendmail.side_effect = Exception('down')
+                assert_equal(mail_spool.send_spool(spool, mail_tasks.smtp_client), (0, 1))
+                assert_equal(spool.names(), names)
+
+                _client.sendmail.side_effect = None
+                _client.sendmail.reset_mock()
+                assert_equal(mail_spool.send_spool(spool, mail_tasks.smtp_client, threads=2), (1, 0))
+                assert_equal(spool.names(), [])
+                return_path, rcpts, body = _client.sendmail.call_args[0]
+                assert_equal(rcpts, ['a@x.com'])
+                assert_in('Subject: Test subject', body)
+        finally:
+            shutil.rmtree(tmpdir)
+
     @td.with_wiki
     def test_receive_email_ok(self):
         c.user = M.User.by_username('test-admin')
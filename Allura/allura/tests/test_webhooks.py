@@ -20,7 +20,8 @@
 import hashlib
 import datetime as dt
 
-from mock import Mock, MagicMock, patch, call
+from bson import ObjectId
+from mock import Mock, MagicMock, patch
 from nose.tools import (
     assert_raises,
     assert_equal,
@@ -39,6 +40,7 @@
     WebhookValidator,
     WebhookController,
     send_webhook,
+    send_webhooks,
     RepoPushWebhookSender,
     SendWebhookHelper,
 )
@@ -447,18 +449,18 @@ def test_log_msg(self):
     @patch('allura.webhooks.SendWebhookHelper', autospec=True)
     def test_send_webhook_task(self, swh):
         send_webhook(self.wh._id, self.payload)
-        swh.assert_called_once_with(self.wh, self.payload)
+        swh.assert_called_once_with(self.wh, self.payload, 0)
 
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send(self, log, requests):
-        requests.post.return_value = Mock(status_code=200)
+    def test_send(self, log, http_session):
+        http_session().post.return_value = Mock(status_code=200)
         self.h.sign = Mock(return_value='sha1=abc')
-        self.h.send()
+        assert self.h.send()
         headers = {'content-type': 'application/json',
                    'User-Agent': 'Allura Webhook (https://allura.apache.org/)',
                    'X-Allura-Signature': 'sha1=abc'}
-        requests.post.assert_called_once_with(
+        http_session().post.assert_called_once_with(
             self.wh.hook_url,
             data=json.dumps(self.payload),
             headers=headers,
@@ -466,48 +468,71 @@ def test_send(self, log, requests):
         log.info.assert_called_once_with(
             'Webhook successfully sent: %s %s %s' % (
                 self.wh.type, self.wh.hook_url, self.wh.app_config.url()))
+        wh = session(self.wh).refresh(self.wh)
+        assert_equal((wh.stats.attempts, wh.stats.failures, wh.stats.last_status), (1, 0, 200))
 
-    @patch('allura.webhooks.time', autospec=True)
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send_error_response_status(self, log, requests, time):
-        requests.post.return_value = Mock(status_code=500)
-        self.h.send()
-        assert_equal(requests.post.call_count, 4)  # initial call + 3 retries
-        assert_equal(time.sleep.call_args_list,
-                     [call(60), call(120), call(240)])
-        assert_equal(log.info.call_args_list, [
-            call('Retrying webhook in: %s', [60, 120, 240]),
-            call('Retrying webhook in %s seconds', 60),
-            call('Retrying webhook in %s seconds', 120),
-            call('Retrying webhook in %s seconds', 240)])
-        assert_equal(log.error.call_count, 4)
-        log.error.assert_called_with(
+    def test_send_error_response_status(self, log, http_session, send_webhook):
+        http_session().post.return_value = Mock(status_code=500)
+        assert not self.h.send()
+        # retried later by another task, rather than sleeping in this one
+        send_webhook.post.assert_called_once_with(
+            self.wh._id, self.payload, attempt=1, delay=60)
+        log.info.assert_called_once_with('Retrying webhook in %s seconds', 60)
+        log.error.assert_called_once_with(
             'Webhook send error: %s %s %s %s %s %s' % (
                 self.wh.type, self.wh.hook_url,
                 self.wh.app_config.url(),
-                requests.post.return_value.status_code,
-                requests.post.return_value.text,
-                requests.post.return_value.headers))
+                http_session().post.return_value.status_code,
+                http_session().post.return_value.text,
+                http_session().post.return_value.headers))
+        wh = session(self.wh).refresh(self.wh)
+        assert_equal((wh.stats.attempts, wh.stats.failures, wh.stats.last_status), (1, 1, 500))
+
+        send_webhook.reset_mock()
+        SendWebhookHelper(self.wh, self.payload, attempt=2).send()
+        send_webhook.post.assert_called_once_with(
+            self.wh._id, self.payload, attempt=3, delay=240)
+        send_webhook.reset_mock()
+        SendWebhookHelper(self.wh, self.payload, attempt=3).send()
+        assert_equal(send_webhook.post.call_count, 0)
+        log.error.assert_called_with(
+            'Webhook not sent after 4 attempts: %s %s %s' % (
+                self.wh.type, self.wh.hook_url, self.wh.app_config.url()))
 
-    @patch('allura.webhooks.time', autospec=True)
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send_error_no_retries(self, log, requests, time):
-        requests.post.return_value = Mock(status_code=500)
+    def test_send_error_no_retries(self, log, http_session, send_webhook):
+        http_session().post.return_value = Mock(status_code=500)
         with h.push_config(config, **{'webhook.retry': ''}):
             self.h.send()
-            assert_equal(requests.post.call_count, 1)
-            assert_equal(time.call_count, 0)
-            log.info.assert_called_once_with('Retrying webhook in: %s', [])
-            assert_equal(log.error.call_count, 1)
-            log.error.assert_called_with(
+            assert_equal(http_session().post.call_count, 1)
+            assert_equal(send_webhook.post.call_count, 0)
+            assert_equal(log.error.call_count, 2)
+            log.error.assert_any_call(
                 'Webhook send error: %s %s %s %s %s %s' % (
                     self.wh.type, self.wh.hook_url,
                     self.wh.app_config.url(),
-                    requests.post.return_value.status_code,
-                    requests.post.return_value.text,
-                    requests.post.return_value.headers))
+                    http_session().post.return_value.status_code,
+                    http_session().post.return_value.text,
+                    http_session().post.return_value.headers))
+
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
+    def test_send_webhooks_task(self, http_session, send_webhook):
+        http_session().post.side_effect = lambda url, data, **kw: Mock(
+            status_code=200 if json.loads(data)['n'] % 2 else 500)
+        payloads = [{'n': n} for n in range(5)]
+        send_webhooks([(self.wh._id, p) for p in payloads] + [(ObjectId(), {})])
+        assert_equal(http_session().post.call_count, 5)
+        # only the failed ones are retried
+        assert_equal(sorted(c[0][1]['n'] for c in send_webhook.post.call_args_list), [0, 2, 4])
+        wh = session(self.wh).refresh(self.wh)
+        assert_equal((wh.stats.attempts, wh.stats.failures), (5, 3))
+        assert wh.avg_delivery_time is not None
 
 
 class TestRepoPushWebhookSender(TestWebhookBase):
@@ -521,16 +546,17 @@ def test_send(self, send_webhook):
             self.wh._id,
             sender.get_payload.return_value)
 
+    @patch('allura.webhooks.send_webhooks', autospec=True)
     @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send_with_list(self, send_webhook):
+    def test_send_with_list(self, send_webhook, send_webhooks):
         sender = RepoPushWebhookSender()
         sender.get_payload = Mock(side_effect=[1, 2])
         self.wh.enforce_limit = Mock(return_value=True)
         with h.push_config(c, app=self.git):
             sender.send([dict(arg1=1, arg2=2), dict(arg1=3, arg2=4)])
-        assert_equal(send_webhook.post.call_count, 2)
-        assert_equal(send_webhook.post.call_args_list,
-                     [call(self.wh._id, 1), call(self.wh._id, 2)])
+        assert_equal(send_webhook.post.call_count, 0)
+        send_webhooks.post.assert_called_once_with(
+            [(self.wh._id, 1), (self.wh._id, 2)])
         assert_equal(self.wh.enforce_limit.call_count, 1)
 
     @patch('allura.webhooks.log', autospec=True)
@@ -0,0 +1,74 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import assert_equal
+
+from allura.lib.snapshot_cache import SnapshotCache
+
+
+class TestSnapshotCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = SnapshotCache(self.root, max_size=10, min_hits=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_key(self):
+        key = self.cache.key('abc', u'test-src-HEAD.zip')
+        assert_equal(key, self.cache.key('abc', 'test-src-HEAD.zip'))
+        assert key != self.cache.key('abd', u'test-src-HEAD.zip')
+        assert key != self.cache.key('abc', u'test-src-HEAD.tar.gz')
+
+    def test_store(self):
+        key = self.cache.key('abc', 'a.zip')
+        assert not self.cache.should_store(key)
+        assert self.cache.should_store(key)
+        assert_equal(self.cache.get(key), None)
+        assert_equal(list(self.cache.store(key, ['12', '34'])), ['12', '34'])
+        path = self.cache.get(key)
+        assert_equal(open(path).read(), '1234')
+        # hit count starts over once stored
+        assert not self.cache.should_store(key)
+
+    def test_store_incomplete(self):
+        key = self.cache.key('abc', 'a.zip')
+        chunks = self.cache.store(key, ['12', '34'])
+        assert_equal(chunks.next(), '12')
+        chunks.close()
+        assert_equal(self.cache.get(key), None)
+        assert_equal(os.listdir(os.path.dirname(self.cache.path(key))), [])
+
+    def test_evict(self):
+        keys = [self.cache.key(str(i), 'a.zip') for i in range(3)]
+        self.cache.max_size = 100
+        for i, key in enumerate(keys):
+            list(self.cache.store(key, ['1234']))
+            os.utime(self.cache.path(key), (i, i))
+        # least recently used goes first
+        self.cache.get(keys[0])
+        self.cache.max_size = 10
+        self.cache.evict()
+        assert self.cache.get(keys[0])
+        assert_equal(self.cache.get(keys[1]), None)
+        assert self.cache.get(keys[2])
@@ -18,13 +18,13 @@
 import unittest
 
 import mock
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
 from markupsafe import Markup
 
 from allura.lib import helpers as h
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test
-from allura.lib.solr import Solr, escape_solr_arg
+from allura.lib.solr import Solr, SolrUpdateBuffer, escape_solr_arg, is_transient_error
 from allura.lib.search import search_app, SearchIndexable
 
 
@@ -58,6 +58,69 @@ def test_add(self, pysolr):
                            commitWithin='10000', somekw='value')] * 2
         pysolr.Solr().add.assert_has_calls(calls)
 
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_add_batches(self, pysolr):
+        servers = ['server1', 'server2']
+        solr = Solr(servers, commit=False, batch_size=2)
+        solr.add([1, 2, 3, 4, 5])
+        calls = [mock.call([1, 2], commit=False)] * 2 + \
+                [mock.call([3, 4], commit=False)] * 2 + \
+                [mock.call([5], commit=False)] * 2
+        assert_equal(pysolr.Solr().add.call_args_list, calls)
+        assert_equal(solr.stats.docs, 5)
+        assert_equal(solr.stats.batches, 3)
+
+    @mock.patch('allura.lib.solr.time.sleep')
+    @mock.patch('allura.lib.solr.pysolr.Solr')
+    def test_add_retries(self, Solr_, sleep):
+        import pysolr
+        Solr_().add.side_effect = [
+            pysolr.SolrError("Failed to connect to server at 'server1'"),
+            pysolr.SolrError('Solr responded with an error (HTTP 503): busy'),
+            'ok']
+        solr = Solr(['server1'], retries=3, retry_backoff=2)
+        assert_equal(solr.add([1]), ['ok'])
+        assert_equal(sleep.call_args_list, [mock.call(2), mock.call(4)])
+        assert_equal(solr.stats.retries, 2)
+
+        # client errors aren't retried, nor are transient errors past the limit
+        Solr_().add.side_effect = pysolr.SolrError('Solr responded with an error (HTTP 400): bad')
+        with td.raises(pysolr.SolrError):
+            solr.add([1])
+        assert_equal(solr.stats.retries, 2)
+        Solr_().add.side_effect = pysolr.SolrError("Connection to server 'server1' timed out")
+        with td.raises(pysolr.SolrError):
+            solr.add([1])
+        assert_equal(solr.stats.retries, 5)
+
+    def test_is_transient_error(self):
+        import pysolr
+        assert is_transient_error(pysolr.SolrError('Solr responded with an error (HTTP 502): x'))
+        assert not is_transient_error(pysolr.SolrError('Solr responded with an error (HTTP 404): x'))
+        assert is_transient_error(pysolr.SolrError("Connection to server 'x' timed out: y"))
+
+    def test_update_buffer(self):
+        solr = mock.Mock()
+        buf = SolrUpdateBuffer(solr, size=2)
+        for doc in [1, 2, 3]:
+            buf.add(doc)
+        solr.add.assert_called_once_with([1, 2])
+        buf.flush()
+        buf.flush()
+        assert_equal(solr.add.call_args_list, [mock.call([1, 2]), mock.call([3])])
+        assert_equal(buf.sent, 3)
+
+    @mock.patch('allura.lib.solr.log')
+    def test_update_buffer_error(self, log):
+        solr = mock.Mock()
+        solr.add.side_effect = ValueError
+        buf = SolrUpdateBuffer(solr, size=2)
+        buf.add(dict(id='a'))
+        with assert_raises(ValueError):
+            buf.add(dict(id='b'))
+        log.error.assert_called_once_with('Error sending %d docs to solr: %s', 2, 'a, b')
+        assert_equal(buf.sent, 0)
+
     @mock.patch('allura.lib.solr.pysolr')
     def test_delete(self, pysolr):
         servers = ['server1', 'server2']
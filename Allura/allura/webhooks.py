@@ -15,6 +15,7 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
 import logging
 import json
 import hmac
@@ -22,6 +23,8 @@
 import time
 import socket
 import ssl
+import threading
+from multiprocessing.pool import ThreadPool
 
 import requests
 from bson import ObjectId
@@ -313,10 +316,34 @@ def _delete(self, webhook):
         return {'result': 'ok'}
 
 
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def http_session():
+    '''A process-wide :class:`requests.Session`, so that webhooks sent to the
+    same receivers reuse keep-alive connections'''
+    global _http_session
+    with _http_session_lock:
+        # don't share connections with the parent of a forked taskd worker
+        if _http_session is None or _http_session.pid != os.getpid():
+            size = asint(config.get('webhook.pool_size', 10))
+            session_ = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=size, pool_maxsize=size)
+            session_.mount('http://', adapter)
+            session_.mount('https://', adapter)
+            session_.pid = os.getpid()
+            _http_session = session_
+        return _http_session
+
+
 class SendWebhookHelper(object):
-    def __init__(self, webhook, payload):
+    def __init__(self, webhook, payload, attempt=0):
         self.webhook = webhook
         self.payload = payload
+        self.attempt = attempt
+        self.app_url = webhook.app_config.url()
 
     @property
     def timeout(self):
@@ -339,7 +366,7 @@ def log_msg(self, msg, response=None):
             msg,
             self.webhook.type,
             self.webhook.hook_url,
-            self.webhook.app_config.url())
+            self.app_url)
         if response is not None:
             message = '{} {} {} {}'.format(
                 message,
@@ -349,24 +376,46 @@ def log_msg(self, msg, response=None):
         return message
 
     def send(self):
+        '''Send the payload and record the outcome (see :meth:`finish`)'''
+        ok, status, elapsed = self.deliver()
+        self.finish(ok, status, elapsed)
+        return ok
+
+    def deliver(self):
+        '''Post the payload to the hook url.  Doesn't touch the database, so
+        that several deliveries can run in threads.
+
+        Returns a tuple of (success, HTTP status or None, seconds taken).
+        '''
         json_payload = json.dumps(self.payload, cls=DateJSONEncoder)
         signature = self.sign(json_payload)
         headers = {'content-type': 'application/json',
                    'User-Agent': 'Allura Webhook (https://allura.apache.org/)',
                    'X-Allura-Signature': signature}
-        ok = self._send(self.webhook.hook_url, json_payload, headers)
-        if not ok:
-            log.info('Retrying webhook in: %s', self.retries)
-            for t in self.retries:
-                log.info('Retrying webhook in %s seconds', t)
-                time.sleep(t)
-                ok = self._send(self.webhook.hook_url, json_payload, headers)
-                if ok:
-                    return
+        start = time.time()
+        ok, status = self._send(self.webhook.hook_url, json_payload, headers)
+        return ok, status, time.time() - start
+
+    def finish(self, ok, status, elapsed):
+        '''Record the stats of a delivery, and if it failed, post a task to
+        retry it after the next ``webhook.retry`` delay (rather than waiting
+        in this one)'''
+        self.webhook.record_delivery(ok, elapsed, status)
+        if ok:
+            return
+        retries = self.retries
+        if self.attempt < len(retries):
+            delay = retries[self.attempt]
+            log.info('Retrying webhook in %s seconds', delay)
+            send_webhook.post(self.webhook._id, self.payload,
+                              attempt=self.attempt + 1, delay=delay)
+        else:
+            log.error(self.log_msg(
+                'Webhook not sent after {} attempts'.format(self.attempt + 1)))
 
     def _send(self, url, data, headers):
         try:
-            r = requests.post(
+            r = http_session().post(
                 url,
                 data=data,
                 headers=headers,
@@ -375,19 +424,47 @@ def _send(self, url, data, headers):
                 socket.timeout,
                 ssl.SSLError):
             log.exception(self.log_msg('Webhook send error'))
-            return False
+            return False, None
         if r.status_code >= 200 and r.status_code < 300:
             log.info(self.log_msg('Webhook successfully sent'))
-            return True
+            return True, r.status_code
         else:
             log.error(self.log_msg('Webhook send error', response=r))
-            return False
+            return False, r.status_code
 
 
 @task()
-def send_webhook(webhook_id, payload):
+def send_webhook(webhook_id, payload, attempt=0):
     webhook = M.Webhook.query.get(_id=webhook_id)
-    SendWebhookHelper(webhook, payload).send()
+    if webhook is None:
+        # deleted while waiting for a retry
+        return
+    SendWebhookHelper(webhook, payload, attempt).send()
+
+
+@task()
+def send_webhooks(deliveries):
+    '''Send several webhooks at once, concurrently.
+
+    :param deliveries: list of (webhook id, payload) pairs
+    '''
+    helpers = []
+    for webhook_id, payload in deliveries:
+        webhook = M.Webhook.query.get(_id=webhook_id)
+        if webhook is not None:
+            helpers.append(SendWebhookHelper(webhook, payload))
+    size = min(len(helpers), asint(config.get('webhook.concurrency', 10)))
+    if size > 1:
+        pool = ThreadPool(size)
+        try:
+            results = pool.map(lambda helper: helper.deliver(), helpers)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [helper.deliver() for helper in helpers]
+    for helper, result in zip(helpers, results):
+        helper.finish(*result)
 
 
 class WebhookSender(object):
@@ -423,13 +500,18 @@ def send(self, params_or_list):
         if webhooks:
             payloads = [self.get_payload(**params)
                         for params in params_or_list]
+            deliveries = []
             for webhook in webhooks:
                 if webhook.enforce_limit():
                     webhook.update_limit()
                     for payload in payloads:
-                        send_webhook.post(webhook._id, payload)
+                        deliveries.append((webhook._id, payload))
                 else:
                     log.warn('Webhook fires too often: %s. Skipping', webhook)
+            if len(deliveries) == 1:
+                send_webhook.post(*deliveries[0])
+            elif deliveries:
+                send_webhooks.post(deliveries)
 
     def enforce_limit(self, app):
         '''
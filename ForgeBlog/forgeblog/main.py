@@ -18,11 +18,10 @@
 #-*- python -*-
 import logging
 import urllib2
-import json
 
 # Non-stdlib imports
 import pymongo
-from tg import config, expose, validate, redirect, flash, jsonify
+from tg import config, expose, validate, redirect, flash
 from tg.decorators import with_trailing_slash, without_trailing_slash
 from pylons import tmpl_context as c
 from pylons import app_globals as g
@@ -38,7 +37,6 @@
 from allura.app import Application, SitemapEntry, ConfigOption
 from allura.app import DefaultAdminController
 from allura.lib import helpers as h
-from allura.lib.utils import JSONForExport
 from allura.lib.search import search_app
 from allura.lib.decorators import require_post, memorable_forget
 from allura.lib.security import has_access, require_access
@@ -208,22 +206,14 @@ def uninstall(self, project):
         super(ForgeBlogApp, self).uninstall(project)
 
     def bulk_export(self, f, export_path='', with_attachments=False):
-        f.write('{"posts": [')
-        posts = list(BM.BlogPost.query.find(dict(app_config_id=self.config._id)))
-        if with_attachments:
-            GenericJSON = JSONForExport
-            self.export_attachments(posts, export_path)
-        else:
-            GenericJSON = jsonify.GenericJSON
-        for i, post in enumerate(posts):
-            if i > 0:
-                f.write(',')
-            json.dump(post, f, cls=GenericJSON, indent=2)
-        f.write(']}')
+        f.write('{"posts":')
+        self.export_artifacts(f, BM.BlogPost, dict(app_config_id=self.config._id),
+                              export_path, with_attachments)
+        f.write('}')
 
     def export_attachments(self, articles, export_path):
         for article in articles:
-            for post in article.discussion_thread.query_posts(status='ok'):
+            for post in article.discussion_thread.chronological_posts():
                 post_path = self.get_attachment_export_path(
                     export_path,
                     str(article._id),
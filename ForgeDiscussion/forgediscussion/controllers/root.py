@@ -31,7 +31,7 @@
 from webob import exc
 import pymongo
 
-from allura.lib.security import require_access, has_access, require_authenticated
+from allura.lib.security import require_access, has_access, require_authenticated, filter_by_access
 from allura.lib.search import search_app
 from allura.lib import helpers as h
 from allura.lib.utils import AntiSpam
@@ -80,7 +80,7 @@ def index(self, new_forum=False, **kw):
         forums = model.Forum.query.find(dict(
             app_config_id=c.app.config._id,
             parent_id=None, deleted=False)).all()
-        forums = [f for f in forums if h.has_access(f, 'read')()]
+        forums = filter_by_access(forums, 'read')
         return dict(forums=forums,
                     announcements=announcements,
                     hide_forum=(not new_forum))
@@ -113,6 +113,11 @@ def git_timers():
         Timer('git_lib.{method_name}', git.Repo,
               'rev_parse', 'iter_commits', 'commit'),
         Timer('git_lib.{method_name}', GM.git_repo.GitLibCmdWrapper, 'log'),
+        # every git subprocess GitPython starts goes through execute, so its
+        # call count is the number of git processes spawned by the request
+        Timer('git_lib.subprocess', git.cmd.Git, 'execute'),
+        Timer('git_lib.cat_file.{method_name}', GM.git_cat_file.CatFilePool,
+              'info', 'open', '_spawn'),
     ]
 
 
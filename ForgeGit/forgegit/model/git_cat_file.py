@@ -0,0 +1,285 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+'''
+A process-wide pool of long-lived ``git cat-file --batch`` and
+``git cat-file --batch-check`` processes, one set per repository.
+
+Every request builds a fresh GitImplementation (and so a fresh GitPython
+Repo with its own cat-file processes), so reading a couple of blobs on a
+page costs a few forks.  Going through this pool instead lets those reads
+reuse processes that are already running for the repo.
+'''
+
+import os
+import logging
+import threading
+import subprocess
+from time import time
+from collections import defaultdict, namedtuple
+
+import tg
+from paste.deploy.converters import asint
+
+log = logging.getLogger(__name__)
+
+ObjectInfo = namedtuple('ObjectInfo', ['hexsha', 'type', 'size'])
+
+
+class CatFileProcess(object):
+
+    '''A single ``git cat-file --batch[-check]`` process'''
+
+    def __init__(self, repo_path, mode):
+        self.repo_path = repo_path
+        self.mode = mode
+        self.last_used = time()
+        with open(os.devnull, 'w') as devnull:
+            self.proc = subprocess.Popen(
+                ['git', '--git-dir', repo_path, 'cat-file', '--' + mode],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=devnull,
+                close_fds=True)
+
+    @property
+    def key(self):
+        return (self.repo_path, self.mode)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def request(self, name):
+        '''
+        Send an object name and parse the header line of the response.
+
+        Returns an :class:`ObjectInfo`, or None if the object doesn't exist.
+        Raises IOError if the process has gone away.
+        '''
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        self.proc.stdin.write(name + '\n')
+        self.proc.stdin.flush()
+        line = self.proc.stdout.readline()
+        if not line:
+            raise IOError('git cat-file exited for %s' % self.repo_path)
+        line = line.rstrip('\n')
+        # "<name> missing" or "<name> ambiguous", where the name may itself
+        # contain spaces
+        if line.endswith(' missing') or line.endswith(' ambiguous'):
+            return None
+        hexsha, obj_type, size = line.rsplit(' ', 2)
+        return ObjectInfo(hexsha, obj_type, int(size))
+
+    def close(self):
+        try:
+            if self.alive():
+                self.proc.kill()
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self.proc.wait()
+        except (IOError, OSError):
+            pass
+
+
+class CatFileStream(object):
+
+    '''
+    File-like object for the contents of one object read from a ``--batch``
+    process.  The process goes back to the pool once the contents have been
+    read completely; closing the stream early discards the process, since
+    its output is no longer in a known state.
+    '''
+
+    def __init__(self, pool, proc, size):
+        self._pool = pool
+        self._proc = proc
+        self.size = size
+        self._remaining = size
+
+    def read(self, size=-1):
+        if self._proc is None or not self._remaining:
+            self._finish()
+            return ''
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._proc.proc.stdout.read(size)
+        self._remaining -= len(data)
+        if not data:
+            self.close()
+        elif not self._remaining:
+            self._finish()
+        return data
+
+    def _finish(self):
+        if self._proc is None:
+            return
+        proc, self._proc = self._proc, None
+        if self._remaining:
+            self._pool.discard(proc)
+            return
+        # contents are followed by a single LF
+        proc.proc.stdout.read(1)
+        self._pool.release(proc)
+
+    def close(self):
+        if self._proc is not None and self._remaining:
+            proc, self._proc = self._proc, None
+            self._pool.discard(proc)
+        self._finish()
+
+    def __del__(self):
+        self.close()
+
+
+class CatFilePool(object):
+
+    '''
+    Pool of cat-file processes keyed by (repo path, mode).
+
+    A process is checked out exclusively while it serves a request, so the
+    pool is safe to share between threads.  Idle processes are closed after
+    ``idle_timeout`` seconds, and at most ``max_size`` idle processes are
+    kept (the least recently used are closed first).  A process that dies
+    mid-request is replaced and the request retried once.
+    '''
+
+    def __init__(self, max_size=16, idle_timeout=300):
+        self.pid = os.getpid()
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.spawned = 0
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def info(self, repo_path, name):
+        '''Type and size of an object (any rev-parse expression), or None'''
+        for attempt in range(2):
+            proc = self.acquire(repo_path, 'batch-check')
+            try:
+                info = proc.request(name)
+            except (IOError, OSError) as e:
+                self._retry_or_raise(proc, attempt, e)
+                continue
+            except Exception:
+                # the process's output is no longer in a known state
+                self.discard(proc)
+                raise
+            self.release(proc)
+            return info
+
+    def open(self, repo_path, name):
+        '''Return a :class:`CatFileStream` of an object's contents'''
+        for attempt in range(2):
+            proc = self.acquire(repo_path, 'batch')
+            try:
+                info = proc.request(name)
+            except (IOError, OSError) as e:
+                self._retry_or_raise(proc, attempt, e)
+                continue
+            except Exception:
+                # the process's output is no longer in a known state
+                self.discard(proc)
+                raise
+            if info is None:
+                self.release(proc)
+                raise KeyError(name)
+            return CatFileStream(self, proc, info.size)
+
+    def _retry_or_raise(self, proc, attempt, error):
+        self.discard(proc)
+        if attempt:
+            raise error
+        log.warn('git cat-file --%s for %s failed (%s), restarting it',
+                 proc.mode, proc.repo_path, error)
+
+    def acquire(self, repo_path, mode):
+        with self._lock:
+            self._reap()
+            procs = self._idle.get((repo_path, mode))
+            while procs:
+                proc = procs.pop()
+                if proc.alive():
+                    return proc
+                proc.close()
+        return self._spawn(repo_path, mode)
+
+    def release(self, proc):
+        if not proc.alive():
+            proc.close()
+            return
+        proc.last_used = time()
+        with self._lock:
+            self._idle[proc.key].append(proc)
+            self._trim()
+
+    def discard(self, proc):
+        proc.close()
+
+    def _spawn(self, repo_path, mode):
+        self.spawned += 1
+        return CatFileProcess(repo_path, mode)
+
+    def _reap(self):
+        cutoff = time() - self.idle_timeout
+        for key, procs in self._idle.items():
+            keep = []
+            for proc in procs:
+                if proc.last_used < cutoff:
+                    proc.close()
+                else:
+                    keep.append(proc)
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    def _trim(self):
+        idle = sorted(
+            (proc for procs in self._idle.itervalues() for proc in procs),
+            key=lambda proc: proc.last_used)
+        for proc in idle[:max(0, len(idle) - self.max_size)]:
+            self._idle[proc.key].remove(proc)
+            proc.close()
+
+    def num_idle(self):
+        with self._lock:
+            return sum(len(procs) for procs in self._idle.itervalues())
+
+    def close_all(self):
+        with self._lock:
+            for procs in self._idle.itervalues():
+                for proc in procs:
+                    proc.close()
+            self._idle.clear()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    '''The process-wide :class:`CatFilePool`, configured from tg.config'''
+    global _pool
+    with _pool_lock:
+        # a forked process (e.g. a taskd worker) mustn't share the pipes of
+        # its parent's cat-file processes
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = CatFilePool(
+                max_size=asint(tg.config.get('scm.git.cat_file.pool_size', 16)),
+                idle_timeout=asint(tg.config.get('scm.git.cat_file.idle_timeout', 300)))
+        return _pool
@@ -36,8 +36,10 @@
 from ming.utils import LazyProperty
 
 from allura.lib import helpers as h
-from allura.model.repository import topological_sort, prefix_paths_union
+from allura.lib import utils
+from allura.model.repository import topological_sort, prefix_paths_union, stream_command
 from allura import model as M
+from forgegit.model import git_cat_file
 
 log = logging.getLogger(__name__)
 
@@ -61,6 +63,7 @@ class Repository(M.Repository):
     tool_name = 'Git'
     repo_id = 'git'
     type_s = 'Git Repository'
+    _refresh_bulk_write = True
 
     class __mongometa__:
         name = 'git-repository'
@@ -141,7 +144,7 @@ def merge(self, mr):
             shutil.rmtree(tmp_path, ignore_errors=True)
 
     def rev_to_commit_id(self, rev):
-        return self._impl.rev_parse(rev).hexsha
+        return self._impl.object_info(rev).hexsha
 
 
 class GitImplementation(M.RepositoryImplementation):
@@ -224,8 +227,8 @@ def commit(self, rev):
         if result is None:
             # find the id by branch/tag name
             try:
-                impl = self._git.rev_parse(str(rev) + '^0')
-                result = cache.get(M.repository.Commit, dict(_id=impl.hexsha))
+                info = self.object_info(str(rev) + '^0')
+                result = cache.get(M.repository.Commit, dict(_id=info.hexsha))
             except Exception:
                 url = ''
                 try:
@@ -269,9 +272,10 @@ def new_commits(self, all_commits=False):
             to_visit += obj.parents
         return list(topological_sort(graph))
 
-    def refresh_commit_info(self, oid, seen, lazy=True):
+    def refresh_commit_info(self, oid, seen, lazy=True, writer=None):
         from allura.model.repository import CommitDoc
-        ci_doc = CommitDoc.m.get(_id=oid)
+        # in bulk mode, refresh_repo has already filtered out known commits
+        ci_doc = CommitDoc.m.get(_id=oid) if writer is None else None
         if ci_doc and lazy:
             return False
         ci = self._git.rev_parse(oid)
@@ -288,7 +292,9 @@ def refresh_commit_info(self, oid, seen, lazy=True):
             message=h.really_unicode(ci.message or ''),
             child_ids=[],
             parent_ids=[p.hexsha for p in ci.parents])
-        if ci_doc:
+        if writer is not None:
+            writer.add_commit(CommitDoc(dict(args, _id=ci.hexsha)), replace=not lazy)
+        elif ci_doc:
             ci_doc.update(**args)
             ci_doc.m.save()
         else:
@@ -298,10 +304,10 @@ def refresh_commit_info(self, oid, seen, lazy=True):
             except DuplicateKeyError:
                 if lazy:
                     return False
-        self.refresh_tree_info(ci.tree, seen, lazy)
+        self.refresh_tree_info(ci.tree, seen, lazy, writer)
         return True
 
-    def refresh_tree_info(self, tree, seen, lazy=True):
+    def refresh_tree_info(self, tree, seen, lazy=True, writer=None):
         from allura.model.repository import TreeDoc
         if lazy and tree.binsha in seen:
             return
@@ -318,16 +324,45 @@ def refresh_tree_info(self, tree, seen, lazy=True):
                 name=h.really_unicode(o.name),
                 id=o.hexsha)
             if o.type == 'tree':
-                self.refresh_tree_info(o, seen, lazy)
+                self.refresh_tree_info(o, seen, lazy, writer)
                 doc.tree_ids.append(obj)
             elif o.type == 'blob':
                 doc.blob_ids.append(obj)
             else:
                 obj.type = o.type
                 doc.other_ids.append(obj)
-        doc.m.save(safe=False)
+        if writer is not None:
+            writer.insert(doc)
+        else:
+            doc.m.save(safe=False)
         return doc
 
+    def update_commit_graph(self):
+        '''
+        Write (or incrementally extend) the repo's on-disk commit-graph file,
+        including changed-path bloom filters.
+
+        With the bloom filters in place, path-limited ``git log`` walks such
+        as the one in :meth:`last_commit_ids` can skip the tree diff for
+        almost every commit that doesn't touch the requested paths.  The
+        ``--split`` mode only writes a new layer for commits added since the
+        last refresh, so this stays cheap on subsequent pushes.
+        '''
+        if not asbool(tg.config.get('scm.git.commit_graph', True)):
+            return
+        start_time = time()
+        try:
+            self._git.git.commit_graph(
+                'write', '--reachable', '--changed-paths', '--split')
+        except git.GitCommandError as e:
+            # commit-graph/--changed-paths need git 2.27+; lookups will still
+            # work without it, just slower
+            log.warn('Unable to write commit-graph for %s: %s',
+                     self._repo.full_fs_path, e)
+        else:
+            log.info('Wrote commit-graph for %s in %.2fs',
+                     self._repo.full_fs_path, time() - start_time)
+
     def log(self, revs=None, path=None, exclude=None, id_only=True, limit=None, **kw):
         """
         Returns a generator that returns information about commits reachable
@@ -471,11 +506,44 @@ def _iter_commits_with_refs(self, *args, **kwargs):
             else:
                 commit_lines.append(line)
 
+    @LazyProperty
+    def _cat_file(self):
+        '''
+        The shared pool of ``git cat-file`` processes used for object reads,
+        or None if disabled with ``scm.git.cat_file.enabled = false``.
+        '''
+        if asbool(tg.config.get('scm.git.cat_file.enabled', True)):
+            return git_cat_file.get_pool()
+        return None
+
+    def object_info(self, rev):
+        '''
+        Resolve any rev-parse expression (including ``<rev>:<path>``) to a
+        :class:`~forgegit.model.git_cat_file.ObjectInfo`.
+
+        Raises KeyError if it doesn't name an object.
+        '''
+        if self._cat_file:
+            info = self._cat_file.info(self._repo.full_fs_path, rev)
+            if info is None:
+                raise KeyError(rev)
+            return info
+        try:
+            obj = self._git.rev_parse(rev)
+        except (gitdb.exc.BadObject, ValueError, IndexError):
+            raise KeyError(rev)
+        return git_cat_file.ObjectInfo(obj.hexsha, obj.type, obj.size)
+
     def open_blob(self, blob):
+        if self._cat_file:
+            return _OpenedGitBlob(
+                self._cat_file.open(self._repo.full_fs_path, blob._id))
         return _OpenedGitBlob(
             self._object(blob._id).data_stream)
 
     def blob_size(self, blob):
+        if self._cat_file:
+            return self.object_info(blob._id).size
         return self._object(blob._id).data_stream.size
 
     def _setup_hooks(self, source_path=None):
@@ -533,11 +601,26 @@ def tarball(self, commit, path=None):
             if os.path.exists(tmpfilename):
                 os.remove(tmpfilename)
 
+    def snapshot_stream(self, commit, archive_name, fmt='zip', path=None):
+        """
+        :param path: is currently ignored, like in :meth:`tarball`
+        """
+        if isinstance(archive_name, unicode):
+            archive_name = archive_name.encode('utf-8')
+        return stream_command([
+            'git', '--git-dir', self._repo.full_fs_path, 'archive',
+            '--format=' + fmt, '--prefix=' + archive_name + '/', str(commit)])
+
     def is_empty(self):
         return not self.head
 
     def is_file(self, path, rev=None):
         path = path.strip('/')
+        if self._cat_file:
+            try:
+                return self.object_info(u'%s:%s' % (rev or 'HEAD', path)).type == 'blob'
+            except KeyError:
+                return False
         ci = self._git.rev_parse(rev)
         try:
             node = ci.tree / path
@@ -621,6 +704,73 @@ def set_default_branch(self, name):
         self._repo.default_branch_name = name
         session(self._repo).flush(self._repo)
 
+    def last_commit_ids(self, commit, paths):
+        '''
+        Return a mapping {path: commit_id} of the _id of the last
+        commit to touch each path, starting from the given commit.
+
+        All paths are resolved from a single streamed ``git log`` walk, which
+        is stopped as soon as every path has been accounted for.  Combined
+        with the changed-path bloom filters written by
+        :meth:`update_commit_graph`, this is much cheaper than the generic
+        implementation's one ``git log`` per chunk of paths.  Set
+        ``scm.git.lcd_single_walk = false`` to use the generic version.
+        '''
+        if not asbool(tg.config.get('scm.git.lcd_single_walk', True)):
+            return super(GitImplementation, self).last_commit_ids(commit, paths)
+        if not paths:
+            return {}
+        timeout = float(tg.config.get('lcd_timeout', 60))
+        start_time = time()
+        remaining = set(paths)
+        result = {}
+        proc = None
+        try:
+            proc = self._git.git.log(
+                commit._id, '--', *[p.encode('utf-8') for p in remaining],
+                pretty='format:%x00%H',
+                name_only=True,
+                as_process=True)
+            for commit_id, files in self._iter_name_only(proc.stdout):
+                # merge commits have no --name-only output, which also skips
+                # the merges that git considers to have "touched" a path
+                # without actually changing it (see _get_last_commit)
+                changed = prefix_paths_union(remaining, files)
+                for path in changed:
+                    result[path] = commit_id
+                remaining -= changed
+                if not remaining:
+                    break
+                if time() - start_time >= timeout:
+                    log.error('last_commit_ids timeout for %s on %s',
+                              commit._id, ', '.join(remaining))
+                    break
+        except Exception as e:
+            log.exception('Error in SCM last_commit_ids: %s', e)
+        finally:
+            if proc is not None:
+                _stop_process(proc)
+        return result
+
+    def _iter_name_only(self, stream):
+        '''
+        Parse ``git log --name-only --pretty=format:%x00%H`` output, yielding
+        a (commit_id, set_of_files) tuple per commit.
+        '''
+        commit_id = None
+        files = set()
+        for line in iter(stream.readline, ''):
+            line = line.rstrip('\n')
+            if line.startswith('\x00'):
+                if commit_id:
+                    yield commit_id, files
+                commit_id = line[1:]
+                files = set()
+            elif line:
+                files.add(h.really_unicode(line))
+        if commit_id:
+            yield commit_id, files
+
     def _get_last_commit(self, commit_id, paths):
         # git apparently considers merge commits to have "touched" a path
         # if the path is changed in either branch being merged, even though
@@ -649,6 +799,27 @@ def _get_last_commit(self, commit_id, paths):
         else:
             return None, set()
 
+    def lines_added(self, commit_ids, max_file_size=None):
+        cmd = ['git']
+        if max_file_size:
+            # bigger files are treated as binary, so git doesn't diff them
+            cmd += ['-c', 'core.bigFileThreshold=%d' % max_file_size]
+        cmd += ['log', '--no-walk=unsorted', '-m', '--first-parent', '--numstat',
+                '--format=format:%x00%H']
+        result = {}
+        for chunk in utils.chunked_list(list(commit_ids), 500):
+            output = self._git.git.execute(cmd + chunk)
+            for entry in output.split('\x00')[1:]:
+                lines = entry.strip().split('\n')
+                added = 0
+                for line in lines[1:]:
+                    # "<added>\t<deleted>\t<path>", or "-\t-\t<path>" for binary files
+                    count = line.split('\t', 1)[0]
+                    if count.isdigit():
+                        added += int(count)
+                result[lines[0]] = added
+        return result
+
     def get_changes(self, commit_id):
         return self._git.git.log(
             commit_id,
@@ -762,6 +933,19 @@ def merge_request_commits(self, mr):
                 id_only=False))
 
 
+def _stop_process(proc):
+    '''Stop a (possibly still streaming) git subprocess and reap it.'''
+    try:
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+    except Exception:
+        # the process may already be gone, or GitPython may complain about
+        # the non-zero status caused by the kill; neither matters here
+        pass
+
+
 class _OpenedGitBlob(object):
     CHUNK_SIZE = 4096
 
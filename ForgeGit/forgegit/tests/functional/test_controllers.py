@@ -22,6 +22,8 @@
 import os
 import shutil
 import tempfile
+from cStringIO import StringIO
+from zipfile import ZipFile
 
 from datadiff.tools import assert_equal as dd_assert_equal
 from nose.tools import assert_equal, assert_in, assert_not_in, assert_not_equal, assert_less
@@ -407,6 +409,45 @@ def test_tarball(self):
         r = self.app.get('/p/test/src-git/ci/master/tarball')
         assert 'Your download will begin shortly' in r
 
+    def test_snapshot(self):
+        r = self.app.get('/p/test/src-git/ci/master/snapshot', validate_skip=True)
+        assert_equal(r.content_type, 'application/zip')
+        name = 'test-src-git-1e146e67985dcd71c74de79613719bef7bddca4a'
+        assert_equal(r.headers['Content-Disposition'],
+                     'attachment;filename="%s.zip"' % name)
+        assert_equal(ZipFile(StringIO(r.body)).namelist(),
+                     [name + '/', name + '/README'])
+        r = self.app.get('/p/test/src-git/ci/master/snapshot?format=tar.gz', validate_skip=True)
+        assert_equal(r.content_type, 'application/x-gzip')
+        self.app.get('/p/test/src-git/ci/master/snapshot?format=rar', status=404)
+        with h.push_config(tg.config, **{'scm.repos.tarball.streaming': 'true'}):
+            r = self.app.get('/p/test/src-git/ci/master/tarball')
+            assert r.location.endswith('/p/test/src-git/ci/master/snapshot'), r.location
+
+    def test_snapshot_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with h.push_config(tg.config, **{'scm.repos.snapshot_cache.root': cache_dir,
+                                             'scm.repos.snapshot_cache.min_hits': '1'}):
+                full = self.app.get('/p/test/src-git/ci/master/snapshot', validate_skip=True).body
+                # second request is served from the cache
+                r = self.app.get('/p/test/src-git/ci/master/snapshot', validate_skip=True)
+                assert_equal(r.body, full)
+                assert_equal(r.headers['Accept-Ranges'], 'bytes')
+                assert_equal(r.headers['Content-Length'], str(len(full)))
+                r = self.app.get('/p/test/src-git/ci/master/snapshot',
+                                 headers={'Range': 'bytes=10-19'}, status=206,
+                                 validate_skip=True)
+                assert_equal(r.body, full[10:20])
+                assert_equal(r.headers['Content-Range'], 'bytes 10-19/%d' % len(full))
+                # the cached file isn't opened for a 304
+                with patch('allura.controllers.repository.open', create=True) as open_:
+                    self.app.get('/p/test/src-git/ci/master/snapshot',
+                                 headers={'If-None-Match': r.headers['ETag']}, status=304)
+                    assert not open_.called
+        finally:
+            shutil.rmtree(cache_dir)
+
     def test_tarball_link_in_subdirs(self):
         '''Go to repo subdir and check 'Download Snapshot' link'''
         self.setup_testgit_index_repo()
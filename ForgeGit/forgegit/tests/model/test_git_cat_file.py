@@ -0,0 +1,131 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import unittest
+import pkg_resources
+
+import mock
+import tg
+from nose.tools import assert_equal, assert_raises
+
+from allura.lib import helpers as h
+from forgegit import model as GM
+from forgegit.model.git_cat_file import CatFilePool
+
+
+README_ID = 'be00c63250248c284b842deee5d8fb0b8132acab'
+README_TEXT = 'This is readme\nAnother Line\n'
+
+
+class TestCatFilePool(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        self.pool = CatFilePool(max_size=2, idle_timeout=300)
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def test_info(self):
+        info = self.pool.info(self.repo_dir, 'master:README')
+        assert_equal(info, (README_ID, 'blob', len(README_TEXT)))
+        assert_equal(self.pool.info(self.repo_dir, 'master:nope'), None)
+        assert_equal(self.pool.info(self.repo_dir, 'HEAD:no such'), None)
+        assert_equal(self.pool.spawned, 1)
+
+    def test_unexpected_error_discards_process(self):
+        with mock.patch('forgegit.model.git_cat_file.ObjectInfo',
+                        side_effect=ValueError):
+            with assert_raises(ValueError):
+                self.pool.info(self.repo_dir, README_ID)
+        assert_equal(self.pool.num_idle(), 0)
+        assert_equal(self.pool.info(self.repo_dir, README_ID).hexsha, README_ID)
+
+    def test_open(self):
+        stream = self.pool.open(self.repo_dir, README_ID)
+        assert_equal(stream.read(4), 'This')
+        assert_equal(stream.read(), README_TEXT[4:])
+        assert_equal(stream.read(), '')
+        # process went back to the pool and is reused
+        assert_equal(self.pool.num_idle(), 1)
+        assert_equal(self.pool.open(self.repo_dir, README_ID).read(), README_TEXT)
+        assert_equal(self.pool.spawned, 1)
+        with assert_raises(KeyError):
+            self.pool.open(self.repo_dir, 'master:nope')
+
+    def test_close_partially_read(self):
+        stream = self.pool.open(self.repo_dir, README_ID)
+        stream.read(4)
+        stream.close()
+        assert_equal(self.pool.num_idle(), 0)
+        assert_equal(self.pool.open(self.repo_dir, README_ID).read(), README_TEXT)
+        assert_equal(self.pool.spawned, 2)
+
+    def test_crash_recovery(self):
+        self.pool.info(self.repo_dir, README_ID)
+        proc = self.pool.acquire(self.repo_dir, 'batch-check')
+        proc.proc.kill()
+        proc.proc.wait()
+        # dead before checkout: replaced when acquired
+        self.pool._idle[proc.key].append(proc)
+        assert_equal(self.pool.info(self.repo_dir, README_ID).hexsha, README_ID)
+        # dies mid-request: retried once with a new process
+        proc = self.pool.acquire(self.repo_dir, 'batch-check')
+        self.pool.release(proc)
+        with mock.patch.object(proc, 'alive', return_value=True):
+            proc.proc.kill()
+            proc.proc.wait()
+            assert_equal(self.pool.info(self.repo_dir, README_ID).hexsha, README_ID)
+        assert_equal(self.pool.spawned, 3)
+
+    def test_idle_timeout(self):
+        self.pool.info(self.repo_dir, README_ID)
+        assert_equal(self.pool.num_idle(), 1)
+        self.pool.idle_timeout = -1
+        self.pool.info(self.repo_dir, README_ID)
+        assert_equal(self.pool.spawned, 2)
+
+    def test_max_size(self):
+        streams = [self.pool.open(self.repo_dir, README_ID) for i in range(3)]
+        for stream in streams:
+            stream.read()
+        assert_equal(self.pool.num_idle(), 2)
+
+
+class TestGitImplementationCatFile(unittest.TestCase):
+
+    def setUp(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        self.impl = GM.git_repo.GitImplementation(mock.Mock(full_fs_path=repo_dir))
+
+    def test_reads(self):
+        blob = mock.Mock(_id=README_ID)
+        assert_equal(self.impl.open_blob(blob).read(), README_TEXT)
+        assert_equal(list(self.impl.open_blob(blob)), README_TEXT.splitlines(True))
+        assert_equal(self.impl.blob_size(blob), len(README_TEXT))
+        assert self.impl.is_file('/README', 'master')
+        assert not self.impl.is_file('/nope', 'master')
+        assert not self.impl.is_file('/no such', 'master')
+        assert_equal(self.impl.object_info('foo').hexsha,
+                     '1e146e67985dcd71c74de79613719bef7bddca4a')
+
+    def test_disabled(self):
+        with h.push_config(tg.config, **{'scm.git.cat_file.enabled': 'false'}):
+            assert_equal(self.impl._cat_file, None)
+            self.test_reads()
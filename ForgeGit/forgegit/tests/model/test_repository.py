@@ -24,7 +24,11 @@
 import pkg_resources
 import datetime
 import email.iterators
+import tarfile
+from cStringIO import StringIO
+from zipfile import ZipFile
 
+import bson
 import mock
 from pylons import tmpl_context as c, app_globals as g
 import tg
@@ -388,6 +392,80 @@ def test_refresh(self):
         assert commit2_loc != -1
         assert_less(commit1_loc, commit2_loc)
 
+    def test_refresh_bulk(self):
+        def snapshot():
+            return sorted(
+                (ci._id, ci.tree_id, sorted(ci.parent_ids), sorted(ci.child_ids), ci.repo_ids)
+                for ci in M.repository.CommitDoc.m.find())
+        expected = snapshot()
+        expected_trees = M.repository.TreeDoc.m.find().count()
+        M.repository.CommitDoc.m.remove({})
+        M.repository.TreeDoc.m.remove({})
+        with h.push_config(tg.config, **{'scm.refresh.bulk_min_commits': '0',
+                                         'scm.refresh.bulk_write_size': '2'}):
+            with mock.patch('allura.model.repo_refresh.BulkRefreshWriter._write',
+                            autospec=True,
+                            side_effect=M.repo_refresh.BulkRefreshWriter._write) as _write:
+                repo = GM.Repository.query.get(_id=self.repo._id)
+                repo.refresh(notify=False)
+        assert _write.called
+        assert_equal(snapshot(), expected)
+        assert_equal(M.repository.TreeDoc.m.find().count(), expected_trees)
+
+    def test_refresh_bulk_all_commits_keeps_forks(self):
+        fork_id = bson.ObjectId()
+        M.repository.CommitDoc.m.update_partial(
+            {}, {'$addToSet': dict(repo_ids=fork_id)}, multi=True)
+        with h.push_config(tg.config, **{'scm.refresh.bulk_min_commits': '0',
+                                         'scm.refresh.bulk_write_size': '2'}):
+            repo = GM.Repository.query.get(_id=self.repo._id)
+            repo.refresh(all_commits=True, notify=False)
+        for ci in M.repository.CommitDoc.m.find():
+            assert_in(fork_id, ci.repo_ids)
+            assert_in(self.repo._id, ci.repo_ids)
+
+    def test_refresh_parallel(self):
+        def snapshot():
+            return sorted(
+                (ci._id, ci.tree_id, sorted(ci.parent_ids), sorted(ci.child_ids), ci.repo_ids)
+                for ci in M.repository.CommitDoc.m.find())
+        expected = snapshot()
+        expected_trees = M.repository.TreeDoc.m.find().count()
+        M.repository.CommitDoc.m.remove({})
+        M.repository.TreeDoc.m.remove({})
+        with h.push_config(tg.config, **{'scm.refresh.parallel_chunk_size': '2'}):
+            repo = GM.Repository.query.get(_id=self.repo._id)
+            repo.refresh(notify=False)
+        tasks = M.MonQTask.query.find(dict(
+            task_name='allura.tasks.repo_tasks.refresh_commits')).all()
+        assert_equal(len(tasks), (len(expected) + 1) / 2)
+        assert_equal(set(t.state for t in tasks), set(['complete']))
+        assert_equal(snapshot(), expected)
+        assert_equal(M.repository.TreeDoc.m.find().count(), expected_trees)
+
+    def test_refresh_parallel_dead_worker(self):
+        from allura.tasks import repo_tasks
+        real_post = repo_tasks.refresh_commits.post
+
+        def post_claimed_by_dead_worker(*args, **kw):
+            task = real_post(*args, **kw)
+            task.state = 'busy'
+            task.process = 'gone pid 1'
+            session(task).flush(task)
+            return task
+        expected = sorted(ci._id for ci in M.repository.CommitDoc.m.find())
+        M.repository.CommitDoc.m.remove({})
+        with h.push_config(tg.config, **{'scm.refresh.parallel_chunk_size': '2',
+                                         'scm.refresh.parallel_chunk_timeout': '0'}):
+            with mock.patch.object(repo_tasks.refresh_commits, 'post',
+                                   side_effect=post_claimed_by_dead_worker):
+                repo = GM.Repository.query.get(_id=self.repo._id)
+                repo.refresh(notify=False)
+        tasks = M.MonQTask.query.find(dict(
+            task_name='allura.tasks.repo_tasks.refresh_commits')).all()
+        assert_equal(set(t.state for t in tasks), set(['complete']))
+        assert_equal(sorted(ci._id for ci in M.repository.CommitDoc.m.find()), expected)
+
     def test_notification_email(self):
         send_notifications(
             self.repo, ['1e146e67985dcd71c74de79613719bef7bddca4a', ])
@@ -497,6 +575,15 @@ def test_tarball(self):
         assert os.path.isfile(
             os.path.join(tmpdir, "git/t/te/test/testgit.git/test-src-git-HEAD.zip"))
 
+    def test_snapshot_stream(self):
+        data = ''.join(self.repo.snapshot_stream('HEAD'))
+        assert_equal(ZipFile(StringIO(data)).namelist(),
+                     ['test-src-git-HEAD/', 'test-src-git-HEAD/README'])
+        data = ''.join(self.repo.snapshot_stream('HEAD', 'tar.gz'))
+        tar = tarfile.open(fileobj=StringIO(data), mode='r:gz')
+        assert_equal(tar.extractfile('test-src-git-HEAD/README').read(),
+                     'This is readme\nAnother Line\n')
+
     def test_all_commit_ids(self):
         cids = list(self.repo.all_commit_ids())
         heads = [
@@ -1012,6 +1099,57 @@ def test_last_commit_ids_threaded_error(self, _git):
                 mock.Mock(_id='13951944969cf45a701bf90f83647b309815e6d5'), ['f2.txt', 'f3.txt'])
             self.assertEqual(lcds, {})
 
+    def test_last_commit_ids_chunked(self):
+        with h.push_config(tg.config, **{'scm.git.lcd_single_walk': 'false'}):
+            self.test_last_commit_ids()
+
+    def test_last_commit_ids_directory(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        repo = mock.Mock(full_fs_path=repo_dir)
+        impl = GM.git_repo.GitImplementation(repo)
+        lcds = impl.last_commit_ids(
+            mock.Mock(_id='9a7df788cf800241e3bb5a849c8870f2f8259d98'), ['a', 'a/b'])
+        self.assertEqual(lcds, {
+            'a': '9a7df788cf800241e3bb5a849c8870f2f8259d98',
+            'a/b': '9a7df788cf800241e3bb5a849c8870f2f8259d98',
+        })
+
+    def test_lines_added(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        impl = GM.git_repo.GitImplementation(mock.Mock(full_fs_path=repo_dir))
+        commit_ids = ['6a45885ae7347f1cac5103b0050cc1be6a1496c8',  # removes a line
+                      '9a7df788cf800241e3bb5a849c8870f2f8259d98',  # adds a line
+                      '1e146e67985dcd71c74de79613719bef7bddca4a']  # changes README
+        self.assertEqual(impl.lines_added(commit_ids), {
+            '6a45885ae7347f1cac5103b0050cc1be6a1496c8': 0,
+            '9a7df788cf800241e3bb5a849c8870f2f8259d98': 1,
+            '1e146e67985dcd71c74de79613719bef7bddca4a': 1,
+        })
+        # files over the size limit aren't counted
+        self.assertEqual(impl.lines_added(commit_ids, max_file_size=10)[
+            '1e146e67985dcd71c74de79613719bef7bddca4a'], 0)
+
+    def test_update_commit_graph(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        with TempDirectory() as tmp:
+            clone_dir = os.path.join(tmp.path, 'testgit.git')
+            shutil.copytree(repo_dir, clone_dir)
+            impl = GM.git_repo.GitImplementation(mock.Mock(full_fs_path=clone_dir))
+            with h.push_config(tg.config, **{'scm.git.commit_graph': 'true'}):
+                impl.update_commit_graph()
+            graphs = os.path.join(clone_dir, 'objects', 'info', 'commit-graphs')
+            assert os.listdir(graphs)
+
+    def test_update_commit_graph_disabled(self):
+        impl = GM.git_repo.GitImplementation(mock.Mock())
+        impl.__dict__['_git'] = mock.Mock()
+        with h.push_config(tg.config, **{'scm.git.commit_graph': 'false'}):
+            impl.update_commit_graph()
+        assert not impl._git.git.commit_graph.called
+
 
 class TestGitCommit(unittest.TestCase):
 
@@ -43,7 +43,7 @@
 from allura import model as M
 from allura.lib import helpers as h
 from allura.model.auth import User
-from allura.model.repository import zipdir
+from allura.model.repository import zipdir, stream_command
 from allura.model import repository as RM
 
 log = logging.getLogger(__name__)
@@ -58,6 +58,7 @@ class __mongometa__:
         name = 'svn-repository'
     branches = FieldProperty([dict(name=str, object_id=str)])
     _refresh_precompute = False
+    _refresh_bulk_write = True
 
     @LazyProperty
     def _impl(self):
@@ -348,9 +349,10 @@ def new_commits(self, all_commits=False):
             seen_oids.add(oid)
         return [o for o in oids if o not in seen_oids]
 
-    def refresh_commit_info(self, oid, seen_object_ids, lazy=True):
+    def refresh_commit_info(self, oid, seen_object_ids, lazy=True, writer=None):
         from allura.model.repository import CommitDoc
-        ci_doc = CommitDoc.m.get(_id=oid)
+        # in bulk mode, refresh_repo has already filtered out known commits
+        ci_doc = CommitDoc.m.get(_id=oid) if writer is None else None
         if ci_doc and lazy:
             return False
         revno = self._revno(oid)
@@ -381,7 +383,9 @@ def refresh_commit_info(self, oid, seen_object_ids, lazy=True):
             child_ids=[])
         if revno > 1:
             args['parent_ids'] = [self._oid(revno - 1)]
-        if ci_doc:
+        if writer is not None:
+            writer.add_commit(CommitDoc(dict(args, _id=oid)), replace=not lazy)
+        elif ci_doc:
             ci_doc.update(**args)
             ci_doc.m.save()
         else:
@@ -658,6 +662,22 @@ def last_commit_ids(self, commit, paths):
                 entries[path] = self._oid(info.last_changed_rev.number)
         return entries
 
+    def lines_added(self, commit_ids, max_file_size=None):
+        result = {}
+        for commit_id in commit_ids:
+            revno = self._revno(commit_id)
+            try:
+                diff = self._svn.diff(
+                    tg.config.get('scm.svn.tmpdir', g.tmpdir),
+                    self._url,
+                    revision1=pysvn.Revision(pysvn.opt_revision_kind.number, revno - 1),
+                    revision2=pysvn.Revision(pysvn.opt_revision_kind.number, revno))
+            except pysvn.ClientError:
+                log.info('Error diffing %s on %s', commit_id, self._url, exc_info=True)
+                continue
+            result[commit_id] = count_added_lines(diff, max_file_size)
+        return result
+
     def get_changes(self, oid):
         rev = self._revision(oid)
         try:
@@ -717,6 +737,43 @@ def tarball(self, commit, path=None):
             if os.path.exists(tmpfilename):
                 os.remove(tmpfilename)
 
+    def snapshot_stream(self, commit, archive_name, fmt='zip', path=None):
+        """
+        Exports the revision into a temporary directory, then streams an
+        archive of it (built by the zip or tar binary) while removing the
+        export once the stream is done.
+        """
+        path = self._tarball_path_clean(path, commit)
+        if not os.path.exists(self._repo.tarball_tmpdir):
+            os.makedirs(self._repo.tarball_tmpdir)
+        tmpdir = tempfile.mkdtemp(dir=self._repo.tarball_tmpdir)
+        if isinstance(archive_name, unicode):
+            archive_name = archive_name.encode('utf-8')
+        try:
+            import locale
+            locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
+            self._svn.export(os.path.join(self._url, path),
+                             os.path.join(tmpdir, archive_name),
+                             revision=pysvn.Revision(
+                                 pysvn.opt_revision_kind.number, commit),
+                             ignore_externals=True)
+        except:
+            rmtree(tmpdir, ignore_errors=True)
+            raise
+        if fmt == 'zip':
+            zipbin = tg.config.get('scm.repos.tarball.zip_binary', '/usr/bin/zip')
+            command = [zipbin, '-y', '-q', '-r', '-', archive_name]
+        else:
+            command = ['tar', '-czf', '-', archive_name]
+
+        def stream():
+            try:
+                for block in stream_command(command, cwd=tmpdir):
+                    yield block
+            finally:
+                rmtree(tmpdir, ignore_errors=True)
+        return stream()
+
     def is_empty(self):
         return self.head == 0
 
@@ -804,4 +861,28 @@ def paged_diffs(self, commit_id, start=0, end=None, onlyChangedFiles=False):
 
         return result
 
+
+def count_added_lines(diff, max_file_size=None):
+    '''Count the lines added by a unified diff of several files.  Files whose
+    part of the diff is bigger than ``max_file_size`` aren't counted.'''
+    total = 0
+    added = size = 0
+    in_hunk = False
+    for line in diff.splitlines():
+        if line.startswith('Index: '):
+            if not max_file_size or size <= max_file_size:
+                total += added
+            added = size = 0
+            in_hunk = False
+            continue
+        size += len(line) + 1
+        if line.startswith('@@'):
+            in_hunk = True
+        elif in_hunk and line.startswith('+'):
+            added += 1
+    if not max_file_size or size <= max_file_size:
+        total += added
+    return total
+
+
 Mapper.compile_all()
@@ -23,6 +23,8 @@
 from itertools import count, product
 from datetime import datetime
 from zipfile import ZipFile
+import tarfile
+from cStringIO import StringIO
 
 from collections import defaultdict
 from pylons import tmpl_context as c, app_globals as g
@@ -44,7 +46,7 @@
 from allura.tests.model.test_repo import RepoImplTestBase
 
 from forgesvn import model as SM
-from forgesvn.model.svn import svn_path_exists
+from forgesvn.model.svn import svn_path_exists, count_added_lines
 from forgesvn.tests import with_svn
 from allura.tests.decorators import with_tool
 
@@ -442,6 +444,18 @@ def test_tarball(self):
         shutil.rmtree(self.repo.tarball_path.encode('utf-8'),
                       ignore_errors=True)
 
+    @onlyif(os.path.exists(tg.config.get('scm.repos.tarball.zip_binary', '/usr/bin/zip')), 'zip binary is missing')
+    def test_snapshot_stream(self):
+        data = ''.join(self.repo.snapshot_stream('1'))
+        assert_equal(ZipFile(StringIO(data), 'r').namelist(),
+                     ['test-src-r1/', 'test-src-r1/README'])
+        data = ''.join(self.repo.snapshot_stream('1', 'tar.gz'))
+        tar = tarfile.open(fileobj=StringIO(data), mode='r:gz')
+        assert_equal(sorted(tar.getnames()), ['test-src-r1', 'test-src-r1/README'])
+        # the export is cleaned up once streamed
+        tmpdir = self.repo.tarball_tmpdir
+        assert_equal([d for d in os.listdir(tmpdir) if os.path.isdir(os.path.join(tmpdir, d))], [])
+
     @onlyif(os.path.exists(tg.config.get('scm.repos.tarball.zip_binary', '/usr/bin/zip')), 'zip binary is missing')
     def test_tarball_paths(self):
         rev = '19'
@@ -1124,3 +1138,30 @@ def test_paged_diffs(self):
             'total': 1,
         }
         assert_equals(diffs, expected)
+
+
+class TestCountAddedLines(unittest.TestCase):
+
+    diff = '\n'.join([
+        'Index: README',
+        '===================================================================',
+        '--- README\t(revision 1)',
+        '+++ README\t(revision 2)',
+        '@@ -1 +1,3 @@',
+        ' README',
+        '+++ added',
+        '+more',
+        'Index: big.txt',
+        '===================================================================',
+        '--- big.txt\t(revision 0)',
+        '+++ big.txt\t(revision 2)',
+        '@@ -0,0 +1 @@',
+        '+' + 'x' * 200,
+    ])
+
+    def test_count(self):
+        self.assertEqual(count_added_lines(self.diff), 3)
+        self.assertEqual(count_added_lines(''), 0)
+
+    def test_max_file_size(self):
+        self.assertEqual(count_added_lines(self.diff, max_file_size=200), 2)
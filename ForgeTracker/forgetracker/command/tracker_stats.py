@@ -0,0 +1,58 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+from ming.orm import ThreadLocalORMSession
+
+from allura.command import base
+from allura import model as M
+from allura.lib import exceptions as exc
+from forgetracker.model import Globals, TicketDailyStats
+
+
+class BackfillTrackerStats(base.Command):
+
+    """Works out the daily counts of trackers from before they were kept.
+
+    Usage:
+
+    paster backfill-tracker-stats ../Allura/development.ini [project_shortname]
+
+    If used with optional parameter will work out the counts of the trackers of
+    the specified project, else of all trackers in all projects.  Trackers that
+    already have counts get them worked out again.
+    """
+    group_name = 'ForgeTracker'
+    min_args = 1
+    max_args = 2
+    usage = '<ini file> [project_shortname]'
+    summary = 'Work out the daily counts of trackers from their tickets and comments'
+    parser = base.Command.standard_parser(verbose=True)
+
+    def command(self):
+        self.basic_setup()
+        query = {}
+        if len(self.args) >= 2:
+            project = M.Project.query.get(shortname=self.args[1])
+            if not project:
+                raise exc.NoSuchProjectError('The project %s '
+                                             'could not be found' % self.args[1])
+            query['app_config_id'] = {
+                '$in': [ac._id for ac in project.app_configs]}
+        for globals in Globals.query.find(query):
+            base.log.info('Working out daily counts of tracker %s',
+                          globals.app_config.url())
+            TicketDailyStats.rebuild(globals)
+            ThreadLocalORMSession.flush_all()
@@ -15,24 +15,26 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import re
 import logging
 import urllib
 import json
 import difflib
+from collections import defaultdict
 from datetime import datetime, timedelta
 from bson import ObjectId
 import os
 
 import pymongo
-from pymongo.errors import OperationFailure
+from pymongo.errors import OperationFailure, DuplicateKeyError
 from pylons import tmpl_context as c, app_globals as g
 from pprint import pformat
-from paste.deploy.converters import aslist, asbool
+from paste.deploy.converters import aslist, asbool, asint
 import jinja2
 
 from ming import schema
 from ming.utils import LazyProperty
-from ming.orm import Mapper, session
+from ming.orm import Mapper, session, mapper
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
 from ming.orm.declarative import MappedClass
 from ming.orm.ormsession import ThreadLocalORMSession
@@ -48,8 +50,10 @@
     BaseAttachment,
     Feed,
     Mailbox,
+    MonQTask,
     MovedArtifact,
     Notification,
+    Post,
     ProjectRole,
     Snapshot,
     Thread,
@@ -64,7 +68,7 @@
 )
 from allura.model.timeline import ActivityObject
 from allura.model.notification import MailFooter
-from allura.model.types import MarkdownCache, EVERYONE
+from allura.model.types import MarkdownCache, EVERYONE, ALL_PERMISSIONS
 
 from allura.lib import security
 from allura.lib.search import search_artifact, SearchError
@@ -115,6 +119,16 @@ class __mongometa__:
     # [dict(name=str,hits=int,closed=int)])
     _milestone_counts = FieldProperty(schema.Deprecated)
     _milestone_counts_expire = FieldProperty(schema.Deprecated)  # datetime)
+    # the counts of the tickets without an ACL, see milestone_counts.  They
+    # are only read and written directly in mongo, and Deprecated so that
+    # a save of a Globals loaded earlier drops them rather than putting back
+    # out of date counts
+    _milestone_counts_data = FieldProperty(schema.Deprecated)
+    _milestone_counts_updated = FieldProperty(schema.Deprecated)
+    _milestone_counts_invalidated = FieldProperty(schema.Deprecated)
+    # whether TicketDailyStats cover all of the tracker's tickets: true for
+    # trackers created since they were kept, or once they are backfilled
+    daily_stats = FieldProperty(bool, if_missing=False)
     show_in_search = FieldProperty({str: bool}, if_missing={'ticket_num': True,
                                                             'summary': True,
                                                             '_milestone': True,
@@ -189,20 +203,50 @@ def get_custom_field_solr_type(self, field_name):
 
     def update_bin_counts(self):
         # Refresh bin counts
-        self._bin_counts_data = []
-        for b in Bin.query.find(dict(
-                app_config_id=self.app_config_id)):
-            if b.terms and '$USER' in b.terms:
+        bins = [b for b in Bin.query.find(dict(app_config_id=self.app_config_id))
                 # skip queries with $USER variable, hits will be inconsistent
                 # for them
-                continue
-            r = search_artifact(Ticket, b.terms, rows=0, short_timeout=False, fq=['-deleted_b:true'])
-            hits = r is not None and r.hits or 0
-            self._bin_counts_data.append(dict(summary=b.summary, hits=hits))
+                if not (b.terms and '$USER' in b.terms)]
+        hits = self.bin_hits([b.terms for b in bins])
+        self._bin_counts_data = [dict(summary=b.summary, hits=hits.get(b.terms, 0))
+                                 for b in bins]
         self._bin_counts_expire = \
             datetime.utcnow() + timedelta(minutes=60)
         self._bin_counts_invalidated = None
 
+    def bin_hits(self, terms):
+        """Count the tickets matching each of the search ``terms`` (of bins).
+
+        All the counts come from one solr request, with a facet query for
+        each of the terms.  If that fails (e.g. on the syntax of one of
+        them), each of the terms is searched for on its own.
+
+        :returns: dict of terms to hits
+        """
+        terms = [t for t in set(terms) if t]
+        ticket = Ticket.query.find(dict(app_config_id=self.app_config_id)).first()
+        if not terms or ticket is None:
+            return {}
+        fields = ticket.index()
+        queries = dict((Ticket.translate_query(t, fields), t) for t in terms)
+        try:
+            r = search_artifact(Ticket, '*:*', rows=0, short_timeout=False, fq=['-deleted_b:true'],
+                                facet='true', **{'facet.query': queries.keys()})
+        except SearchError as e:
+            log.warn('Counting bins in one search failed, searching for each one: %s', e)
+        else:
+            facet_queries = r.facets.get('facet_queries', {}) if r is not None else {}
+            return dict((queries[q], hits) for q, hits in facet_queries.iteritems() if q in queries)
+        hits = {}
+        for t in terms:
+            try:
+                r = search_artifact(Ticket, t, rows=0, short_timeout=False, fq=['-deleted_b:true'])
+            except SearchError as e:
+                log.warn('Bin search %r failed: %s', t, e)
+                continue
+            hits[t] = r is not None and r.hits or 0
+        return hits
+
     def bin_count(self, name):
         # not sure why we expire bin counts after an hour even if unchanged
         # I guess a catch-all in case invalidate_bin_counts is missed
@@ -218,24 +262,83 @@ def milestone_count(self, name):
         d = dict(name=name, hits=0, closed=0)
         if not (fld_name and m_name):
             return d
-        mongo_query = {
-            'custom_fields.%s' % fld_name: m_name,
-            'app_config_id': self.app_config_id,
-            'deleted': False
-        }
-        d['hits'] = Ticket.query.find(dict(mongo_query, acl=[])).count()
-        d['closed'] = Ticket.query.find(dict(mongo_query, acl=[],
-                                             status={'$in': list(self.set_of_closed_status_names)})).count()
-
-        secured_tickets = Ticket.query.find(dict(mongo_query, acl={"$ne": []}))
-        if secured_tickets.count():
-            tickets = [t for t in secured_tickets if security.has_access(t, 'read')]
-            d['hits'] += len(tickets)
-            d['closed'] += sum(1 for t in tickets if t.status in self.set_of_closed_status_names)
+        d.update(self.milestone_counts().get(name, {}))
         return d
 
+    def milestone_counts(self):
+        """The numbers of tickets (hits) and of closed tickets of all the
+        milestones, as a dict keyed by 'field_name:milestone_name'.
+
+        Tickets without an ACL are counted once for everyone, until a ticket
+        changes (see invalidate_milestone_counts) or an hour has passed.  The
+        private tickets that c.user can read are counted for each request.
+        """
+        cache = mapper(Globals).collection.m.collection.find_one(
+            {'_id': self._id},
+            fields=['_milestone_counts_data', '_milestone_counts_updated']) or {}
+        updated = cache.get('_milestone_counts_updated')
+        if updated is None or updated < datetime.utcnow() - timedelta(minutes=60):
+            data = self.update_milestone_counts()
+        else:
+            data = cache.get('_milestone_counts_data') or []
+        counts = dict((d['name'], dict(hits=d['hits'], closed=d['closed']))
+                      for d in data)
+        private = dict(app_config_id=self.app_config_id, deleted=False, acl={'$ne': []})
+        private.update(Ticket.read_access_query(project=self.app_config.project.root_project))
+        for name, d in self._count_milestones(private).iteritems():
+            total = counts.setdefault(name, dict(hits=0, closed=0))
+            total['hits'] += d['hits']
+            total['closed'] += d['closed']
+        return counts
+
+    def update_milestone_counts(self):
+        """Count the tickets without an ACL, and store the counts unless they
+        were invalidated while they were counted.
+
+        :returns: the counts, as stored in _milestone_counts_data
+        """
+        started = datetime.utcnow()
+        counts = self._count_milestones(dict(app_config_id=self.app_config_id, deleted=False, acl=[]))
+        data = [dict(d, name=name) for name, d in counts.iteritems()]
+        Globals.query.update(
+            {'_id': self._id,
+             '$or': [{'_milestone_counts_invalidated': None},
+                     {'_milestone_counts_invalidated': {'$lt': started}}]},
+            {'$set': {'_milestone_counts_data': data,
+                      '_milestone_counts_updated': started}})
+        return data
+
+    def invalidate_milestone_counts(self):
+        # not through the unit of work, which would save all of this
+        # Globals, e.g. over a newer last_ticket_num
+        Globals.query.update(
+            {'_id': self._id},
+            {'$set': {'_milestone_counts_updated': None,
+                      '_milestone_counts_invalidated': datetime.utcnow()}})
+
+    def _count_milestones(self, query):
+        """Count the tickets matching ``query`` for each milestone, in one pass
+        over just their milestone fields and status."""
+        fields = ['custom_fields.%s' % fld.name for fld in self.milestone_fields]
+        counts = {}
+        if not fields:
+            return counts
+        closed = self.set_of_closed_status_names
+        tickets = mapper(Ticket).collection.m.collection.find(query, fields=fields + ['status'])
+        for t in tickets:
+            for fld_name, m_name in t.get('custom_fields', {}).iteritems():
+                if not m_name:
+                    continue
+                d = counts.setdefault('%s:%s' % (fld_name, m_name), dict(hits=0, closed=0))
+                d['hits'] += 1
+                if t.get('status') in closed:
+                    d['closed'] += 1
+        return counts
+
     def invalidate_bin_counts(self):
         '''Force expiry of bin counts and queue them to be updated.'''
+        # the milestone counts are also out of date whenever the bin counts are
+        self.invalidate_milestone_counts()
         # To prevent multiple calls to this method from piling on redundant
         # tasks, we set _bin_counts_invalidated when we post the task, and
         # the task clears it when it's done.  However, in the off chance
@@ -279,9 +382,11 @@ def move_tickets(self, ticket_ids, destination_tracker_id):
         original_ticket_nums = {t._id: t.ticket_num for t in tickets}
         users = User.query.find({'_id': {'$in': filtered.keys()}}).all()
         moved_tickets = {}
-        for ticket in tickets:
+        for i, ticket in enumerate(tickets, 1):
             moved = ticket.move(tracker, notify=False)
             moved_tickets[moved._id] = moved
+            if i % 100 == 0 or i == len(tickets):
+                MonQTask.report_progress('%d/%d tickets' % (i, len(tickets)))
         mail = dict(
             sender=c.project.app_instance(self.app_config).email_address,
             fromaddr=str(c.user.email_address_header()),
@@ -339,11 +444,7 @@ def move_tickets(self, ticket_ids, destination_tracker_id):
 
     def update_tickets(self, **post_data):
         from forgetracker.tracker_main import get_change_text, get_label
-        tickets = Ticket.query.find(dict(
-            _id={'$in': [ObjectId(id)
-                         for id in aslist(
-                             post_data['__ticket_ids'])]},
-            app_config_id=self.app_config_id)).all()
+        ticket_ids = [ObjectId(id) for id in aslist(post_data['__ticket_ids'])]
 
         fields = set(['status', 'private'])
         values = {}
@@ -380,63 +481,93 @@ def update_tickets(self, **post_data):
                 custom_values[cf.name] = v
                 custom_fields[cf.name] = cf
 
+        # users are looked up once for all the tickets: owners by id (the
+        # anonymous user has none), custom user fields by username
+        anonymous = User.anonymous()
+        users_by_id = {}
+        project_users = {}
+
+        def user_in_project(username):
+            if username not in project_users:
+                user = c.project.user_in_project(username) if username else None
+                project_users[username] = None if user == anonymous else user
+            return project_users[username]
+
+        def cf_val(ticket, cf):
+            value = ticket.custom_fields.get(cf.name)
+            return user_in_project(value) if cf.type == 'user' else value
+
         changes = {}
         changed_tickets = {}
-        for ticket in tickets:
-            message = ''
-            if labels:
-                values['labels'] = self.append_new_labels(
-                    ticket.labels, labels.split(','))
-            for k, v in sorted(values.iteritems()):
-                if k == 'deleted':
-                    if v:
-                        ticket.soft_delete()
-                        break
-                elif k == 'assigned_to_id':
-                    new_user = User.query.get(_id=v)
-                    old_user = User.query.get(_id=getattr(ticket, k))
-                    if new_user:
+        count = 0
+        chunk_size = asint(tg_config.get('forgetracker.bulk_edit.chunk_size', 100))
+        query = dict(_id={'$in': ticket_ids}, app_config_id=self.app_config_id)
+        for tickets in utils.chunked_find(Ticket, query, chunk_size):
+            user_ids = set(t.assigned_to_id for t in tickets)
+            user_ids.update(t.reported_by_id for t in tickets)
+            user_ids.add(values.get('assigned_to_id'))
+            user_ids = [_id for _id in user_ids - set(users_by_id) if _id]
+            if user_ids:
+                users_by_id.update((u._id, u) for u in User.query.find({'_id': {'$in': user_ids}}))
+            committed = []
+            for ticket in tickets:
+                message = ''
+                if labels:
+                    values['labels'] = self.append_new_labels(
+                        ticket.labels, labels.split(','))
+                for k, v in sorted(values.iteritems()):
+                    if k == 'deleted':
+                        if v:
+                            ticket.soft_delete()
+                            break
+                    elif k == 'assigned_to_id':
+                        old_id = ticket.assigned_to_id
+                        new_user = users_by_id.get(v) if v else anonymous
+                        old_user = users_by_id.get(old_id) if old_id else anonymous
+                        if new_user:
+                            message += get_change_text(
+                                get_label(k),
+                                new_user.display_name,
+                                old_user.display_name)
+                    elif k == 'private' or k == 'discussion_disabled':
+                        def _text(val):
+                            if val:
+                                return 'Yes'
+                            else:
+                                return 'No'
+
                         message += get_change_text(
                             get_label(k),
-                            new_user.display_name,
-                            old_user.display_name)
-                elif k == 'private' or k == 'discussion_disabled':
-                    def _text(val):
-                        if val:
-                            return 'Yes'
-                        else:
-                            return 'No'
-
-                    message += get_change_text(
-                        get_label(k),
-                        _text(v),
-                        _text(getattr(ticket, k)))
-                else:
+                            _text(v),
+                            _text(getattr(ticket, k)))
+                    else:
+                        message += get_change_text(
+                            get_label(k),
+                            v,
+                            getattr(ticket, k))
+                    setattr(ticket, k, v)
+                for k, v in sorted(custom_values.iteritems()):
+                    cf = custom_fields[k]
+                    old_value = cf_val(ticket, cf)
+                    if cf.type == 'boolean':
+                        v = asbool(v)
+                    ticket.custom_fields[k] = v
+                    new_value = cf_val(ticket, cf)
                     message += get_change_text(
-                        get_label(k),
-                        v,
-                        getattr(ticket, k))
-                setattr(ticket, k, v)
-            for k, v in sorted(custom_values.iteritems()):
-                def cf_val(cf):
-                    return ticket.get_custom_user(cf.name) \
-                        if cf.type == 'user' \
-                        else ticket.custom_fields.get(cf.name)
-                cf = custom_fields[k]
-                old_value = cf_val(cf)
-                if cf.type == 'boolean':
-                    v = asbool(v)
-                ticket.custom_fields[k] = v
-                new_value = cf_val(cf)
-                message += get_change_text(
-                    cf.label,
-                    new_value,
-                    old_value)
-            if message != '':
-                changes[ticket._id] = message
-                changed_tickets[ticket._id] = ticket
-                ticket.discussion_thread.post(message, notify=False, is_meta=True)
-                ticket.commit()
+                        cf.label,
+                        new_value,
+                        old_value)
+                if message != '':
+                    changes[ticket._id] = message
+                    changed_tickets[ticket._id] = ticket
+                    ticket.discussion_thread.post(message, notify=False, is_meta=True)
+                    committed.append(ticket)
+            Ticket.commit_many(committed, users_by_id)
+            # a flush per chunk writes its tickets, posts and snapshots, and
+            # queues their indexing
+            ThreadLocalORMSession.flush_all()
+            count += len(tickets)
+            MonQTask.report_progress('%d/%d tickets' % (count, len(ticket_ids)))
 
         filtered_changes = self.filtered_by_subscription(changed_tickets)
         users = User.query.find(
@@ -460,7 +591,7 @@ def changes_iter(user):
         head = []
         for f, v in sorted(values.iteritems()):
             if f == 'assigned_to_id':
-                user = User.query.get(_id=v)
+                user = users_by_id.get(v) if v else anonymous
                 v = user.display_name if user else v
             head.append('- **%s**: %s' % (get_label(f), v))
         for f, v in sorted(custom_values.iteritems()):
@@ -502,7 +633,6 @@ def changes_iter(user):
         ThreadLocalORMSession.flush_all()
         app = '%s/%s' % (c.project.shortname,
                          self.app_config.options.mount_point)
-        count = len(tickets)
         text = 'Updated {} ticket{} in {}'.format(
             count, 's' if count != 1 else '', app)
         Notification.post_user(c.user, None, 'flash', text=text)
@@ -575,6 +705,263 @@ def index(self):
         return result
 
 
+def _stats_key(name):
+    # status and milestone names can have characters mongo keys can't
+    return name.replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+
+def _stats_name(key):
+    return key.replace('%24', '$').replace('%2E', '.').replace('%25', '%')
+
+
+class TicketDailyStats(MappedClass):
+
+    """Counts for a tracker, a document per day, kept up to date as tickets
+    change so that statistics over any range of dates take a document per day
+    to work out rather than a scan over all the tickets and comments.
+
+    ``created``, ``closed`` and ``comments`` are how many tickets were created
+    and closed, and comments posted, on the day.  ``status``, ``milestone`` and
+    ``milestone_closed`` are how much the number of (not deleted) tickets in
+    each status, and in each milestone (``<field name>:<milestone>``) in all
+    and closed, changed on the day, so the numbers at the end of any day are
+    the sums up to it (see :meth:`history`).
+    """
+
+    class __mongometa__:
+        name = 'ticket_daily_stats'
+        session = project_orm_session
+        unique_indexes = [('app_config_id', 'date')]
+
+    _id = FieldProperty(schema.ObjectId)
+    app_config_id = ForeignIdProperty('AppConfig')
+    date = FieldProperty(datetime)
+    created = FieldProperty(int, if_missing=0)
+    closed = FieldProperty(int, if_missing=0)
+    comments = FieldProperty(int, if_missing=0)
+    status = FieldProperty({str: int})
+    milestone = FieldProperty({str: int})
+    milestone_closed = FieldProperty({str: int})
+
+    counters = ('created', 'closed', 'comments')
+    totals = ('status', 'milestone', 'milestone_closed')
+
+    @staticmethod
+    def day(when):
+        return datetime(when.year, when.month, when.day)
+
+    @classmethod
+    def add(cls, app_config_id, counts, when=None):
+        """Add ``counts``, e.g. ``{'created': 1, 'status.open': 1}``, to the
+        day of ``when`` (default: today)."""
+        counts = dict((k, v) for k, v in counts.iteritems() if v)
+        if not counts:
+            return
+        spec = {'app_config_id': app_config_id,
+                'date': cls.day(when or datetime.utcnow())}
+        collection = mapper(cls).collection.m.collection
+        if collection.update(spec, {'$inc': counts})['updatedExisting']:
+            return
+        # the first counts of the day, inserted whole rather than upserted as
+        # mim can't $inc "status.<name>" before there is a status document
+        doc = dict(spec, _id=ObjectId(), created=0, closed=0, comments=0)
+        doc.update((name, {}) for name in cls.totals)
+        for key, n in counts.iteritems():
+            if '.' in key:
+                name, key = key.split('.', 1)
+                doc[name][key] = n
+            else:
+                doc[key] = n
+        try:
+            collection.insert(doc)
+        except DuplicateKeyError:
+            collection.update(spec, {'$inc': counts})
+
+    @classmethod
+    def ticket_counts(cls, globals, ticket):
+        """The status and milestone counts ``ticket`` (or the data of a snapshot
+        of one) adds to in the tracker of ``globals``."""
+        counts = {}
+        if ticket.status:
+            counts['status.' + _stats_key(ticket.status)] = 1
+        closed = ticket.status in globals.set_of_closed_status_names
+        for fld in globals.milestone_fields:
+            milestone = ticket.custom_fields.get(fld['name'])
+            if milestone:
+                key = _stats_key('%s:%s' % (fld['name'], milestone))
+                counts['milestone.' + key] = 1
+                if closed:
+                    counts['milestone_closed.' + key] = 1
+        return counts
+
+    @classmethod
+    def ticket_changes(cls, globals, old=None, new=None, created=False):
+        """The changes to the counts of the tracker of ``globals`` when a ticket
+        goes from ``old`` to ``new``.  ``old`` is None for a ticket that is
+        created, moved in or undeleted, and ``new`` is None for one that is
+        moved out or deleted.
+        """
+        counts = defaultdict(int)
+        if new is not None:
+            for key, n in cls.ticket_counts(globals, new).iteritems():
+                counts[key] += n
+        if old is not None:
+            for key, n in cls.ticket_counts(globals, old).iteritems():
+                counts[key] -= n
+        closed = globals.set_of_closed_status_names
+        if new is not None and new.status in closed:
+            if old.status not in closed if old is not None else created:
+                counts['closed'] += 1
+        return counts
+
+    @classmethod
+    def ticket_changed(cls, globals, old=None, new=None, created=None):
+        """Count a ticket going from ``old`` to ``new`` (see
+        :meth:`ticket_changes`), today.
+
+        :param created: the creation date of a new ticket, to count it on
+        """
+        counts = cls.ticket_changes(globals, old, new, created is not None)
+        if created is not None:
+            counts['created'] += 1
+        cls.add(globals.app_config_id, counts, created)
+
+    @classmethod
+    def comment_posted(cls, app_config_id, when=None, n=1):
+        cls.add(app_config_id, {'comments': n}, when)
+
+    @classmethod
+    def comments_moved(cls, posts, old_app_config_id, new_app_config_id):
+        """Move the counts of the comments ``posts`` of a ticket to another
+        tracker, on the days they were posted."""
+        days = defaultdict(int)
+        for post in posts:
+            if post.status == 'ok' and not post.deleted:
+                days[cls.day(post.timestamp)] += 1
+        for day, n in days.iteritems():
+            cls.comment_posted(old_app_config_id, day, -n)
+            cls.comment_posted(new_app_config_id, day, n)
+
+    @classmethod
+    def milestone_renamed(cls, app_config_id, field_name, old_name, new_name):
+        """Move the counts of a renamed milestone to its new name, adding them
+        to any there already are under it, as the tickets are changed without
+        being counted again."""
+        old_key = _stats_key('%s:%s' % (field_name, old_name))
+        new_key = _stats_key('%s:%s' % (field_name, new_name))
+        collection = mapper(cls).collection.m.collection
+        query = {'app_config_id': app_config_id, '$or': [
+            {'%s.%s' % (name, old_key): {'$exists': True}}
+            for name in ('milestone', 'milestone_closed')]}
+        for doc in collection.find(query, fields=['milestone', 'milestone_closed']):
+            inc, unset = {}, {}
+            for name in ('milestone', 'milestone_closed'):
+                if old_key in (doc.get(name) or {}):
+                    inc['%s.%s' % (name, new_key)] = doc[name][old_key]
+                    unset['%s.%s' % (name, old_key)] = 1
+            collection.update({'_id': doc['_id']}, {'$inc': inc, '$unset': unset})
+
+    @classmethod
+    def rebuild(cls, globals):
+        """Work the counts of the tracker of ``globals`` out again from its
+        tickets, their snapshots and its comments, e.g. for a tracker from
+        before they were kept.
+
+        A ticket's changes are counted on the days of its snapshots, and a
+        deleted ticket is taken away on the day it was last modified.  Tickets
+        moved in are counted as created in this tracker.
+        """
+        app_config_id = globals.app_config_id
+        days = defaultdict(lambda: defaultdict(int))
+
+        def add(counts, when):
+            for key, n in counts.iteritems():
+                days[cls.day(when)][key] += n
+
+        for ticket in Ticket.query.find({'app_config_id': app_config_id}):
+            snapshots = TicketHistory.query.find(
+                {'artifact_id': ticket._id}).sort('version').all()
+            states = [hist.data for hist in snapshots]
+            dates = [ticket.created_date] + [hist.timestamp for hist in snapshots[1:]]
+            states.append(None if ticket.deleted else ticket)
+            dates.append(ticket.mod_date)
+            old = None
+            for i, (new, when) in enumerate(zip(states, dates)):
+                if i == 0:
+                    add({'created': 1}, when)
+                add(cls.ticket_changes(globals, old, new, i == 0), when)
+                old = new
+        for post in Post.query.find(dict(
+                discussion_id=globals.app_config.discussion_id,
+                status='ok',
+                deleted=False)):
+            add({'comments': 1}, post.timestamp)
+
+        cls.query.remove({'app_config_id': app_config_id})
+        for date, counts in days.iteritems():
+            cls.add(app_config_id, counts, date)
+        globals.daily_stats = True
+
+    @classmethod
+    def find_days(cls, app_config_id, start=None, end=None):
+        query = {'app_config_id': app_config_id}
+        if start or end:
+            query['date'] = {}
+            if start:
+                query['date']['$gte'] = cls.day(start)
+            if end:
+                query['date']['$lte'] = cls.day(end)
+        return cls.query.find(query, refresh=True, sort=[('date', 1)])
+
+    @classmethod
+    def sums(cls, app_config_id, start=None, end=None):
+        """Add up the counts of the days from ``start`` to ``end`` (either can
+        be None for no limit).  Without a ``start``, the status and milestone
+        counts are the numbers of tickets at the end of the last day.
+        """
+        result = dict((name, 0) for name in cls.counters)
+        result.update((name, defaultdict(int)) for name in cls.totals)
+        for stats in cls.find_days(app_config_id, start, end):
+            cls._add_day(result, stats)
+        return cls._result(result)
+
+    @classmethod
+    def history(cls, app_config_id, start, end):
+        """The counts of each day from ``start`` to ``end``, with the status
+        and milestone counts made the numbers of tickets at the end of the day,
+        e.g. for a burndown chart."""
+        before = cls.sums(app_config_id, end=cls.day(start) - timedelta(days=1))
+        running = dict((name, defaultdict(int, before[name])) for name in cls.totals)
+        days = dict((stats.date, stats)
+                    for stats in cls.find_days(app_config_id, start, end))
+        result = []
+        date = cls.day(start)
+        while date <= cls.day(end):
+            day = dict((name, 0) for name in cls.counters)
+            # the day's changes are added to the running totals
+            day.update(running)
+            if date in days:
+                cls._add_day(day, days[date])
+            result.append(dict(cls._result(day), date=date))
+            date += timedelta(days=1)
+        return result
+
+    @classmethod
+    def _add_day(cls, result, stats):
+        for name in cls.counters:
+            result[name] += getattr(stats, name)
+        for name in cls.totals:
+            for key, n in (getattr(stats, name) or {}).iteritems():
+                result[name][_stats_name(key)] += n
+
+    @classmethod
+    def _result(cls, result):
+        result = dict(result)
+        for name in cls.totals:
+            result[name] = dict((k, n) for k, n in result[name].iteritems() if n)
+        return result
+
+
 class Bin(Artifact, ActivityObject):
 
     class __mongometa__:
@@ -723,6 +1110,11 @@ def index(self):
         # `text`, so we're appending all other field values into `text`, to
         # match on it too.
         result['text'] += pformat(result.values())
+
+        # so searches can be filtered by read access (see paged_search)
+        allowed, denied = security.acl_principals(self.acl, 'read')
+        result['read_roles_ws'] = ' '.join(allowed)
+        result['read_denied_ws'] = ' '.join(denied)
         return result
 
     @classmethod
@@ -869,75 +1261,130 @@ def _get_discussion_disabled(self):
 
     def commit(self, **kwargs):
         VersionedArtifact.commit(self)
-        monitoring_email = self.app.config.options.get('TicketMonitoringEmail')
+        self.globals.invalidate_milestone_counts()
         if self.version > 1:
             hist = TicketHistory.query.get(
                 artifact_id=self._id, version=self.version - 1)
-            old = hist.data
-            changes = ['Ticket %s has been modified: %s' % (
-                self.ticket_num, self.summary),
-                'Edited By: %s (%s)' % (c.user.get_pref('display_name'), c.user.username)]
-            fields = [
-                ('Summary', old.summary, self.summary),
-                ('Status', old.status, self.status)]
-            if old.status != self.status and self.status in c.app.globals.set_of_closed_status_names:
-                h.log_action(log, 'closed').info('')
-                g.statsUpdater.ticketEvent(
-                    "closed", self, self.project, self.assigned_to)
-            for key in self.custom_fields:
-                fields.append(
-                    (key, old.custom_fields.get(key, ''), self.custom_fields[key]))
-            for title, o, n in fields:
-                if o != n:
-                    changes.append('%s updated: %r => %r' % (
-                        title, o, n))
-            o = hist.assigned_to
-            n = self.assigned_to
+            if not self.deleted:
+                TicketDailyStats.ticket_changed(self.globals, hist.data, self)
+            self.record_changes(hist)
+            return
+        TicketDailyStats.ticket_changed(
+            self.globals, new=self, created=self.created_date)
+        monitoring_email = self.app.config.options.get('TicketMonitoringEmail')
+        self.subscribe()
+        if self.assigned_to_id:
+            user = User.query.get(_id=self.assigned_to_id)
+            g.statsUpdater.ticketEvent(
+                "assigned", self, self.project, user)
+            self.subscribe(user=user)
+        subject = self.email_subject
+        Thread.new(discussion_id=self.app_config.discussion_id,
+                   ref_id=self.index_id())
+        # First ticket notification. Use persistend Message-ID (self.message_id()).
+        # Thus we can group notification emails in one thread later.
+        n = Notification.post(
+            message_id=self.message_id(),
+            artifact=self,
+            topic='metadata',
+            text='',
+            subject=subject)
+        if monitoring_email and n and (not self.private or
+                                       self.app.config.options.get('TicketMonitoringType') in (
+                                           'NewTicketsOnly', 'AllTicketChanges')):
+            n.send_simple(monitoring_email)
+        Feed.post(
+            self,
+            title=self.summary,
+            description=self.description,
+            author=self.reported_by,
+            pubdate=self.created_date)
+
+    @classmethod
+    def commit_many(cls, tickets, users=None):
+        """Like :meth:`commit`, for many edited (not new) tickets of a tracker
+        at once.
+
+        The snapshots are written by the next flush, and the previous ones
+        are loaded with one query.
+
+        :param users: :class:`~allura.model.auth.User` objects already loaded,
+            by id
+        """
+        if not tickets:
+            return
+        super(Ticket, cls).commit_many(tickets)
+        globals = tickets[0].globals
+        globals.invalidate_milestone_counts()
+        previous = dict(
+            (hist.artifact_id, hist) for hist in TicketHistory.query.find({
+                '$or': [{'artifact_id': t._id, 'version': t.version - 1}
+                        for t in tickets]}))
+        counts = defaultdict(int)
+        for ticket in tickets:
+            hist = previous.get(ticket._id)
+            if hist is None:
+                continue
+            if not ticket.deleted:
+                changes = TicketDailyStats.ticket_changes(
+                    globals, hist.data, ticket)
+                for key, n in changes.iteritems():
+                    counts[key] += n
+            ticket.record_changes(hist, users)
+        TicketDailyStats.add(globals.app_config_id, counts)
+
+    def record_changes(self, hist, users=None):
+        """Log, count and post to the feed the changes made since snapshot
+        ``hist``, and subscribe a new owner.
+
+        :param users: :class:`~allura.model.auth.User` objects already loaded,
+            by id
+        """
+        def get_user(user_id):
+            if users is not None and user_id in users:
+                return users[user_id]
+            return User.query.get(_id=user_id) if user_id else None
+        old = hist.data
+        changes = ['Ticket %s has been modified: %s' % (
+            self.ticket_num, self.summary),
+            'Edited By: %s (%s)' % (c.user.get_pref('display_name'), c.user.username)]
+        fields = [
+            ('Summary', old.summary, self.summary),
+            ('Status', old.status, self.status)]
+        if old.status != self.status and self.status in c.app.globals.set_of_closed_status_names:
+            h.log_action(log, 'closed').info('')
+            g.statsUpdater.ticketEvent(
+                "closed", self, self.project, get_user(self.assigned_to_id))
+        for key in self.custom_fields:
+            fields.append(
+                (key, old.custom_fields.get(key, ''), self.custom_fields[key]))
+        for title, o, n in fields:
             if o != n:
-                changes.append('Owner updated: %r => %r' % (
-                    o and o.username, n and n.username))
-                self.subscribe(user=n)
-                g.statsUpdater.ticketEvent("assigned", self, self.project, n)
-                if o:
-                    g.statsUpdater.ticketEvent(
-                        "revoked", self, self.project, o)
-            if old.description != self.description:
-                changes.append('Description updated:')
-                changes.append('\n'.join(
-                    difflib.unified_diff(
-                        a=old.description.split('\n'),
-                        b=self.description.split('\n'),
-                        fromfile='description-old',
-                        tofile='description-new')))
-            description = '\n'.join(changes)
-        else:
-            self.subscribe()
-            if self.assigned_to_id:
-                user = User.query.get(_id=self.assigned_to_id)
+                changes.append('%s updated: %r => %r' % (
+                    title, o, n))
+        o = get_user(old.assigned_to_id)
+        n = get_user(self.assigned_to_id)
+        if o != n:
+            changes.append('Owner updated: %r => %r' % (
+                o and o.username, n and n.username))
+            self.subscribe(user=n)
+            g.statsUpdater.ticketEvent("assigned", self, self.project, n)
+            if o:
                 g.statsUpdater.ticketEvent(
-                    "assigned", self, self.project, user)
-                self.subscribe(user=user)
-            description = ''
-            subject = self.email_subject
-            Thread.new(discussion_id=self.app_config.discussion_id,
-                       ref_id=self.index_id())
-            # First ticket notification. Use persistend Message-ID (self.message_id()).
-            # Thus we can group notification emails in one thread later.
-            n = Notification.post(
-                message_id=self.message_id(),
-                artifact=self,
-                topic='metadata',
-                text=description,
-                subject=subject)
-            if monitoring_email and n and (not self.private or
-                                           self.app.config.options.get('TicketMonitoringType') in (
-                                               'NewTicketsOnly', 'AllTicketChanges')):
-                n.send_simple(monitoring_email)
+                    "revoked", self, self.project, o)
+        if old.description != self.description:
+            changes.append('Description updated:')
+            changes.append('\n'.join(
+                difflib.unified_diff(
+                    a=old.description.split('\n'),
+                    b=self.description.split('\n'),
+                    fromfile='description-old',
+                    tofile='description-new')))
         Feed.post(
             self,
             title=self.summary,
-            description=description if description else self.description,
-            author=self.reported_by,
+            description='\n'.join(changes),
+            author=get_user(self.reported_by_id),
             pubdate=self.created_date)
 
     def url(self):
@@ -999,26 +1446,14 @@ def update(self, ticket_form):
             ThreadLocalORMSession.flush_all()
         self.commit()
 
-    def _move_attach(self, attachments, attach_metadata, app_config):
-        for attach in attachments:
-            attach.app_config_id = app_config._id
-            if attach.attachment_type == 'DiscussionAttachment':
-                attach.discussion_id = app_config.discussion_id
-            attach_thumb = BaseAttachment.query.get(
-                filename=attach.filename, **attach_metadata)
-            if attach_thumb:
-                if attach_thumb.attachment_type == 'DiscussionAttachment':
-                    attach_thumb.discussion_id = app_config.discussion_id
-                attach_thumb.app_config_id = app_config._id
-
     def move(self, app_config, notify=True):
         '''Move ticket from current tickets app to tickets app with given app_config'''
         app = app_config.project.app_instance(app_config)
         prior_url = self.url()
         prior_app = self.app
         prior_ticket_num = self.ticket_num
-        attachments = self.attachments
-        attach_metadata = BaseAttachment.metadata_for(self)
+        if not self.deleted:
+            TicketDailyStats.ticket_changed(prior_app.globals, old=self)
         prior_cfs = [
             (cf['name'], cf['type'], cf['label'])
             for cf in prior_app.globals.custom_fields or []]
@@ -1081,20 +1516,29 @@ def move(self, app_config, notify=True):
                     session(self).expunge(self)
                     continue
 
-        attach_metadata['type'] = 'thumbnail'
-        self._move_attach(attachments, attach_metadata, app_config)
+        # move the attachments of the ticket and of its posts, and their
+        # thumbnails, with an update for each rather than one per attachment
+        posts = self.discussion_thread.posts
+        BaseAttachment.query.update(
+            {'app_config_id': prior_app.config._id, 'artifact_id': self._id},
+            {'$set': {'app_config_id': app_config._id}},
+            multi=True)
+        if posts:
+            BaseAttachment.query.update(
+                {'post_id': {'$in': [post._id for post in posts]}},
+                {'$set': {'app_config_id': app_config._id,
+                          'discussion_id': app_config.discussion_id}},
+                multi=True)
 
         # move ticket's discussion thread, thus all new commnets will go to a
         # new ticket's feed
         self.discussion_thread.app_config_id = app_config._id
         self.discussion_thread.discussion_id = app_config.discussion_id
-        for post in self.discussion_thread.posts:
-            attach_metadata = BaseAttachment.metadata_for(post)
-            attach_metadata['type'] = 'thumbnail'
-            self._move_attach(post.attachments, attach_metadata, app_config)
+        for post in posts:
             post.app_config_id = app_config._id
             post.app_id = app_config._id
             post.discussion_id = app_config.discussion_id
+        TicketDailyStats.comments_moved(posts, prior_app.config._id, app_config._id)
 
         session(self.discussion_thread).flush(self.discussion_thread)
         # need this to reset app_config RelationProperty on ticket to a new one
@@ -1102,6 +1546,8 @@ def move(self, app_config, notify=True):
         session(self).expunge(self)
         ticket = Ticket.query.find(dict(
             app_config_id=app_config._id, ticket_num=self.ticket_num)).first()
+        if not ticket.deleted:
+            TicketDailyStats.ticket_changed(app.globals, new=ticket)
 
         # creating MovedTicket to be able to redirect from this url
         moved_ticket = MovedTicket(
@@ -1158,6 +1604,29 @@ def __json__(self, posts_limit=None, is_export=False):
                     attachments=self.attachments_for_export() if is_export else self.attachments_for_json(),
                     custom_fields=dict(self.custom_fields))
 
+    @classmethod
+    def read_access_query(cls, user=None, project=None):
+        """A mongo query for the tickets which the user can read, given they can read the tracker.
+
+        Ticket ACLs are either empty or those of private tickets, which allow
+        some roles and then deny everyone else.
+        """
+        if user is None:
+            user = c.user
+        if project is None:
+            project = c.project.root_project
+        if security.has_access(project, 'admin', user, project)():
+            return {}
+        roles = security.Credentials.get().user_roles(
+            user_id=user._id, project_id=project._id).reaching_ids
+        return {'$or': [
+            {'acl': []},
+            {'acl': {'$elemMatch': {
+                'access': ACE.ALLOW,
+                'role_id': {'$in': roles},
+                'permission': {'$in': ['read', ALL_PERMISSIONS]}}}},
+        ]}
+
     @classmethod
     def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, deleted=False, **kw):
         """
@@ -1166,8 +1635,13 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
         See also paged_search which does a solr search
         """
         limit, page, start = g.handle_paging(limit, page, default=25)
-        q = cls.query.find(
-            dict(query, app_config_id=app_config._id, deleted=deleted))
+        mongo_query = dict(query, app_config_id=app_config._id, deleted=deleted)
+        access_query = cls.read_access_query(user, app_config.project.root_project)
+        if '$or' in mongo_query and access_query:
+            mongo_query = {'$and': [mongo_query, access_query]}
+        else:
+            mongo_query.update(access_query)
+        q = cls.query.find(mongo_query)
         q = q.sort('ticket_num', pymongo.DESCENDING)
         if sort:
             field, direction = sort.split()
@@ -1179,13 +1653,8 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
             q = q.sort(field, direction)
         q = q.skip(start)
         q = q.limit(limit)
-        tickets = []
         count = q.count()
-        for t in q:
-            if security.has_access(t, 'read', user, app_config.project.root_project):
-                tickets.append(t)
-            else:
-                count = count - 1
+        tickets = q.all()
 
         return dict(
             tickets=tickets,
@@ -1200,7 +1669,9 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
         See also paged_query which does a mongo search.
 
         We do the sorting and skipping right in SOLR, before we ever ask
-        Mongo for the actual tickets.  Other keywords for
+        Mongo for the actual tickets.  The 'read' permission is checked in
+        SOLR too, with the roles indexed by Ticket.index, so pages are full
+        and the count is exact.  Other keywords for
         search_artifact (e.g., history) or for SOLR are accepted through
         kw.  The output is intended to be used directly in templates,
         e.g., exposed controller methods can just:
@@ -1222,17 +1693,21 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
         refined_sort = sort if sort else 'ticket_num_i desc'
         if 'ticket_num_i' not in refined_sort:
             refined_sort += ',ticket_num_i asc'
+        project = app_config.project.root_project if app_config else None
+        show_deleted = show_deleted and security.has_access(app_config, 'delete', user, project)()
         try:
             if q:
                 # also query for choices for filter options right away
                 params = kw.copy()
                 params.update(tsearch.FACET_PARAMS)
-                if not show_deleted:
-                    params['fq'] = ['deleted_b:False']
+                params['fq'] = [] if show_deleted else ['deleted_b:False']
+                # tickets indexed before the read roles were added still need has_access
+                params['fq'] += security.principals_filter(
+                    'read_roles_ws', 'read_denied_ws', user, project, unindexed=True)
 
                 matches = search_artifact(
                     cls, q, short_timeout=True,
-                    rows=limit, sort=refined_sort, start=start, fl='id',
+                    rows=limit, sort=refined_sort, start=start, fl='id,read_roles_ws',
                     filter=filter, **params)
             else:
                 matches = None
@@ -1244,6 +1719,8 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
             count = matches.hits
             # ticket_matches is in sorted order
             ticket_matches = [ObjectId(match['id'].split('#')[1]) for match in matches.docs]
+            unindexed = set(ObjectId(match['id'].split('#')[1]) for match in matches.docs
+                            if 'read_roles_ws' not in match)
             query = cls.query.find(
                 dict(_id={'$in': ticket_matches}))
             # so stick all the results in a dictionary...
@@ -1254,11 +1731,8 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
             tickets = []
             for t_id in ticket_matches:
                 if t_id in ticket_by_id:
-                    show_deleted = show_deleted and security.has_access(
-                        ticket_by_id[t_id], 'delete', user, app_config.project.root_project)
-                    if (security.has_access(ticket_by_id[t_id], 'read', user,
-                                            app_config.project.root_project if app_config else None) and
-                            (show_deleted or ticket_by_id[t_id].deleted == False)):
+                    if t_id not in unindexed or security.has_access(
+                            ticket_by_id[t_id], 'read', user, project)():
                         tickets.append(ticket_by_id[t_id])
                     else:
                         count = count - 1
@@ -1310,15 +1784,33 @@ def get_mail_footer(self, notification, toaddr):
             self.app.config.options.get('AllowEmailPosting', True),
             discussion_disabled=self.discussion_disabled)
 
+    def post_approved(self, post):
+        TicketDailyStats.comment_posted(self.app_config_id, post.timestamp)
+
+    def post_removed(self, post):
+        TicketDailyStats.comment_posted(self.app_config_id, post.timestamp, -1)
+
     def soft_delete(self):
         require_access(self, 'delete')
         Shortlink.query.remove(dict(ref_id=self.index_id()))
+        if not self.deleted:
+            TicketDailyStats.ticket_changed(self.globals, old=self)
         self.deleted = True
         suffix = " {dt.hour}:{dt.minute}:{dt.second} {dt.day}-{dt.month}-{dt.year}".format(
             dt=datetime.utcnow())
         self.summary += suffix
         c.app.globals.invalidate_bin_counts()
 
+    def undelete(self):
+        require_access(self, 'delete')
+        if self.deleted:
+            TicketDailyStats.ticket_changed(self.globals, new=self)
+        self.deleted = False
+        self.summary = re.sub(
+            ' \d+:\d+:\d+ \d+-\d+-\d+$', '', self.summary)
+        Shortlink.from_artifact(self)
+        c.app.globals.invalidate_bin_counts()
+
 
 class TicketAttachment(BaseAttachment):
     thumbnail_size = (100, 100)
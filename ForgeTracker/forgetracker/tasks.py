@@ -37,19 +37,27 @@ def update_bin_counts(app_config_id):
 
 @task
 def move_tickets(ticket_ids, destination_tracker_id):
-    c.app.globals.move_tickets(ticket_ids, destination_tracker_id)
+    # index all the moved tickets, posts and attachments in one batch
+    with M.session.substitute_extensions(M.artifact_orm_session,
+                                         [M.session.BatchIndexer]):
+        c.app.globals.move_tickets(ticket_ids, destination_tracker_id)
+    M.session.BatchIndexer.flush()
 
 
 @task
 def bulk_edit(**post_data):
-    try:
-        M.artifact_orm_session._get().skip_last_updated = True
-        c.app.globals.update_tickets(**post_data)
-        # manually update project's last_updated field at the end of the
-        # import instead of it being updated automatically by each artifact
-        # since long-running task can cause stale project data to be saved
-        M.Project.query.update(
-            {'_id': c.project._id},
-            {'$set': {'last_updated': datetime.utcnow()}})
-    finally:
-        M.artifact_orm_session._get().skip_last_updated = False
+    # index all the edited tickets, their posts and snapshots in one batch
+    with M.session.substitute_extensions(M.artifact_orm_session,
+                                         [M.session.BatchIndexer]):
+        try:
+            M.artifact_orm_session._get().skip_last_updated = True
+            c.app.globals.update_tickets(**post_data)
+            # manually update project's last_updated field at the end of the
+            # import instead of it being updated automatically by each artifact
+            # since long-running task can cause stale project data to be saved
+            M.Project.query.update(
+                {'_id': c.project._id},
+                {'$set': {'last_updated': datetime.utcnow()}})
+        finally:
+            M.artifact_orm_session._get().skip_last_updated = False
+    M.session.BatchIndexer.flush()
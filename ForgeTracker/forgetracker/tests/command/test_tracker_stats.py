@@ -0,0 +1,80 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+from ming.orm import ThreadLocalORMSession
+from nose.tools import assert_equal, assert_true
+import pkg_resources
+
+from alluratest.controller import setup_basic_test, setup_global_objects
+from forgetracker.command import tracker_stats
+from allura.tests.decorators import with_tracker
+from allura import model as M
+from forgetracker import model as TM
+
+
+test_config = pkg_resources.resource_filename(
+    'allura', '../test.ini') + '#main'
+
+
+def setUp(self):
+    """Method called by nose before running each test"""
+    setup_basic_test()
+    setup_global_objects()
+
+
+@with_tracker
+def create_tickets():
+    t = TM.Ticket.new()
+    t.summary = 'ticket 1'
+    t.status = 'open'
+    t.commit()
+    t.discussion_thread.add_post(text='comment 1')
+    t = TM.Ticket.new()
+    t.summary = 'ticket 2'
+    t.status = 'closed'
+    t.custom_fields['_milestone'] = '1.0'
+    t.commit()
+    t.status = 'open'
+    t.commit()
+    t = TM.Ticket.new()
+    t.summary = 'ticket 3'
+    t.status = 'open'
+    t.commit()
+    t.soft_delete()
+    ThreadLocalORMSession.flush_all()
+
+
+def test_backfill_tracker_stats():
+    create_tickets()
+    tracker = M.AppConfig.query.find({'options.mount_point': 'bugs'}).first()
+    counts = TM.TicketDailyStats.sums(tracker._id)
+    assert_equal(counts, dict(
+        created=3, closed=1, comments=1,
+        status={'open': 2},
+        milestone={'_milestone:1.0': 1},
+        milestone_closed={}))
+    TM.TicketDailyStats.query.remove({'app_config_id': tracker._id})
+    globals = TM.Globals.query.get(app_config_id=tracker._id)
+    globals.daily_stats = False
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+
+    cmd = tracker_stats.BackfillTrackerStats('backfill-tracker-stats')
+    cmd.run([test_config, 'test'])
+
+    assert_equal(TM.TicketDailyStats.sums(tracker._id), counts)
+    globals = TM.Globals.query.get(app_config_id=tracker._id)
+    assert_true(globals.daily_stats)
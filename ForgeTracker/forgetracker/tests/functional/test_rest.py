@@ -15,11 +15,14 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+from datetime import datetime, timedelta
+
 from pylons import tmpl_context as c
 
 from datadiff.tools import assert_equal
 from nose.tools import assert_not_equal
 from mock import patch
+from ming.orm import ThreadLocalORMSession
 from tg import config
 
 from allura.lib import helpers as h
@@ -197,6 +200,35 @@ def test_post(self):
         assert len(thread.json['thread']['posts']) == 2, thread.json
 
 
+class TestRestStats(TestTrackerApiBase):
+
+    def test_stats(self):
+        self.create_ticket()
+        r = self.api_get('/rest/p/test/bugs/stats')
+        days = r.json['days']
+        assert_equal(len(days), 30)
+        assert_equal(days[-1]['created'], 1)
+        assert_equal(days[-1]['status'], {'open': 1})
+        assert_equal(days[0]['created'], 0)
+
+        today = datetime.utcnow().date()
+        r = self.api_get('/rest/p/test/bugs/stats', start=str(today - timedelta(days=1)),
+                         end=str(today))
+        assert_equal([day['date'] for day in r.json['days']],
+                     [str(today - timedelta(days=1)), str(today)])
+        assert_equal(r.json['days'][0]['status'], {})
+
+    def test_stats_bad_dates(self):
+        self.api_get('/rest/p/test/bugs/stats', start='yesterday', status=400)
+        self.api_get('/rest/p/test/bugs/stats', start='2020-01-02', end='2020-01-01',
+                     status=400)
+
+    def test_stats_not_kept(self):
+        self.tracker_globals.daily_stats = False
+        ThreadLocalORMSession.flush_all()
+        self.api_get('/rest/p/test/bugs/stats', status=404)
+
+
 class TestRestSearch(TestTrackerApiBase):
 
     @property
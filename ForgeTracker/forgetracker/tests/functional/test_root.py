@@ -24,7 +24,6 @@
 import json
 import StringIO
 import allura
-import mock
 
 import PIL
 from BeautifulSoup import BeautifulSoup
@@ -419,6 +418,34 @@ def test_mass_edit(self):
         r = self.app.get('/p/test/bugs/2/')
         assert '<li><strong>Status</strong>: open --&gt; accepted</li>' in r
 
+    def test_mass_edit_chunked(self):
+        for i in range(3):
+            self.new_ticket(summary='Ticket %s' % i, status='open')
+        M.MonQTask.run_ready()
+        tickets = tm.Ticket.query.find().sort('ticket_num').all()
+        M.MonQTask.query.remove({})
+        with h.push_config(config, **{'forgetracker.bulk_edit.chunk_size': '2'}):
+            self.app.post('/p/test/bugs/update_tickets', {
+                '__search': '',
+                '__ticket_ids': [t._id for t in tickets],
+                'status': 'accepted',
+            })
+            M.MonQTask.run_ready()
+        ThreadLocalORMSession.close_all()
+        for ticket in tickets:
+            ticket = tm.Ticket.query.get(_id=ticket._id)
+            assert_equal(ticket.status, 'accepted')
+            assert_equal(ticket.get_version(-1).status, 'accepted')
+            assert_equal(ticket.get_version(-2).status, 'open')
+        task = M.MonQTask.query.get(task_name='forgetracker.tasks.bulk_edit')
+        assert_equal(task.progress, '3/3 tickets')
+        # the tickets, their posts and snapshots are indexed all together
+        index_tasks = M.MonQTask.query.find(
+            {'task_name': 'allura.tasks.index_tasks.add_artifacts'}).all()
+        assert_equal(len(index_tasks), 1)
+        r = self.app.get('/p/test/bugs/3/')
+        assert '<li><strong>Status</strong>: open --&gt; accepted</li>' in r
+
     def test_label_for_mass_edit(self):
         self.new_ticket(summary='Ticket1')
         self.new_ticket(summary='Ticket2', labels='tag1')
@@ -1217,6 +1244,29 @@ def test_milestone_rename(self):
         assert '1.0' not in ticket_view
         assert 'zzzé' in ticket_view
 
+    def test_milestone_rename_stats(self):
+        self.new_ticket(summary='ticket 1', _milestone='1.0')
+        self.new_ticket(summary='ticket 2', _milestone='2.0', status='closed')
+        self.app.post('/bugs/update_milestones', {
+            'field_name': '_milestone',
+            'milestones-0.old_name': '1.0',
+            'milestones-0.new_name': '2.0.1',
+            'milestones-0.description': '',
+            'milestones-0.complete': 'Open',
+            'milestones-0.due_date': '',
+            'milestones-1.old_name': '2.0',
+            'milestones-1.new_name': '2.x',
+            'milestones-1.description': '',
+            'milestones-1.complete': 'Open',
+            'milestones-1.due_date': '',
+        })
+        p = M.Project.query.get(shortname='test')
+        app = p.app_instance('bugs')
+        today = datetime.utcnow()
+        [day] = tm.TicketDailyStats.history(app.config._id, today, today)
+        assert_equal(day['milestone'], {'_milestone:2.0.1': 1, '_milestone:2.x': 1})
+        assert_equal(day['milestone_closed'], {'_milestone:2.x': 1})
+
     def test_milestone_close(self):
         self.new_ticket(summary='test milestone close')
         r = self.app.get('/bugs/milestones')
@@ -2385,7 +2435,7 @@ def test_rest_tickets(self):
                      'http://localhost/p/test/bugs/1/attachment/test_root.py')
 
     def test_html_escaping(self):
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with td.mock_smtp() as _client:
             self.new_ticket(summary='test <h2> ticket',
                             status='open', _milestone='2.0')
             ThreadLocalORMSession.flush_all()
@@ -3189,6 +3239,25 @@ def test_stats(self):
         r = self.app.get('/bugs/stats/', status=200)
         assert_in('# tickets: 0', r.body)
 
+        self.new_ticket(summary='ticket 1')
+        self.new_ticket(summary='ticket 2', status='closed')
+        r = self.app.get('/bugs/stats/', status=200)
+        assert_in('# tickets: 2', r.body)
+        assert_in('# open tickets: 1', r.body)
+        assert_in('# closed tickets: 1', r.body)
+        assert_in('7 days: 2', r.body)
+
+    def test_stats_not_kept(self):
+        self.new_ticket(summary='ticket 1')
+        p = M.Project.query.get(shortname='test')
+        app = p.app_instance('bugs')
+        app.globals.daily_stats = False
+        tm.TicketDailyStats.query.remove()
+        ThreadLocalORMSession.flush_all()
+        r = self.app.get('/bugs/stats/', status=200)
+        assert_in('# tickets: 1', r.body)
+        assert_in('# open tickets: 1', r.body)
+
 
 class TestNotificationEmailGrouping(TrackerTestController):
     def test_new_ticket_message_id(self):
@@ -19,14 +19,16 @@
 import json
 import operator
 import os
-
+import mock
 from nose.tools import assert_equal, assert_true
 from pylons import tmpl_context as c
+from tg import config
 from cgi import FieldStorage
 from cStringIO import StringIO
 from ming.orm import ThreadLocalORMSession
 
 from allura import model as M
+from allura.lib import helpers as h
 from allura.tests import decorators as td
 from forgetracker import model as TM
 from forgetracker.tests.functional.test_root import TrackerTestController
@@ -84,6 +86,24 @@ def test_bulk_export(self):
                                 for bin in tracker['saved_bins']]
         assert_true('Closed Tickets' in saved_bins_summaries)
 
+    def test_bulk_export_chunked(self):
+        ThreadLocalORMSession.close_all()
+        f = tempfile.TemporaryFile()
+        self.tracker.bulk_export(f)
+        f.seek(0)
+        expected = json.loads(f.read())
+        f = tempfile.TemporaryFile()
+        with h.push_config(config, **{'bulk_export.chunk_size': '1'}), \
+                mock.patch.object(M.MonQTask, 'report_progress') as report_progress:
+            self.tracker.bulk_export(f)
+        f.seek(0)
+        tracker = json.loads(f.read())
+        assert_equal(tracker, expected)
+        assert_equal(len(tracker['tickets']), 2)
+        assert_equal(report_progress.call_args_list[:2], [
+            mock.call('exported 1/2 Ticket of /p/test/bugs/'),
+            mock.call('exported 2/2 Ticket of /p/test/bugs/')])
+
     def test_export_with_attachments(self):
 
         f = tempfile.TemporaryFile()
@@ -15,17 +15,20 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import time
 from datetime import datetime, timedelta
 
 import mock
 from nose.tools import assert_equal
 from pylons import tmpl_context as c
 from ming.orm.ormsession import ThreadLocalORMSession
+from ming.orm import mapper
 
 import forgetracker
 from forgetracker.model import Globals
 from forgetracker.tests.unit import TrackerTestWithModel
 from allura.lib import helpers as h
+from allura.lib.search import SearchError
 
 
 class TestGlobalsModel(TrackerTestWithModel):
@@ -99,26 +102,132 @@ def test_invalidate_bin_counts(self, mock_dt, mock_task):
         assert_equal(gbl._bin_counts_invalidated, now)
 
     @mock.patch('forgetracker.model.ticket.Bin')
-    @mock.patch('forgetracker.model.ticket.search_artifact')
     @mock.patch('forgetracker.model.ticket.datetime')
-    def test_update_bin_counts(self, mock_dt, mock_search, mock_bin):
+    def test_update_bin_counts(self, mock_dt, mock_bin):
         now = datetime.utcnow().replace(microsecond=0)
         mock_dt.utcnow.return_value = now
         gbl = Globals()
         gbl._bin_counts_invalidated = now - timedelta(minutes=1)
         mock_bin.query.find.return_value = [
-            mock.Mock(summary='foo', terms='bar')]
-        mock_search().hits = 5
+            mock.Mock(summary='foo', terms='bar'),
+            mock.Mock(summary='mine', terms='assigned_to:$USER')]
+        gbl.bin_hits = mock.Mock(return_value={'bar': 5})
 
         assert_equal(gbl._bin_counts_data, [])  # sanity pre-check
         gbl.update_bin_counts()
         assert mock_bin.query.find.called
-        mock_search.assert_called_with(
-            forgetracker.model.Ticket, 'bar', rows=0, short_timeout=False, fq=['-deleted_b:true'])
+        gbl.bin_hits.assert_called_once_with(['bar'])
         assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5}])
         assert_equal(gbl._bin_counts_expire, now + timedelta(minutes=60))
         assert_equal(gbl._bin_counts_invalidated, None)
 
+    @mock.patch('forgetracker.model.ticket.search_artifact')
+    def test_bin_hits(self, mock_search):
+        gbl = c.app.globals
+        assert_equal(gbl.bin_hits(['status:open']), {})  # no tickets yet
+        forgetracker.model.Ticket.new()
+        mock_search.return_value.facets = {'facet_queries': {'status_s:open': 3, '*:*': 4}}
+        assert_equal(gbl.bin_hits(['status:open', '*:*', '']), {'status:open': 3, '*:*': 4})
+        assert_equal(mock_search.call_count, 1)
+        args, kw = mock_search.call_args
+        assert_equal(args, (forgetracker.model.Ticket, '*:*'))
+        assert_equal(sorted(kw['facet.query']), ['*:*', 'status_s:open'])
+        assert_equal(kw['fq'], ['-deleted_b:true'])
+
+        # when the faceted search fails, each of the bins is searched for
+        mock_search.reset_mock()
+        def search(atype, q, **kw):
+            if q == '*:*' or q.startswith('a:'):
+                raise SearchError('bad')
+            return mock.Mock(hits=2)
+        mock_search.side_effect = search
+        assert_equal(gbl.bin_hits(['a:(', 'status:open']), {'status:open': 2})
+        assert_equal(mock_search.call_count, 3)
+
+    def test_milestone_counts(self):
+        gbl = c.app.globals
+        gbl.custom_fields = [dict(name='_milestone', label='Milestone', type='milestone',
+                                  milestones=[dict(name='1.0'), dict(name='2.0')])]
+        ticket_model = forgetracker.model.Ticket
+        for i, (milestone, status) in enumerate([('1.0', 'open'), ('1.0', 'closed'), ('2.0', 'open')]):
+            t = ticket_model(ticket_num=i + 1, summary='t', status=status,
+                             custom_fields=dict(_milestone=milestone))
+        private = ticket_model(ticket_num=4, summary='t', status='closed',
+                               custom_fields=dict(_milestone='2.0'))
+        private.private = True
+        ThreadLocalORMSession.flush_all()
+        assert_equal(gbl.milestone_count('_milestone:1.0'),
+                     dict(name='_milestone:1.0', hits=2, closed=1))
+        # c.user is a project admin, who can read the private ticket
+        assert_equal(gbl.milestone_count('_milestone:2.0'),
+                     dict(name='_milestone:2.0', hits=2, closed=1))
+        assert_equal(gbl.milestone_count('_milestone:3.0'),
+                     dict(name='_milestone:3.0', hits=0, closed=0))
+        # public tickets are counted once, until a ticket changes
+        assert self.milestone_counts_updated(gbl)
+        with mock.patch.object(gbl, '_count_milestones', return_value={}) as count:
+            gbl.milestone_counts()
+            assert_equal(count.call_count, 1)  # only the private tickets
+            t.status = 'closed'
+            t.commit()
+            assert_equal(self.milestone_counts_updated(gbl), None)
+        ThreadLocalORMSession.flush_all()
+        assert_equal(gbl.milestone_count('_milestone:2.0')['closed'], 2)
+
+    def milestone_counts_updated(self, gbl):
+        return mapper(Globals).collection.m.collection.find_one(
+            {'_id': gbl._id}).get('_milestone_counts_updated')
+
+    def test_milestone_counts_not_saved_over(self):
+        gbl = c.app.globals
+        ThreadLocalORMSession.flush_all()
+        # e.g. a ticket created while the counts are worked out
+        Globals.query.update({'_id': gbl._id}, {'$inc': {'last_ticket_num': 5}})
+        gbl.milestone_counts()
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        assert_equal(Globals.query.get(_id=gbl._id).last_ticket_num, 5)
+
+    def test_milestone_counts_dropped_by_save(self):
+        gbl = c.app.globals
+        ThreadLocalORMSession.flush_all()
+        gbl.milestone_counts()
+        assert self.milestone_counts_updated(gbl)
+        # a Globals loaded before the counts were stored is saved
+        gbl.closed_status_names = 'closed wont-fix invalid'
+        ThreadLocalORMSession.flush_all()
+        assert_equal(self.milestone_counts_updated(gbl), None)
+
+    def test_milestone_counts_invalidated_while_counting(self):
+        gbl = c.app.globals
+        ThreadLocalORMSession.flush_all()
+
+        def count(query):
+            gbl.invalidate_milestone_counts()  # e.g. a ticket commit
+            return {}
+        with mock.patch.object(gbl, '_count_milestones', side_effect=count):
+            gbl.update_milestone_counts()
+        assert_equal(self.milestone_counts_updated(gbl), None)
+        # mongo keeps dates to the millisecond, so a count started in the
+        # same one as the invalidation isn't saved either
+        time.sleep(0.01)
+        gbl.update_milestone_counts()
+        assert self.milestone_counts_updated(gbl)
+
+    @mock.patch('forgetracker.model.ticket.datetime')
+    def test_milestone_counts_expire(self, mock_dt):
+        now = datetime.utcnow()
+        mock_dt.utcnow.return_value = now
+        gbl = c.app.globals
+        ThreadLocalORMSession.flush_all()
+        with mock.patch.object(gbl, '_count_milestones', return_value={}) as count:
+            gbl.milestone_counts()
+            gbl.milestone_counts()
+            assert_equal(count.call_count, 3)  # once for public tickets
+            mock_dt.utcnow.return_value = now + timedelta(minutes=61)
+            gbl.milestone_counts()
+            assert_equal(count.call_count, 5)
+
     def test_append_new_labels(self):
         gbl = Globals()
         assert_equal(gbl.append_new_labels([], ['tag1']), ['tag1'])
@@ -30,7 +30,7 @@
     assert_true,
     assert_false,
 )
-from forgetracker.model import Ticket, TicketAttachment
+from forgetracker.model import Ticket, TicketAttachment, TicketDailyStats
 from forgetracker.tests.unit import TrackerTestWithModel
 from forgetracker.import_support import ResettableStream
 from allura.model import Feed, Post, User
@@ -328,6 +328,38 @@ def test_attach_with_resettable_stream(self):
         assert_equal(len(ticket.attachments), 1)
         assert_equal(ticket.attachments[0].filename, 'test_ticket_model.py')
 
+    def test_private_ticket_read_access(self):
+        from allura.model import ProjectRole
+        from allura.lib.security import Credentials
+        from allura.websetup import bootstrap
+
+        admin = c.user
+        creator = bootstrap.create_user('Not a Project Admin')
+        observer = bootstrap.create_user('Random Non-Project User')
+        anon = User(_id=None, username='*anonymous',
+                    display_name='Anonymous')
+        public = Ticket(summary='public', ticket_num=1, app_config_id=c.app.config._id)
+        private = Ticket(summary='private', ticket_num=2, app_config_id=c.app.config._id,
+                         reported_by_id=creator._id)
+        role_developer = ProjectRole.by_name('Developer')._id
+        role_creator = ProjectRole.by_user(creator, upsert=True)._id
+        private.private = True
+        ThreadLocalORMSession.flush_all()
+        Credentials.get().clear()
+
+        assert_equal(public.index()['read_roles_ws'], 'inherit')
+        assert_equal(private.index()['read_roles_ws'], '%s %s' % (role_developer, role_creator))
+        assert_equal(private.index()['read_denied_ws'], '')
+
+        def readable(user):
+            result = Ticket.paged_query(c.app.config, user, {})
+            assert_equal(result['count'], len(result['tickets']))
+            return sorted(t.summary for t in result['tickets'])
+        assert_equal(readable(admin), ['private', 'public'])
+        assert_equal(readable(creator), ['private', 'public'])
+        assert_equal(readable(observer), ['public'])
+        assert_equal(readable(anon), ['public'])
+
     def test_json_parents(self):
         ticket = Ticket.new()
         json_keys = ticket.__json__().keys()
@@ -364,3 +396,90 @@ def test_index(self):
         assert_equal(idx['labels_t'], 'mylabel other')
         assert_equal(idx['reported_by_s'], 'test-user')
         assert_equal(idx['assigned_to_s'], None)  # must exist at least
+
+
+class TestTicketDailyStats(TrackerTestWithModel):
+
+    def test_ticket_changes(self):
+        ticket = Ticket.new()
+        ticket.summary = 'my ticket'
+        ticket.status = 'open'
+        ticket.custom_fields['_milestone'] = '1.0'
+        ticket.commit()
+        ticket.discussion_thread.add_post(text='a comment')
+        ticket.status = 'closed'
+        ticket.commit()
+        ThreadLocalORMSession.flush_all()
+        assert_equal(TicketDailyStats.sums(c.app.config._id), dict(
+            created=1, closed=1, comments=1,
+            status={'closed': 1},
+            milestone={'_milestone:1.0': 1},
+            milestone_closed={'_milestone:1.0': 1}))
+
+        ticket.soft_delete()
+        ThreadLocalORMSession.flush_all()
+        sums = TicketDailyStats.sums(c.app.config._id)
+        assert_equal(sums['created'], 1)
+        assert_equal(sums['status'], {})
+        assert_equal(sums['milestone'], {})
+
+        ticket.undelete()
+        ThreadLocalORMSession.flush_all()
+        sums = TicketDailyStats.sums(c.app.config._id)
+        assert_equal(sums['status'], {'closed': 1})
+        assert_equal(sums['milestone_closed'], {'_milestone:1.0': 1})
+
+    def test_history(self):
+        app_config_id = c.app.config._id
+        TicketDailyStats.add(
+            app_config_id, {'created': 2, 'status.open': 2}, datetime(2020, 1, 1))
+        TicketDailyStats.add(
+            app_config_id, {'closed': 1, 'status.open': -1, 'status.closed': 1},
+            datetime(2020, 1, 3, 12))
+        days = TicketDailyStats.history(
+            app_config_id, datetime(2020, 1, 2), datetime(2020, 1, 3))
+        assert_equal(days, [
+            dict(date=datetime(2020, 1, 2), created=0, closed=0, comments=0,
+                 status={'open': 2}, milestone={}, milestone_closed={}),
+            dict(date=datetime(2020, 1, 3), created=0, closed=1, comments=0,
+                 status={'open': 1, 'closed': 1}, milestone={},
+                 milestone_closed={}),
+        ])
+        assert_equal(
+            TicketDailyStats.sums(app_config_id, start=datetime(2020, 1, 2))['closed'], 1)
+
+    def test_comment_removed(self):
+        ticket = Ticket.new()
+        ticket.summary = 'my ticket'
+        ticket.commit()
+        thread = ticket.discussion_thread
+        post1 = thread.add_post(text='a comment')
+        post2 = thread.add_post(text='another comment')
+        ThreadLocalORMSession.flush_all()
+        assert_equal(TicketDailyStats.sums(c.app.config._id)['comments'], 2)
+        with mock.patch('allura.model.discuss.g'):
+            post1.spam()
+            assert_equal(TicketDailyStats.sums(c.app.config._id)['comments'], 1)
+            post1.undo('ok')
+            assert_equal(TicketDailyStats.sums(c.app.config._id)['comments'], 2)
+        post2.delete()
+        post2.delete()
+        assert_equal(TicketDailyStats.sums(c.app.config._id)['comments'], 1)
+
+    @td.with_tool('test', 'Tickets', 'bugs2', username='test-user')
+    def test_ticket_move_comments(self):
+        app1 = c.project.app_instance('bugs')
+        app2 = c.project.app_instance('bugs2')
+        with h.push_context(c.project._id, app_config_id=app1.config._id):
+            ticket = Ticket.new()
+            ticket.summary = 'my ticket'
+            ticket.commit()
+            ticket.discussion_thread.add_post(text='a comment')
+            ThreadLocalORMSession.flush_all()
+        assert_equal(TicketDailyStats.sums(app1.config._id)['comments'], 1)
+        moved = ticket.move(app2.config)
+        ThreadLocalORMSession.flush_all()
+        shown = Post.query.find(dict(thread_id=moved.discussion_thread._id,
+                                     status='ok', deleted=False)).count()
+        assert_equal(TicketDailyStats.sums(app1.config._id)['comments'], 0)
+        assert_equal(TicketDailyStats.sums(app2.config._id)['comments'], shown)
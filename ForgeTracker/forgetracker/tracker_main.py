@@ -445,6 +445,7 @@ def install(self, project):
         ]
         self.globals = TM.Globals(app_config_id=c.app.config._id,
                                   last_ticket_num=0,
+                                  daily_stats=True,
                                   open_status_names=self.config.options.pop(
                                       'open_status_names', 'open unread accepted pending'),
                                   closed_status_names=self.config.options.pop(
@@ -474,42 +475,26 @@ def uninstall(self, project):
         TM.Ticket.query.remove(app_config_id)
         TM.Bin.query.remove(app_config_id)
         TM.Globals.query.remove(app_config_id)
+        TM.TicketDailyStats.query.remove(app_config_id)
         super(ForgeTrackerApp, self).uninstall(project)
 
     def bulk_export(self, f, export_path='', with_attachments=False):
-        f.write('{"tickets": [')
-        tickets = list(TM.Ticket.query.find(dict(
+        f.write('{"tickets":')
+        self.export_artifacts(f, TM.Ticket, dict(
             app_config_id=self.config._id,
             # backwards compat for old tickets that don't have it set
             deleted={'$ne': True},
-        )))
-        if with_attachments:
-            GenericClass = utils.JSONForExport
-            self.export_attachments(tickets, export_path)
-        else:
-            GenericClass = jsonify.GenericJSON
-
-        for i, ticket in enumerate(tickets):
-            if i > 0:
-                f.write(',')
-            json.dump(ticket, f, cls=GenericClass, indent=2)
-        f.write('],\n"tracker_config":')
-        json.dump(self.config, f, cls=GenericClass, indent=2)
-        f.write(',\n"milestones":')
-        milestones = self.milestones
-        json.dump(milestones, f, cls=GenericClass, indent=2)
-        f.write(',\n"custom_fields":')
-        json.dump(self.globals.custom_fields, f,
-                  cls=GenericClass, indent=2)
-        f.write(',\n"open_status_names":')
-        json.dump(self.globals.open_status_names, f,
-                  cls=GenericClass, indent=2)
-        f.write(',\n"closed_status_names":')
-        json.dump(self.globals.closed_status_names, f,
-                  cls=GenericClass, indent=2)
-        f.write(',\n"saved_bins":')
-        bins = self.bins
-        json.dump(bins, f, cls=GenericClass, indent=2)
+        ), export_path, with_attachments)
+        GenericClass = utils.JSONForExport if with_attachments else jsonify.GenericJSON
+        for key, value in [
+                ('tracker_config', self.config),
+                ('milestones', self.milestones),
+                ('custom_fields', self.globals.custom_fields),
+                ('open_status_names', self.globals.open_status_names),
+                ('closed_status_names', self.globals.closed_status_names),
+                ('saved_bins', self.bins)]:
+            f.write(',\n"%s":' % key)
+            json.dump(value, f, cls=GenericClass, separators=(',', ':'))
         f.write('}')
 
     def export_attachments(self, tickets, export_path):
@@ -517,7 +502,7 @@ def export_attachments(self, tickets, export_path):
             attachment_path = self.get_attachment_export_path(export_path, str(ticket._id))
             self.save_attachments(attachment_path, ticket.attachments)
 
-            for post in ticket.discussion_thread.query_posts(status='ok'):
+            for post in ticket.discussion_thread.chronological_posts():
                 post_path = os.path.join(
                     attachment_path,
                     ticket.discussion_thread._id,
@@ -532,11 +517,11 @@ def bins(self):
     @property
     def milestones(self):
         milestones = []
+        counts = self.globals.milestone_counts()
         for fld in self.globals.milestone_fields:
             if fld.name == '_milestone':
                 for m in fld.milestones:
-                    d = self.globals.milestone_count(
-                        '%s:%s' % (fld.name, m.name))
+                    d = counts.get('%s:%s' % (fld.name, m.name), dict(hits=0, closed=0))
                     milestones.append(dict(
                         name=m.name,
                         due_date=m.get('due_date'),
@@ -671,12 +656,12 @@ def bin_counts(self, *args, **kw):
     @expose('json:')
     def milestone_counts(self, *args, **kw):
         milestone_counts = []
+        counts = c.app.globals.milestone_counts()
         for fld in c.app.globals.milestone_fields:
             for m in getattr(fld, "milestones", []):
                 if m.complete:
                     continue
-                count = c.app.globals.milestone_count(
-                    '%s:%s' % (fld.name, m.name))['hits']
+                count = counts.get('%s:%s' % (fld.name, m.name), {}).get('hits', 0)
                 name = h.text.truncate(m.name, 72)
                 milestone_counts.append({'name': name, 'count': count})
         return {'milestone_counts': milestone_counts}
@@ -802,6 +787,9 @@ def update_milestones(self, field_name=None, milestones=None, **kw):
                                         ticket_num={'$in': ticket_numbers})).all()
                                     for t in tickets:
                                         t.custom_fields[field_name] = m.name
+                                    TM.TicketDailyStats.milestone_renamed(
+                                        c.app.config._id, field_name,
+                                        new['old_name'], m.name)
                                     update_counts = True
                     if new['old_name'] == '' and new['new_name'] != '':
                         fld.milestones.append(dict(
@@ -1073,12 +1061,6 @@ def ticket_comments_since(self, when=None):
     @expose('jinja:forgetracker:templates/tracker/stats.html')
     def stats(self, dates=None, **kw):
         globals = c.app.globals
-        total = TM.Ticket.query.find(
-            dict(app_config_id=c.app.config._id, deleted=False)).count()
-        open = TM.Ticket.query.find(dict(app_config_id=c.app.config._id, deleted=False, status={
-                                    '$in': list(globals.set_of_open_status_names)})).count()
-        closed = TM.Ticket.query.find(dict(app_config_id=c.app.config._id, deleted=False, status={
-                                      '$in': list(globals.set_of_closed_status_names)})).count()
         now = datetime.utcnow()
         week = timedelta(weeks=1)
         fortnight = timedelta(weeks=2)
@@ -1086,13 +1068,40 @@ def stats(self, dates=None, **kw):
         week_ago = now - week
         fortnight_ago = now - fortnight
         month_ago = now - month
-        week_tickets = self.tickets_since(week_ago)
-        fortnight_tickets = self.tickets_since(fortnight_ago)
-        month_tickets = self.tickets_since(month_ago)
-        comments = self.ticket_comments_since()
-        week_comments = self.ticket_comments_since(week_ago)
-        fortnight_comments = self.ticket_comments_since(fortnight_ago)
-        month_comments = self.ticket_comments_since(month_ago)
+        if globals.daily_stats:
+            # a document per day rather than a scan over the tickets and posts
+            sums = TM.TicketDailyStats.sums
+            all_time = sums(c.app.config._id)
+            status = all_time['status']
+            total = sum(status.itervalues())
+            open = sum(status.get(name, 0)
+                       for name in globals.set_of_open_status_names)
+            closed = sum(status.get(name, 0)
+                         for name in globals.set_of_closed_status_names)
+            last_week = sums(c.app.config._id, week_ago)
+            last_fortnight = sums(c.app.config._id, fortnight_ago)
+            last_month = sums(c.app.config._id, month_ago)
+            week_tickets = last_week['created']
+            fortnight_tickets = last_fortnight['created']
+            month_tickets = last_month['created']
+            comments = all_time['comments']
+            week_comments = last_week['comments']
+            fortnight_comments = last_fortnight['comments']
+            month_comments = last_month['comments']
+        else:
+            total = TM.Ticket.query.find(
+                dict(app_config_id=c.app.config._id, deleted=False)).count()
+            open = TM.Ticket.query.find(dict(app_config_id=c.app.config._id, deleted=False, status={
+                                        '$in': list(globals.set_of_open_status_names)})).count()
+            closed = TM.Ticket.query.find(dict(app_config_id=c.app.config._id, deleted=False, status={
+                                          '$in': list(globals.set_of_closed_status_names)})).count()
+            week_tickets = self.tickets_since(week_ago)
+            fortnight_tickets = self.tickets_since(fortnight_ago)
+            month_tickets = self.tickets_since(month_ago)
+            comments = self.ticket_comments_since()
+            week_comments = self.ticket_comments_since(week_ago)
+            fortnight_comments = self.ticket_comments_since(fortnight_ago)
+            month_comments = self.ticket_comments_since(month_ago)
         c.user_select = ffw.ProjectUserCombo()
         if dates is None:
             today = datetime.utcnow()
@@ -1453,13 +1462,8 @@ def delete(self, **kw):
     @expose('json:')
     @require_post()
     def undelete(self, **kw):
-        require_access(self.ticket, 'delete')
-        self.ticket.deleted = False
-        self.ticket.summary = re.sub(
-            ' \d+:\d+:\d+ \d+-\d+-\d+$', '', self.ticket.summary)
-        M.Shortlink.from_artifact(self.ticket)
+        self.ticket.undelete()
         flash('Ticket successfully restored')
-        c.app.globals.invalidate_bin_counts()
         return dict(location='../' + str(self.ticket.ticket_num))
 
     @require_post()
@@ -1857,6 +1861,26 @@ def _convert_ticket(t):
         results['tickets'] = map(_convert_ticket, results['tickets'])
         return results
 
+    @expose('json:')
+    def stats(self, start=None, end=None, **kw):
+        """The counts of each day from ``start`` to ``end`` (``YYYY-MM-DD``,
+        the last 30 days by default), see
+        :meth:`~forgetracker.model.TicketDailyStats.history`."""
+        if not c.app.globals.daily_stats:
+            raise exc.HTTPNotFound()
+        try:
+            end = datetime.strptime(end, '%Y-%m-%d') if end else datetime.utcnow()
+            start = (datetime.strptime(start, '%Y-%m-%d') if start
+                     else end - timedelta(days=29))
+        except ValueError:
+            raise exc.HTTPBadRequest('start and end must be dates as YYYY-MM-DD')
+        if not timedelta(0) <= end - start <= timedelta(days=3660):
+            raise exc.HTTPBadRequest('start must be before end, and up to 10 years before')
+        days = TM.TicketDailyStats.history(c.app.config._id, start, end)
+        for day in days:
+            day['date'] = day['date'].strftime('%Y-%m-%d')
+        return dict(days=days)
+
     @expose()
     def _lookup(self, ticket_num, *remainder):
         if ticket_num.isdigit():
@@ -51,5 +51,6 @@
 
       [paste.paster_command]
       fix-discussion = forgetracker.command.fix_discussion:FixDiscussion
+      backfill-tracker-stats = forgetracker.command.tracker_stats:BackfillTrackerStats
       """,
       )
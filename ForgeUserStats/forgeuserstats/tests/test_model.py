@@ -458,9 +458,11 @@ def test_count_loc(self, unified_diff):
                 copied=[mock.MagicMock()],
                 added=[mock.MagicMock()],
             ),
+            # the SCM can't count lines, so the blobs are diffed
+            lines_added=None,
         )
         unified_diff.return_value = ['+++', '---', '+line']
-        newcommit.tree.get_blob_by_path.return_value = mock.MagicMock()
+        newcommit.tree.get_blob_by_path.return_value = mock.MagicMock(size=10)
         newcommit.tree.get_blob_by_path.return_value.__iter__.return_value = [
             'one']
         newcommit.repo.commit(
@@ -481,3 +483,29 @@ def test_count_loc(self, unified_diff):
         self.assertEqual(stats.general[0].commits[0],
                          {'lines': 3, 'number': 2, 'language': None})
         assert not unified_diff.called
+
+    @mock.patch('allura.model.stats.difflib.unified_diff')
+    def test_count_loc_too_big(self, unified_diff):
+        stats = USM.UserStats()
+        newcommit = mock.Mock(
+            parent_ids=['deadbeef'],
+            diffs=mock.Mock(changed=[mock.MagicMock()], copied=[], added=[mock.MagicMock()]),
+            lines_added=None,
+        )
+        newcommit.tree.get_blob_by_path.return_value = mock.MagicMock(size=2000)
+        project = mock.Mock(trove_topic=[], trove_language=[])
+        with h.push_config(config, **{'scm.line_counts.max_file_size': '1000'}):
+            stats.addCommit(newcommit, datetime.utcnow(), project)
+        self.assertEqual(stats.general[0].commits[0]['lines'], 0)
+        assert not unified_diff.called
+
+    @mock.patch('allura.model.stats.difflib.unified_diff')
+    def test_count_loc_by_scm(self, unified_diff):
+        stats = USM.UserStats()
+        newcommit = mock.Mock(lines_added=7)
+        project = mock.Mock(trove_topic=[], trove_language=[])
+        stats.addCommit(newcommit, datetime.utcnow(), project)
+        self.assertEqual(stats.general[0].commits[0],
+                         {'lines': 7, 'number': 1, 'language': None})
+        assert not unified_diff.called
+        assert not newcommit.repo.commit.called
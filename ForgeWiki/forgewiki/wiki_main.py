@@ -16,14 +16,13 @@
 #       under the License.
 
 #-*- python -*-
-import json
 import logging
 import os
 from pprint import pformat
 from urllib import unquote
 
 # Non-stdlib imports
-from tg import expose, validate, redirect, flash, jsonify
+from tg import expose, validate, redirect, flash
 from tg.decorators import with_trailing_slash, without_trailing_slash
 from pylons import tmpl_context as c, app_globals as g
 from pylons import request
@@ -38,7 +37,7 @@
 from allura.lib.search import search_app
 from allura.lib.decorators import require_post, memorable_forget
 from allura.lib.security import require_access, has_access
-from allura.lib.utils import is_ajax, JSONForExport
+from allura.lib.utils import is_ajax
 from allura.lib import exceptions as forge_exc
 from allura.controllers import AppDiscussionController, BaseController, AppDiscussionRestController
 from allura.controllers import DispatchIndex
@@ -342,27 +341,18 @@ def uninstall(self, project):
         super(ForgeWikiApp, self).uninstall(project)
 
     def bulk_export(self, f, export_path='', with_attachments=False):
-        f.write('{"pages": [')
-        pages = list(WM.Page.query.find(dict(
+        f.write('{"pages":')
+        self.export_artifacts(f, WM.Page, dict(
             app_config_id=self.config._id,
-            deleted=False)))
-        if with_attachments:
-            GenericClass = JSONForExport
-            self.export_attachments(pages, export_path)
-        else:
-            GenericClass = jsonify.GenericJSON
-        for i, page in enumerate(pages):
-            if i > 0:
-                f.write(',')
-            json.dump(page, f, cls=GenericClass, indent=2)
-        f.write(']}')
+            deleted=False), export_path, with_attachments)
+        f.write('}')
 
     def export_attachments(self, pages, export_path):
         for page in pages:
             attachment_path = self.get_attachment_export_path(export_path, str(page._id))
             self.save_attachments(attachment_path, page.attachments)
 
-            for post in page.discussion_thread.query_posts(status='ok'):
+            for post in page.discussion_thread.chronological_posts():
                 post_path = os.path.join(
                     attachment_path,
                     page.discussion_thread._id,
@@ -16,16 +16,57 @@
 #       under the License.
 
 import sys
+import time
+import multiprocessing
 
-import PIL
 from pylons import tmpl_context as c
 
-from ming.orm import ThreadLocalORMSession, state, Mapper
+from ming.orm import ThreadLocalORMSession, Mapper
 
 from allura.command import base
 from allura.lib.helpers import iter_entry_points
 
 
+def class_path(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def load_class(path):
+    smod, scls = path.rsplit('.', 1)
+    return getattr(__import__(smod, fromlist=[scls]), scls)
+
+
+def make_thumbnail(args):
+    '''Make the thumbnail of one attachment (run in a worker process).
+    Returns True if one was created.'''
+    cls_path, attachment_id = args
+    try:
+        att_cls = load_class(cls_path)
+        attachment = att_cls.query.get(_id=attachment_id)
+        if attachment is None:
+            return False
+        count = att_cls.query.find(attachment.thumbnail_query()).count()
+        if count == 1:
+            base.log.info(
+                "Thumbnail already exists for '%s' - skipping", attachment.filename)
+            return False
+        elif count > 1:
+            base.log.warning(
+                "There are %d thumbnails for '%s' - consider clearing them with --force", count, attachment.filename)
+            return False
+        base.log.info("Processing image attachment '%s'", attachment.filename)
+        thumbnail = attachment.make_thumbnail()
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        if thumbnail is None:
+            return False
+        base.log.info("Created thumbnail for '%s'", attachment.filename)
+        return True
+    except Exception:
+        base.log.exception('Error making thumbnail of %s %s', cls_path, attachment_id)
+        return False
+
+
 class RethumbCommand(base.Command):
     min_args = 1
     max_args = 2
@@ -34,40 +75,42 @@ class RethumbCommand(base.Command):
     parser = base.Command.standard_parser(verbose=True)
     parser.add_option('', '--force', dest='force', action='store_true',
                       help=('Recreate all thumbnails (by first removing any existing)'))
+    parser.add_option('', '--processes', dest='processes', type='int', default=1,
+                      help='Number of processes making thumbnails at once')
+    parser.add_option('', '--progress', dest='progress', type='int', default=100,
+                      help='Report progress after this many attachments')
 
     created_thumbs = 0
 
-    def create_thumbnail(self, attachment, att_cls):
-        if attachment.is_image():
-            base.log.info("Processing image attachment '%s'",
-                          attachment.filename)
-            doc = state(attachment).document.deinstrumented_clone()
-            del doc['_id']
-            del doc['file_id']
-            doc['type'] = 'thumbnail'
-            count = att_cls.query.find(doc).count()
-            if count == 1:
-                base.log.info(
-                    "Thumbnail already exists for '%s' - skipping", attachment.filename)
-                return
-            elif count > 1:
-                base.log.warning(
-                    "There are %d thumbnails for '%s' - consider clearing them with --force", count, attachment.filename)
-                return
-
-            image = PIL.Image.open(attachment.rfile())
-            del doc['content_type']
-            del doc['filename']
-            att_cls.save_thumbnail(attachment.filename, image,
-                                   attachment.content_type, att_cls.thumbnail_size, doc, square=True)
-            base.log.info("Created thumbnail for '%s'", attachment.filename)
-            self.created_thumbs += 1
-
-    def process_att_of_type(self, cls, find_criteria):
-        base.log.info('Processing attachment class: %s', cls)
+    def collect_att_of_type(self, cls, find_criteria):
+        base.log.info('Collecting attachment class: %s', cls)
         find_criteria['type'] = 'attachment'
-        for att in cls.query.find(find_criteria):
-            self.create_thumbnail(att, cls)
+        return [(class_path(cls), att._id)
+                for att in cls.query.find(find_criteria)
+                if att.is_image()]
+
+    def make_thumbnails(self, work):
+        '''Make the thumbnails, with several processes if asked to, logging progress'''
+        if self.options.processes > 1:
+            pool = multiprocessing.Pool(self.options.processes)
+            results = pool.imap_unordered(make_thumbnail, work)
+        else:
+            pool = None
+            results = (make_thumbnail(item) for item in work)
+        start = time.time()
+        try:
+            for i, created in enumerate(results, 1):
+                if created:
+                    self.created_thumbs += 1
+                if i % self.options.progress == 0 or i == len(work):
+                    elapsed = time.time() - start
+                    base.log.info('Progress: %d/%d attachments (%d%%), %d thumbnails created, %.1f/s',
+                                  i, len(work), 100 * i / len(work), self.created_thumbs,
+                                  i / elapsed if elapsed else 0)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
 
     def command(self):
         from allura import model as M
@@ -90,6 +133,7 @@ def command(self):
             projects = M.Project.query.find({'shortname': self.args[1]})
         else:
             projects = M.Project.query.find()
+        work = []
         for p in projects:
             base.log.info('=' * 20)
             base.log.info("Processing project '%s'", p.shortname)
@@ -112,7 +156,7 @@ def command(self):
 
                 # Any application may contain DiscussionAttachment's, it has
                 # discussion_id field
-                self.process_att_of_type(
+                work += self.collect_att_of_type(
                     M.DiscussionAttachment, {'app_config_id': app._id, 'discussion_id': {'$ne': None}})
 
                 # Otherwise, we'll take attachment classes belonging to app's
@@ -125,11 +169,17 @@ def command(self):
 
                 classes = package_model_map.get(app_package, [])
                 for cls in classes:
-                    self.process_att_of_type(
+                    work += self.collect_att_of_type(
                         cls, {'app_config_id': app._id, 'discussion_id': None})
 
                 base.log.info('-' * 10)
 
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        base.log.info('Making thumbnails of %d image attachments with %d processes',
+                      len(work), self.options.processes)
+        self.make_thumbnails(work)
+
         base.log.info('Recreated %d thumbs', self.created_thumbs)
         if self.options.force:
             if existing_thumbs != self.created_thumbs:
@@ -137,8 +187,6 @@ def command(self):
                     'There were %d thumbs before --force operation started, but %d recreated',
                     existing_thumbs, self.created_thumbs)
 
-        ThreadLocalORMSession.flush_all()
-
 
 if __name__ == '__main__':
     command = RethumbCommand('rethumb')